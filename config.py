@@ -19,6 +19,123 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Shards of the orders by customer_id (see service/sharding.py): shard 0 is
+# DATABASE_URI and SHARDS adds the others, e.g. '{"1": "postgres://..."}';
+# the ids of shard n start at n * SHARD_ID_SPAN
+SHARDS = json.loads(os.getenv("SHARDS", "{}"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+SHARD_ID_SPAN = int(os.getenv("SHARD_ID_SPAN", "100000000"))
+
+# When to create missing tables: "startup" (when the app is imported),
+# "lazy" (on the first request) or "off" (schema managed by a deploy step)
+DB_SCHEMA_CHECK = os.getenv("DB_SCHEMA_CHECK", "startup")
+# Directory for markers that let workers skip the schema check once it has
+# passed for the current schema and database (empty disables the cache)
+DB_SCHEMA_CACHE_DIR = os.getenv("DB_SCHEMA_CACHE_DIR", "")
+
+# Warm up done by each worker before it takes traffic: the number of pooled
+# connections to open and of most recent orders to load
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+WARMUP_HOT_ORDERS = int(os.getenv("WARMUP_HOT_ORDERS", "0"))
+
+# Request deadlines in seconds, propagated to Postgres as statement_timeout.
+# REQUEST_TIMEOUTS overrides the default per endpoint, e.g. {"order_collection": 5}
+# and clients can ask for another deadline with the X-Request-Timeout header
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+REQUEST_TIMEOUT_MAX = float(os.getenv("REQUEST_TIMEOUT_MAX", "60"))
+REQUEST_TIMEOUTS = json.loads(os.getenv("REQUEST_TIMEOUTS", "{}"))
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+REQUEST_TIMEOUT_EXEMPT = ["static", "asset", "order_event_stream"]
+
+# Admission control (service/admission.py): each client may send RATE_LIMIT
+# requests per second on average, in bursts of up to RATE_LIMIT_BURST (0
+# disables the rate limit), and at most CONCURRENCY_LIMIT requests are served
+# at once (0 disables the limit). RATE_LIMITS and CONCURRENCY_LIMITS set the
+# limits of an endpoint, e.g. {"order_bulk_collection": [1, 5]} and
+# {"order_bulk_collection": 2}. Clients are told by their address;
+# TRUSTED_PROXIES is the number of proxies in front of the service whose
+# X-Forwarded-For is trusted to give it (0 ignores the header)
+RATE_LIMIT = float(os.getenv("RATE_LIMIT", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", "{}"))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "16"))
+CONCURRENCY_LIMITS = json.loads(os.getenv("CONCURRENCY_LIMITS", "{}"))
+CONCURRENCY_RETRY_AFTER = int(os.getenv("CONCURRENCY_RETRY_AFTER", "1"))
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+ADMISSION_EXEMPT = ["static", "asset", "index", "ready", "metrics"]
+# event streams stay open, they would hold a slot for their whole life
+CONCURRENCY_EXEMPT = ["order_event_stream"]
+
+# Seconds an Idempotency-Key is remembered, and after which a key whose
+# first request never finished can be claimed again
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "60"))
+
+# Largest array accepted by POST /orders/bulk
+BULK_MAX_ORDERS = int(os.getenv("BULK_MAX_ORDERS", "1000"))
+
+# Most ids of each kind accepted by POST /orders/lookup
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "1000"))
+
+# Listings of tables with more estimated rows than QUERY_SCAN_THRESHOLD must
+# not need a full scan (see service/queries.py); pages are at most
+# QUERY_MAX_PAGE_SIZE rows and start before QUERY_MAX_OFFSET
+QUERY_SCAN_THRESHOLD = int(os.getenv("QUERY_SCAN_THRESHOLD", "100000"))
+QUERY_MAX_OFFSET = int(os.getenv("QUERY_MAX_OFFSET", "10000"))
+QUERY_MAX_PAGE_SIZE = int(os.getenv("QUERY_MAX_PAGE_SIZE", "1000"))
+
+# Totals of the listings (X-Total-Count): counts are reused for COUNT_CACHE_TTL
+# seconds and planner estimates below COUNT_EXACT_BELOW rows are counted exactly
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_EXACT_BELOW = int(os.getenv("COUNT_EXACT_BELOW", "10000"))
+
+# Changes returned by GET /orders/changes when no limit is given
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "100"))
+
+# Server-Sent Events of GET /orders/events: seconds between the reads of the
+# changes when no notification arrives, between keep-alive comments and
+# before a stream ends (the client reconnects), and events a stream may lag
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", "1"))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", "600"))
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "1000"))
+# Streams open at once in a worker, each holds a thread: keep it below
+# GUNICORN_THREADS so that the other requests are still served; the streams
+# over it get 503 with Retry-After
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "4"))
+
+# Response compression: bodies smaller than COMPRESSION_MIN_SIZE bytes are
+# sent as is, the levels trade CPU for size (gzip 1-9, brotli 0-11, zstd 1-22).
+# Compressed request bodies may be at most COMPRESSION_MAX_COMPRESSED_SIZE and
+# inflate to at most COMPRESSION_MAX_REQUEST_SIZE
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_MAX_REQUEST_SIZE = int(os.getenv("COMPRESSION_MAX_REQUEST_SIZE", str(64 * 1024 * 1024)))
+COMPRESSION_MAX_COMPRESSED_SIZE = int(os.getenv("COMPRESSION_MAX_COMPRESSED_SIZE", str(16 * 1024 * 1024)))
+
+# Connection pool of the optional async read path (service/async_reads.py)
+ASYNC_POOL_MIN_SIZE = int(os.getenv("ASYNC_POOL_MIN_SIZE", "2"))
+ASYNC_POOL_MAX_SIZE = int(os.getenv("ASYNC_POOL_MAX_SIZE", "20"))
+
+# Group commit of item additions and item status updates (service/group_commit.py):
+# the writes that arrive within GROUP_COMMIT_WINDOW seconds, at most
+# GROUP_COMMIT_MAX_BATCH of them, share one transaction. Needs GUNICORN_THREADS > 1
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "false").lower() in ("1", "true", "yes", "on")
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.002"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+
+# Concurrent identical reads of an order or of a customer's orders share one
+# query (service/coalescing.py)
+READ_COALESCING = os.getenv("READ_COALESCING", "true").lower() in ("1", "true", "yes", "on")
+
+# Buckets returned by GET /orders/rollups when no start is given, and the most
+# buckets a request may ask for
+ORDER_ROLLUP_BUCKETS = int(os.getenv("ORDER_ROLLUP_BUCKETS", "60"))
+ORDER_ROLLUP_MAX_BUCKETS = int(os.getenv("ORDER_ROLLUP_MAX_BUCKETS", "1500"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
 LOGGING_LEVEL = logging.INFO
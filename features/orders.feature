@@ -120,8 +120,9 @@ Feature: The orders service back-end
     And I set the "customer_id" to "1001"
     And I press the "find-by-customer-id" button
     Then I should see the message "Success"
-    And I should see "SHIPPED" in the results
-    And I should see "DELIVERED" in the results
+    And the "PLACED" count in the results should be "0"
+    And the "SHIPPED" count in the results should be "1"
+    And the "DELIVERED" count in the results should be "1"
     When I copy the "id" field
     And I press the "Reset-Form" button
     Then the "id" field should be empty
@@ -121,6 +121,16 @@ def step_impl(context, text):
     expect(found).to_be(True)
 
 
+@then('the "{item_status}" count in the results should be "{count}"')
+def step_impl(context, item_status, count):
+    """ Check the items in a status of the only order in the results """
+    selector = '#results_body td.{}_count'.format(item_status.lower())
+    found = WebDriverWait(context.driver, WAIT_SECONDS).until(
+        lambda driver: [cell.text for cell in driver.find_elements_by_css_selector(selector)] == [count]
+    )
+    expect(found).to_be(True)
+
+
 @then('I should not see order for customer_id "{customer_id}" in the results')
 def step_impl(context, customer_id):
     element = context.driver.find_element_by_id('results')
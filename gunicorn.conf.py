@@ -3,4 +3,17 @@ import os
 PORT = os.getenv("PORT", "5000")
 bind = "0.0.0.0:" + PORT
 workers = 1
-log_level = "info"
\ No newline at end of file
+# threads per worker: each open event stream holds one (see SSE_MAX_STREAMS)
+# and concurrent requests are what group commit batches
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+log_level = "info"
+
+
+def post_worker_init(worker):
+    """ Warms up the worker after the app is loaded and before it accepts requests """
+    from service import routes
+    try:
+        routes.warm_up()
+    except Exception as error:  # pylint: disable=broad-except
+        # the worker still starts and /ready reports 503 until a warm up succeeds
+        worker.log.error("Warm up failed: %s", error)
@@ -6,16 +6,25 @@ and SQL database
 """
 import os
 import sys
+import time
 import logging
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+startup_started = time.perf_counter()
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object('config')
+if app.config["TRUSTED_PROXIES"]:
+    # Take the client address from X-Forwarded-For, as set by our own proxies only
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
 
 # Import the rutes After the Flask app is created
 from service import routes, models
 
+routes_loaded = time.perf_counter()
+
 # Set up logging for production
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
@@ -39,4 +48,9 @@ except Exception as error:
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
-app.logger.info("Service inititalized!")
+startup_finished = time.perf_counter()
+app.config["STARTUP_SECONDS"] = startup_finished - startup_started
+app.logger.info("Routes loaded in %.3fs, database initialized in %.3fs (schema check: %s)",
+                routes_loaded - startup_started, startup_finished - routes_loaded,
+                app.config["DB_SCHEMA_CHECK"])
+app.logger.info("Service inititalized in %.3f seconds!", app.config["STARTUP_SECONDS"])
@@ -0,0 +1,176 @@
+"""
+Admission control
+
+Requests are admitted before they reach the routes, so that a spike or a
+greedy client is turned away at once instead of queuing until gunicorn
+times the worker out:
+
+- each client, told by its address, gets a token bucket refilled at
+  RATE_LIMIT requests per second up to RATE_LIMIT_BURST; a client with an empty bucket gets 429 with Retry-After.
+  Headers sent by the client can't pick its bucket: the address comes from
+  X-Forwarded-For only behind TRUSTED_PROXIES proxies (see service/__init__.py)
+- at most CONCURRENCY_LIMIT requests are served at once; the others get
+  503 with Retry-After rather than waiting for a database connection
+
+RATE_LIMITS and CONCURRENCY_LIMITS give an endpoint its own limits, e.g.
+{"order_bulk_collection": [1, 5]} and {"order_bulk_collection": 2}; the
+other endpoints share the default ones. The counters are served by
+GET /metrics.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+
+class TokenBucket():
+    """ Allows rate requests per second on average and bursts of up to burst requests """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """ Takes a token, returns 0 or the seconds until one is available """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        """ Returns True when the bucket has refilled, it can be dropped """
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter():
+    """ Token buckets of the clients of one or more endpoints """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, client):
+        """ Takes a token of a client, returns 0 or the seconds until one is available """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= self.max_clients:
+                    self.buckets = {key: kept for key, kept in self.buckets.items() if not kept.idle(now)}
+                bucket = self.buckets[client] = TokenBucket(self.rate, self.burst, now)
+            return bucket.take(now)
+
+
+class ConcurrencyLimiter():
+    """ Caps the requests served at once by one or more endpoints """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns True when the request can be served, it must then release() """
+        with self.lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+class AdmissionControl():
+    """ The rate and concurrency limits of the endpoints of an app """
+
+    def __init__(self, config):
+        self.config = config
+        self.exempt = set(config["ADMISSION_EXEMPT"])
+        self.concurrency_exempt = set(config["CONCURRENCY_EXEMPT"])
+        self.rate_limiters = {
+            endpoint: RateLimiter(rate, burst, config["RATE_LIMIT_MAX_CLIENTS"])
+            for endpoint, (rate, burst) in config["RATE_LIMITS"].items()
+        }
+        self.default_rate_limiter = RateLimiter(config["RATE_LIMIT"], config["RATE_LIMIT_BURST"],
+                                                config["RATE_LIMIT_MAX_CLIENTS"])
+        self.concurrency_limiters = {
+            endpoint: ConcurrencyLimiter(limit) for endpoint, limit in config["CONCURRENCY_LIMITS"].items()
+        }
+        self.default_concurrency_limiter = ConcurrencyLimiter(config["CONCURRENCY_LIMIT"])
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def client(self):
+        """ Returns the key of the client of the current request """
+        return request.remote_addr
+
+    def admit(self, endpoint):
+        """ Raises TooManyRequests or ServiceUnavailable when the request cannot be served now """
+        if endpoint is None or endpoint in self.exempt:
+            return None
+        rate_limiter = self.rate_limiters.get(endpoint, self.default_rate_limiter)
+        if rate_limiter.rate > 0:
+            wait = rate_limiter.take(self.client())
+            if wait:
+                self._count(endpoint, "rate_limited")
+                raise TooManyRequests("Rate limit exceeded, retry in {:.1f} seconds".format(wait),
+                                      retry_after=math.ceil(wait))
+        concurrency_limiter = None
+        if endpoint not in self.concurrency_exempt:
+            concurrency_limiter = self.concurrency_limiters.get(endpoint, self.default_concurrency_limiter)
+            if concurrency_limiter.limit <= 0:
+                concurrency_limiter = None
+            elif not concurrency_limiter.acquire():
+                self._count(endpoint, "shed")
+                raise ServiceUnavailable("Too many requests in progress, retry later",
+                                         retry_after=self.config["CONCURRENCY_RETRY_AFTER"])
+        self._count(endpoint, "admitted")
+        return concurrency_limiter
+
+    def _count(self, endpoint, outcome):
+        with self.lock:
+            self.counters[(endpoint, outcome)] += 1
+
+    def metrics(self):
+        """ Returns the limits, the requests in flight and the counters of each endpoint """
+        endpoints = {}
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (endpoint, outcome), count in counters:
+            endpoints.setdefault(endpoint, {"admitted": 0, "rate_limited": 0, "shed": 0})[outcome] = count
+        limiters = dict(self.concurrency_limiters, default=self.default_concurrency_limiter)
+        return {
+            "endpoints": endpoints,
+            "in_flight": {name: limiter.in_flight for name, limiter in limiters.items()},
+            "concurrency_limits": {name: limiter.limit for name, limiter in limiters.items()},
+            "rate_limits": {name: [limiter.rate, limiter.burst] for name, limiter in
+                            dict(self.rate_limiters, default=self.default_rate_limiter).items()},
+        }
+
+
+def init_admission(app):
+    """ Registers the request hooks of the admission control, returns it """
+    admission = AdmissionControl(app.config)
+
+    @app.before_request
+    def _admit():
+        g.concurrency_limiter = admission.admit(request.endpoint)
+
+    @app.teardown_request
+    def _release(exception=None):
+        limiter = g.pop("concurrency_limiter", None)
+        if limiter is not None:
+            limiter.release()
+
+    return admission
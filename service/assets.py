@@ -0,0 +1,104 @@
+"""
+Static assets
+
+The files of service/static are served under /assets with the hash of their
+content in the name, e.g. /assets/js/rest_api.3f2a9c1b0d.js, so they can be
+cached by browsers and proxies for a year (Cache-Control immutable): a
+changed file gets a new name. Templates link them with asset_url().
+
+Each asset is compressed once per process, at the highest levels, with
+every encoding of service.compression (the warm up does it before the
+worker takes traffic) and the variant the client accepts is sent as is.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from flask import request
+from werkzeug.exceptions import NotFound
+from service.compression import Compressor, available_encodings, is_compressible
+
+# One year, the longest lifetime caches honour
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Levels used to precompress, the cost is paid once per process
+PRECOMPRESSION_LEVELS = {
+    "COMPRESSION_LEVEL": 9,
+    "COMPRESSION_BROTLI_QUALITY": 11,
+    "COMPRESSION_ZSTD_LEVEL": 19,
+}
+
+
+class Asset():
+    """ A static file with its fingerprint and its compressed variants """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.digest = hashlib.sha1(data).hexdigest()[:10]
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        """ The fingerprinted file name, e.g. js/rest_api.3f2a9c1b0d.js """
+        root, extension = os.path.splitext(self.path)
+        return "{}.{}{}".format(root, self.digest, extension)
+
+    def encoded(self, encoding, config):
+        """ Returns the content compressed with encoding, compressing it the first time """
+        with self.lock:
+            if encoding not in self.variants:
+                compressor = Compressor(encoding, dict(config, **PRECOMPRESSION_LEVELS))
+                self.variants[encoding] = compressor.compress_all(self.data)
+            return self.variants[encoding]
+
+
+class AssetManifest():
+    """ The fingerprinted assets of a static folder """
+
+    def __init__(self, folder):
+        self.assets = {}
+        self.names = {}
+        for directory, _, files in os.walk(folder):
+            for file_name in files:
+                path = os.path.relpath(os.path.join(directory, file_name), folder).replace(os.sep, "/")
+                with open(os.path.join(folder, path), "rb") as asset_file:
+                    asset = Asset(path, asset_file.read())
+                self.assets[asset.name] = asset
+                self.names[path] = asset.name
+
+    def url(self, path):
+        """ Returns the URL of the fingerprinted asset of a static file """
+        return "/assets/" + self.names[path]
+
+    def precompress(self, config):
+        """ Compresses every compressible asset with every encoding, returns the count """
+        count = 0
+        for asset in self.assets.values():
+            if is_compressible(asset.mimetype):
+                for encoding in available_encodings():
+                    asset.encoded(encoding, config)
+                    count += 1
+        return count
+
+    def response(self, app, name):
+        """ Returns the response serving a fingerprinted asset """
+        asset = self.assets.get(name)
+        if asset is None:
+            raise NotFound("Asset {} was not found".format(name))
+        response = app.response_class(asset.data, mimetype=asset.mimetype)
+        etag = asset.digest
+        if is_compressible(asset.mimetype):
+            response.vary.add("Accept-Encoding")
+            encoding = request.accept_encodings.best_match(available_encodings())
+            if encoding:
+                response.set_data(asset.encoded(encoding, app.config))
+                response.headers["Content-Encoding"] = encoding
+                etag = "{}-{}".format(asset.digest, encoding)
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+        response.set_etag(etag)
+        return response.make_conditional(request)
@@ -0,0 +1,242 @@
+"""
+Async read path
+
+An optional ASGI application for the status polling reads,
+GET /orders/<order_id> and GET /orders?customer_id=<id>, served on asyncio
+with the asyncpg driver so that one process can hold thousands of
+concurrent polls while they wait on Postgres. Every other request is handed
+to the Flask application (through asgiref), so the ASGI app can stand in
+for the WSGI one:
+
+  uvicorn service.async_reads:app --host 0.0.0.0 --port $PORT
+
+The SQL is compiled from the SQLAlchemy models, ?fields= is validated by
+service.projection and the responses are assembled by Order.assemble and
+marshalled with the flask-restx order_model, as in service/routes.py. With
+SHARDS, a pool is opened per shard and each read goes to the shard of its
+order or customer (see service/sharding.py).
+"""
+import asyncio
+import json
+import re
+from functools import lru_cache
+from urllib.parse import parse_qs
+from flask_api import status
+from flask_restx import marshal
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects import postgresql
+from werkzeug.exceptions import BadRequest
+from service import app as flask_app
+from service.models import Order, Item, shards
+from service.projection import FIELDS_ARG, parse_fields, nested_fields
+from service.queries import OrderQuery, SORT_DIRECTIONS
+from service.routes import order_model
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover
+    asyncpg = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # pragma: no cover
+    WsgiToAsgi = None
+
+ORDER_PATH = re.compile(r"^/orders/(\d+)/?$")
+ORDERS_PATHS = ("/orders", "/orders/")
+# query string arguments of GET /orders that the async path serves
+LIST_ARGS = {"customer_id", "sort", "sort_by", "page", "per_page", FIELDS_ARG}
+
+DIALECT = postgresql.dialect(paramstyle="numeric")
+
+
+def compile_statement(statement):
+    """
+    Compiles a SQLAlchemy statement for asyncpg
+    :return: a tuple with the SQL, using $n placeholders, and the names of the parameters in order
+    """
+    compiled = statement.compile(dialect=DIALECT)
+    return re.sub(r":(\d+)\b", r"$\1", compiled.string), tuple(compiled.positiontup)
+
+
+@lru_cache(maxsize=256)
+def orders_sql(key, fields=None, sort=None, direction="asc", paged=False):
+    """ Returns the compiled query of the orders whose column key equals the value parameter """
+    statement = select(Order.serialized_columns(fields)).where(getattr(Order, key) == bindparam("value"))
+    sort_column = OrderQuery.sort_keys[sort or OrderQuery.default_sort]
+    statement = statement.order_by(SORT_DIRECTIONS[direction](sort_column))
+    if sort is not None and sort != OrderQuery.default_sort:
+        statement = statement.order_by(Order.id)
+    if paged:
+        statement = statement.limit(bindparam("limit")).offset(bindparam("offset"))
+    return compile_statement(statement)
+
+
+@lru_cache(maxsize=64)
+def items_sql(fields=None):
+    """ Returns the compiled query of the items of the orders in the order_ids parameter """
+    statement = select([Item.order_id] + Item.serialized_columns(fields)) \
+        .where(Item.order_id == func.any(bindparam("order_ids"))) \
+        .order_by(Item.item_id)
+    return compile_statement(statement)
+
+
+def _integer(args, name, minimum=None):
+    """ Returns a query string argument as an integer, None when it is missing """
+    if name not in args:
+        return None
+    try:
+        value = int(args[name])
+    except ValueError:
+        raise BadRequest("{} must be an integer".format(name))
+    if minimum is not None and value < minimum:
+        raise BadRequest("{} must be at least {}".format(name, minimum))
+    return value
+
+
+class AsyncReadApp():
+    """ ASGI application serving the order reads with asyncpg, other requests go to fallback """
+
+    def __init__(self, config, fallback=None):
+        self.config = config
+        self.fallback = fallback
+        # the connection pools by shard number
+        self.pools = {}
+
+    async def startup(self):
+        """ Opens the connection pool of every shard """
+        if asyncpg is None:
+            raise RuntimeError("The async read path needs the asyncpg package")
+        for number in shards.numbers:
+            self.pools[number] = await asyncpg.create_pool(
+                shards.uris[number] or self.config["DATABASE_URI"],
+                min_size=self.config["ASYNC_POOL_MIN_SIZE"],
+                max_size=self.config["ASYNC_POOL_MAX_SIZE"],
+                command_timeout=self.config["REQUEST_TIMEOUT"])
+        flask_app.logger.info("Async read pools opened with %d connections",
+                              sum(pool.get_size() for pool in self.pools.values()))
+
+    async def shutdown(self):
+        """ Closes the connection pools """
+        while self.pools:
+            _, pool = self.pools.popitem()
+            await pool.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET":
+            handler = self.route(scope)
+            if handler is not None:
+                code, data = await self.respond(handler)
+                await self.send_json(send, code, data)
+                return
+        if self.fallback is None:
+            await self.send_json(send, status.HTTP_404_NOT_FOUND, {"message": "Not Found"})
+            return
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """ Opens and closes the pool with the server """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as error:  # pylint: disable=broad-except
+                    await send({"type": "lifespan.startup.failed", "message": str(error)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def route(self, scope):
+        """ Returns the coroutine function serving a request, None for the fallback """
+        args = {name: values[-1] for name, values in
+                parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        for name, value in scope.get("headers", []):
+            if name.decode("latin-1").lower() == self.config["RESTX_MASK_HEADER"].lower():
+                args.setdefault(FIELDS_ARG, value.decode("latin-1"))
+        match = ORDER_PATH.match(scope["path"])
+        if match:
+            return lambda: self.get_order(int(match.group(1)), args)
+        if scope["path"] in ORDERS_PATHS and "customer_id" in args and set(args) <= LIST_ARGS:
+            return lambda: self.list_orders(args)
+        return None
+
+    async def respond(self, handler):
+        """ Runs a handler within the request deadline, returns a (status, data) tuple """
+        try:
+            return await asyncio.wait_for(handler(), self.config["REQUEST_TIMEOUT"])
+        except BadRequest as error:
+            return status.HTTP_400_BAD_REQUEST, {"message": error.description}
+        except asyncio.TimeoutError:
+            return (status.HTTP_504_GATEWAY_TIMEOUT,
+                    {"message": "The request did not complete within its deadline"})
+
+    async def send_json(self, send, code, data):
+        """ Sends a JSON response """
+        body = json.dumps(data).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": code,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode("latin-1"))],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def get_order(self, order_id, args):
+        """ GET /orders/<order_id> """
+        mask = parse_fields(args.get(FIELDS_ARG), order_model)
+        number = shards.for_id(order_id)
+        orders = [] if number is None else await self.fetch_orders(number, "id", order_id, mask)
+        if not orders:
+            return status.HTTP_404_NOT_FOUND, {"message": "Order was not found."}
+        return status.HTTP_200_OK, marshal(orders[0], order_model, mask=mask)
+
+    async def list_orders(self, args):
+        """ GET /orders?customer_id=<customer_id> """
+        customer_id = _integer(args, "customer_id")
+        sort = args.get("sort")
+        if sort is not None and sort not in OrderQuery.sort_keys:
+            raise BadRequest("Invalid sort key '{}', use one of {}".format(
+                sort, ", ".join(OrderQuery.sort_keys)))
+        direction = args.get("sort_by") if args.get("sort_by") in SORT_DIRECTIONS else "asc"
+        page = _integer(args, "page", 1)
+        per_page = _integer(args, "per_page", 1)
+        if per_page is not None and per_page > self.config["QUERY_MAX_PAGE_SIZE"]:
+            raise BadRequest("per_page must be at most {}".format(self.config["QUERY_MAX_PAGE_SIZE"]))
+        offset = ((page or 1) - 1) * (per_page or 0)
+        if offset > self.config["QUERY_MAX_OFFSET"]:
+            raise BadRequest("Pages deeper than {} rows are not served".format(
+                self.config["QUERY_MAX_OFFSET"]))
+        mask = parse_fields(args.get(FIELDS_ARG), order_model)
+        orders = await self.fetch_orders(shards.for_customer(customer_id), "customer_id", customer_id, mask,
+                                         sort, direction, per_page, offset)
+        return status.HTTP_200_OK, marshal(orders, order_model, mask=mask)
+
+    async def fetch_orders(self, number, key, value, mask, sort=None, direction="asc", limit=None, offset=0):
+        """ Selects the orders of a shard whose column key equals value, with their items when they are wanted """
+        fields = tuple(mask) if mask is not None else None
+        item_fields = nested_fields(mask, "order_items")
+        sql, names = orders_sql(key, fields, sort, direction, limit is not None)
+        params = {"value": value, "limit": limit, "offset": offset}
+        async with self.pools[number].acquire() as connection:
+            orders = [dict(row) for row in await connection.fetch(sql, *[params[name] for name in names])]
+            items = []
+            if orders and Order.with_items(fields):
+                sql, _ = items_sql(tuple(item_fields) if item_fields is not None else None)
+                items = [dict(row) for row in await connection.fetch(sql, [order["id"] for order in orders])]
+        return Order.assemble(orders, items, fields)
+
+
+def create_app():
+    """ Returns the ASGI application, falling back to the Flask app when asgiref is installed """
+    fallback = WsgiToAsgi(flask_app) if WsgiToAsgi is not None else None
+    return AsyncReadApp(flask_app.config, fallback)
+
+
+app = create_app()
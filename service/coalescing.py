@@ -0,0 +1,99 @@
+"""
+Request coalescing
+
+With READ_COALESCING on, concurrent requests for the same order (GET
+/orders/<order_id>) or the same listing of a customer's orders (GET
+/orders?customer_id=<id>) share one query: the first request runs it and the
+identical requests that arrive while it is in flight wait for its serialized
+result, or its error, instead of running it again. An order that does not
+exist is shared like any other result, so a burst of polls of a missing id
+costs one lookup too. Only a leader that ran out of its own deadline is not
+followed: its followers have their own time left and run the read themselves.
+
+Nothing is cached: a result is only shared by the requests that arrived
+while it was being read, and a write committed by this process ends the
+sharing of the reads of its order and customer, so a read sent after a
+write always sees it.
+"""
+import copy
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from sqlalchemy import event
+from service.deadlines import DeadlineExceeded, remaining
+from service.models import CHANGED_ORDERS
+
+
+class SingleFlight():
+    """ Shares the result of a call with the identical calls made while it runs """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def run(self, key, func, *args):
+        """
+        Returns func(*args), or the result of the call with the same key in
+        flight; the first element of the key says what is read, e.g.
+        ("order", order_id, ...)
+        """
+        with self.lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            try:
+                result = future.result(timeout=remaining())
+            except FutureTimeout:
+                raise DeadlineExceeded("Request deadline exceeded waiting for an identical read")
+            except DeadlineExceeded:
+                # the leader's deadline is not ours
+                return func(*args)
+            # the results are marshalled by each request, never shared as is
+            return copy.deepcopy(result)
+        try:
+            result = func(*args)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is future:
+                    del self.flights[key]
+        future.set_result(result)
+        return result
+
+    def forget(self, *prefix):
+        """ Lets the calls made from now on with a key starting with prefix run again """
+        with self.lock:
+            for key in [key for key in self.flights if key[:len(prefix)] == prefix]:
+                del self.flights[key]
+
+    def metrics(self):
+        """ Returns the calls that ran, that shared a result and that are in flight """
+        with self.lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self.flights)}
+
+
+def forget_on_commit(single_flight, db):
+    """ Ends the sharing of the reads of the orders and customers written by each commit """
+
+    @event.listens_for(db.session, "after_commit")
+    def _forget(session):
+        # releasing a SAVEPOINT commits nothing yet, the outer commit will
+        if session.transaction.nested:
+            return
+        for order_id, (_, customer_id) in session.info.pop(CHANGED_ORDERS, {}).items():
+            single_flight.forget("order", order_id)
+            single_flight.forget("customer", customer_id)
+
+    @event.listens_for(db.session, "after_soft_rollback")
+    def _discard(session, previous_transaction):
+        # a SAVEPOINT rolled back leaves the writes of the rest of the transaction
+        if previous_transaction.parent is None:
+            session.info.pop(CHANGED_ORDERS, None)
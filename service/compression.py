@@ -0,0 +1,211 @@
+"""
+HTTP compression
+
+Responses larger than COMPRESSION_MIN_SIZE are compressed with the best
+encoding the client accepts: brotli and zstd when their packages are
+installed, gzip otherwise. Streamed (generator) responses are compressed
+chunk by chunk and each chunk is flushed as it is sent. Request bodies sent
+with Content-Encoding gzip (or br / zstd) are decompressed before the routes
+read them, so bulk uploads can be sent compressed; at most
+COMPRESSION_MAX_COMPRESSED_SIZE bytes of a compressed body are read, chunked
+or not, and the output is bounded while decompressing, a small body cannot
+inflate past COMPRESSION_MAX_REQUEST_SIZE in memory. gzip bodies may hold
+several members, as concatenated gzip files do. brotli bodies need brotli
+1.2 or later, the first release that can bound its output.
+"""
+import io
+import zlib
+from flask import request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# brotli releases before 1.2 always inflate their whole input
+BROTLI_BOUNDED = brotli is not None and hasattr(brotli.Decompressor, "can_accept_more_data")
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+}
+
+# Set by the middleware when a request body cannot be decompressed
+DECOMPRESSION_ERROR = "orders.decompression_error"
+
+
+def available_encodings():
+    """ Returns the supported content encodings in order of preference """
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def is_compressible(mimetype):
+    """ Returns True for the text formats worth compressing """
+    return mimetype in COMPRESSIBLE_TYPES or (mimetype.startswith("text/") and mimetype != "text/event-stream")
+
+
+class Compressor():
+    """ Incremental compressor with the same interface for every encoding """
+
+    def __init__(self, encoding, config):
+        self.encoding = encoding
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=config["COMPRESSION_BROTLI_QUALITY"])
+            self.compress = compressor.process
+            self.flush = compressor.flush
+            self.finish = compressor.finish
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=config["COMPRESSION_ZSTD_LEVEL"]).compressobj()
+            self.compress = compressor.compress
+            self.flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            self.finish = compressor.flush
+        else:
+            compressor = zlib.compressobj(config["COMPRESSION_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = compressor.compress
+            self.flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+
+    def compress_all(self, data):
+        """ Compresses a whole body """
+        return self.compress(data) + self.finish()
+
+    def compress_stream(self, chunks):
+        """ Compresses an iterable of chunks lazily, each one is flushed so the client gets it at once """
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if not chunk:
+                continue
+            yield self.compress(chunk) + self.flush()
+        yield self.finish()
+
+
+def _gunzip(data, limit):
+    """ Decompresses the gzip members of data, stopping past limit bytes """
+    result = b""
+    while data and len(result) <= limit:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result += decompressor.decompress(data, limit + 1 - len(result))
+        if len(result) > limit:
+            break
+        if not decompressor.eof:
+            raise zlib.error("truncated gzip member")
+        data = decompressor.unused_data
+    return result
+
+
+def decompress(data, encoding, limit):
+    """ Decompresses a request body, refusing to inflate it past limit bytes """
+    if encoding in ("gzip", "x-gzip"):
+        try:
+            result = _gunzip(data, limit)
+        except zlib.error as error:
+            raise BadRequest("Invalid gzip request body: {}".format(error))
+    elif encoding == "br" and BROTLI_BOUNDED:
+        try:
+            result = brotli.Decompressor().process(data, output_buffer_limit=limit + 1)
+        except brotli.error as error:
+            raise BadRequest("Invalid brotli request body: {}".format(error))
+    elif encoding == "zstd" and zstandard is not None:
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                result = reader.read(limit + 1)
+        except zstandard.ZstdError as error:
+            raise BadRequest("Invalid zstd request body: {}".format(error))
+    else:
+        raise UnsupportedMediaType("Unsupported Content-Encoding: {}".format(encoding))
+    if len(result) > limit:
+        raise RequestEntityTooLarge("Decompressed request body is larger than {} bytes".format(limit))
+    return result
+
+
+class RequestDecompressor():
+    """
+    WSGI middleware that replaces a compressed request body by its content,
+    bodies larger than compressed_limit are refused unread
+    """
+
+    def __init__(self, wsgi_app, limit, compressed_limit):
+        self.wsgi_app = wsgi_app
+        self.limit = limit
+        self.compressed_limit = compressed_limit
+
+    def read_body(self, environ):
+        """ Returns the compressed body, without ever reading more than compressed_limit + 1 bytes """
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        if length > self.compressed_limit:
+            raise RequestEntityTooLarge("Compressed request body is larger than {} bytes".format(
+                self.compressed_limit))
+        # a chunked body has no length, it is read up to the limit
+        body = environ["wsgi.input"].read(length or self.compressed_limit + 1)
+        if len(body) > self.compressed_limit:
+            raise RequestEntityTooLarge("Compressed request body is larger than {} bytes".format(
+                self.compressed_limit))
+        return body
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding and encoding != "identity":
+            try:
+                body = decompress(self.read_body(environ), encoding, self.limit)
+            except Exception as error:  # pylint: disable=broad-except
+                # reported by the before_request hook so the error is JSON
+                environ[DECOMPRESSION_ERROR] = error
+                body = b""
+            del environ["HTTP_CONTENT_ENCODING"]
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+        return self.wsgi_app(environ, start_response)
+
+
+def compress_response(response, config):
+    """ Compresses a response with the best encoding accepted by the client """
+    if not is_compressible(response.mimetype):
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or "Content-Encoding" in response.headers):
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+    compressor = Compressor(encoding, config)
+    if response.is_streamed:
+        response.response = compressor.compress_stream(response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESSION_MIN_SIZE"]:
+            return response
+        response.set_data(compressor.compress_all(data))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """ Installs the request decompression and response compression hooks """
+    app.wsgi_app = RequestDecompressor(app.wsgi_app, app.config["COMPRESSION_MAX_REQUEST_SIZE"],
+                                       app.config["COMPRESSION_MAX_COMPRESSED_SIZE"])
+
+    @app.before_request
+    def _decompression_error():
+        error = request.environ.get(DECOMPRESSION_ERROR)
+        if error is not None:
+            raise error
+
+    @app.after_request
+    def _compress_response(response):
+        return compress_response(response, app.config)
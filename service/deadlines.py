@@ -0,0 +1,107 @@
+"""
+Request deadlines
+
+Every request gets a deadline taken from REQUEST_TIMEOUT, optionally
+overridden per endpoint in REQUEST_TIMEOUTS and by the client with the
+X-Request-Timeout header (a positive number of seconds, capped at
+REQUEST_TIMEOUT_MAX, anything else is a 400). The remaining time is propagated to
+Postgres as a statement_timeout at the start of every transaction and the
+routes call check_deadline() between processing stages, so a slow request
+fails fast with 503/504 instead of holding a worker and a connection.
+
+Work done for a request on another thread (the group commit, the shard
+scatters) carries the request's deadline there with carried_deadline().
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import BadRequest, GatewayTimeout
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+# deadline of the request the current thread works for, outside of the request
+_carried = threading.local()
+
+
+class DeadlineExceeded(GatewayTimeout):
+    """ Raised when a request runs past its deadline """
+
+
+def start_deadline(app):
+    """ Sets the deadline of the current request """
+    g.deadline = None
+    if request.endpoint in app.config["REQUEST_TIMEOUT_EXEMPT"]:
+        return
+    timeout = app.config["REQUEST_TIMEOUTS"].get(request.endpoint, app.config["REQUEST_TIMEOUT"])
+    header = request.headers.get(app.config["REQUEST_TIMEOUT_HEADER"])
+    if header is not None:
+        try:
+            timeout = float(header)
+        except ValueError:
+            timeout = math.nan
+        # nan and inf would never expire
+        if not (math.isfinite(timeout) and timeout > 0):
+            raise BadRequest("Invalid {} header: {}".format(app.config["REQUEST_TIMEOUT_HEADER"], header))
+        timeout = min(timeout, app.config["REQUEST_TIMEOUT_MAX"])
+    if timeout:
+        g.deadline = time.monotonic() + timeout
+
+
+def current_deadline():
+    """ Returns the deadline (time.monotonic()) of the current request, None when there is none """
+    if has_request_context():
+        return g.get("deadline")
+    return getattr(_carried, "deadline", None)
+
+
+@contextmanager
+def carried_deadline(deadline):
+    """ Gives the code run in the block, outside of the request, the deadline of a request """
+    previous = getattr(_carried, "deadline", None)
+    _carried.deadline = deadline
+    try:
+        yield
+    finally:
+        _carried.deadline = previous
+
+
+def remaining():
+    """ Returns the seconds left before the deadline or None when there is none """
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline(stage):
+    """ Aborts the request with 504 if its deadline passed before the stage """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded before {}".format(stage))
+
+
+def init_deadlines(app, db):
+    """ Registers the request hooks and propagates deadlines to the database """
+
+    @app.before_request
+    def _start_deadline():
+        start_deadline(app)
+
+    @event.listens_for(db.session, "after_begin")
+    def _set_statement_timeout(session, transaction, connection):
+        left = remaining()
+        if left is None or connection.dialect.name != "postgresql":
+            return
+        if left <= 0:
+            raise DeadlineExceeded("Request deadline exceeded before querying the database")
+        connection.execute("SET LOCAL statement_timeout = {:d}".format(max(int(left * 1000), 1)))
+
+    @event.listens_for(Engine, "handle_error")
+    def _statement_timeout(context):
+        if getattr(context.original_exception, "pgcode", None) == QUERY_CANCELED:
+            raise DeadlineExceeded("Request deadline exceeded while querying the database")
@@ -0,0 +1,219 @@
+"""
+Order events
+
+GET /orders/events streams the changes of the order feed (the OrderChange
+outbox of service/models.py) as Server-Sent Events to the subscribers of an
+order or a customer, so that status pages are pushed the changes instead of
+polling GET /orders/<order_id>.
+
+Each process runs a single ChangeBroker thread, while it has subscribers,
+that reads the new changes from the outbox and fans them out to the streams
+of that process, each event encoded once. On Postgres the thread LISTENs to
+CHANGES_CHANNEL on every shard, notified by every transaction that writes
+changes, so the
+changes made by any worker reach the streams of every worker as soon as
+they commit; elsewhere (and for a lost notification) SSE_POLL_INTERVAL
+bounds the delay. A client that reconnects sends the Last-Event-ID header
+and the changes it missed are replayed from the outbox.
+
+Every open stream holds a worker thread, so a worker serves at most
+SSE_MAX_STREAMS streams at once (below GUNICORN_THREADS, 8 by default) and
+turns the others away with 503, which EventSource clients retry.
+
+Each event carries the new status of the items the change set (all the
+items of a created order), so a status page does not have to fetch the order.
+"""
+import json
+import queue
+import select
+import threading
+import time
+from service.models import OrderChange, CHANGES_CHANNEL, shard_engine, shards
+
+
+def encode_event(change):
+    """ Returns the text of the Server-Sent Event of a serialized change """
+    data = dict(change, changed_at=change["changed_at"].isoformat())
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(change["cursor"], change["operation"], json.dumps(data))
+
+
+class Subscription():
+    """ The changes of an order or a customer queued for one stream """
+
+    def __init__(self, order_id=None, customer_id=None, size=1000):
+        self.order_id = order_id
+        self.customer_id = customer_id
+        self.queue = queue.Queue(size)
+        # set when the stream fell too far behind, it ends and the client
+        # catches up from the outbox when it reconnects
+        self.overflowed = False
+
+    def wants(self, change):
+        """ Returns True when the change is for this subscription """
+        return (self.order_id is None or change["order_id"] == self.order_id) and \
+            (self.customer_id is None or change["customer_id"] == self.customer_id)
+
+    def put(self, cursor, event):
+        """ Queues an event without ever blocking the broker """
+        try:
+            self.queue.put_nowait((cursor, event))
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeBroker():
+    """ Fans the changes committed by every worker out to the streams of this process """
+
+    def __init__(self, app, db, poll_interval=1.0, batch_size=1000, max_streams=4):
+        self.app = app
+        self.db = db
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.thread = None
+        self.cursor = 0
+        self.streams = 0
+
+    def open_stream(self):
+        """ Returns True when one more stream can be served, it must then close_stream() """
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self.lock:
+            self.streams -= 1
+
+    def subscribe(self, subscription, cursor):
+        """
+        Adds a subscription whose stream has seen the changes up to cursor
+        The changes published from then on are queued, the stream replays
+        the earlier ones with replay()
+        """
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if self.thread is None or not self.thread.is_alive():
+                self.cursor = cursor
+                self.thread = threading.Thread(target=self._run, name="order-events", daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, subscription):
+        """ Removes a subscription, the thread stops with the last one """
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, changes):
+        """ Queues serialized changes for the subscriptions that want them """
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for change in changes:
+            event = None
+            for subscription in subscriptions:
+                if subscription.wants(change):
+                    event = event or encode_event(change)
+                    subscription.put(change["cursor"], event)
+
+    def replay(self, subscription, cursor):
+        """ Yields the (cursor, event) of the changes of a subscription after cursor from the outbox """
+        while True:
+            changes = OrderChange.since(cursor, self.batch_size, subscription.order_id, subscription.customer_id)
+            for change in changes:
+                cursor = change.position
+                yield cursor, encode_event(change.serialize())
+            if len(changes) < self.batch_size:
+                return
+
+    def stream(self, subscription, cursor, heartbeat, max_duration):
+        """
+        Yields the Server-Sent Events of a subscription after cursor for at
+        most max_duration seconds, with a comment every heartbeat seconds of
+        silence to keep the connection open
+        """
+        self.subscribe(subscription, cursor)
+        try:
+            for cursor, event in self.replay(subscription, cursor):
+                yield event
+            # hand the connection back to the pool for the life of the stream
+            self.db.session.remove()
+            ends = time.monotonic() + max_duration
+            while not subscription.overflowed:
+                left = ends - time.monotonic()
+                if left <= 0:
+                    return
+                try:
+                    change_cursor, event = subscription.queue.get(timeout=min(heartbeat, left))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                # already sent by the replay
+                if change_cursor <= cursor:
+                    continue
+                cursor = change_cursor
+                yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def _run(self):
+        with self.app.app_context():
+            listener = None
+            while True:
+                with self.lock:
+                    if not self.subscriptions:
+                        self.thread = None
+                        break
+                try:
+                    if listener is None:
+                        listener = self._listen()
+                    changes = OrderChange.since(self.cursor, self.batch_size)
+                    if changes:
+                        self.cursor = changes[-1].position
+                        self.publish([change.serialize() for change in changes])
+                    self.db.session.remove()
+                    if len(changes) < self.batch_size:
+                        self._wait(listener)
+                except Exception as error:  # pylint: disable=broad-except
+                    self.app.logger.error("Reading the order changes failed: %s", error)
+                    self.db.session.remove()
+                    listener = self._close(listener)
+                    time.sleep(self.poll_interval)
+            self._close(listener)
+
+    def _listen(self):
+        """
+        Returns the connections listening to CHANGES_CHANNEL, one per shard,
+        False when the database cannot notify
+        """
+        if self.db.engine.dialect.name != "postgresql":
+            return False
+        connections = []
+        try:
+            for number in shards.numbers:
+                connection = shard_engine(number).raw_connection()
+                connections.append(connection)
+                # autocommit, so that the notifications are received while idle
+                connection.connection.set_isolation_level(0)
+                connection.cursor().execute("LISTEN " + CHANGES_CHANNEL)
+        except Exception:
+            self._close(connections)
+            raise
+        return connections
+
+    def _wait(self, listener):
+        """ Waits for a notification on any shard or the poll interval """
+        if not listener:
+            time.sleep(self.poll_interval)
+            return
+        ready = select.select([connection.connection for connection in listener], [], [], self.poll_interval)[0]
+        for connection in ready:
+            connection.poll()
+            del connection.notifies[:]
+
+    def _close(self, listener):
+        """ Discards the listening connections rather than return them to the pool """
+        for connection in listener or []:
+            connection.invalidate()
+        return None
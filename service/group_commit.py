@@ -0,0 +1,135 @@
+"""
+Group commit
+
+With GROUP_COMMIT enabled, item additions and item status updates are not
+committed by the request that makes them. The request hands its write to
+the per-process GroupCommitter and waits; the committer thread collects the
+writes that arrive within GROUP_COMMIT_WINDOW seconds (up to
+GROUP_COMMIT_MAX_BATCH of them) and runs them in a single transaction, one
+SAVEPOINT each, so a write that fails is rolled back alone and every
+request still gets its own result or error. One commit (one fsync) is then
+shared by the whole batch.
+
+Each write carries the deadline of its request: it runs with the request's
+statement_timeout and is skipped when the deadline has passed before the
+committer gets to it. A write that ran in time can still be committed after
+its request gave up waiting, so a 504 from a batched write does not mean
+the write did not happen; retry it with an Idempotency-Key (idempotent
+writes are not batched) or read the order back.
+
+Group commit only helps when a process serves concurrent requests, i.e.
+with gunicorn threads (GUNICORN_THREADS) greater than 1.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from service.deadlines import DeadlineExceeded, carried_deadline, current_deadline, remaining
+
+
+class GroupCommitter():
+    """ Runs the writes submitted by concurrent requests in shared transactions """
+
+    def __init__(self, app, db, window=0.002, max_batch=64):
+        self.app = app
+        self.db = db
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.writes = 0
+
+    def start(self):
+        """ Starts the committer thread, again after a fork since threads do not survive it """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a write for the next group commit and returns a Future of its result
+        func runs on the committer thread with db.session as its session, its
+        own commit() only releases its SAVEPOINT, under the deadline of the
+        current request
+        """
+        self.start()
+        future = Future()
+        self.queue.put((future, current_deadline(), func, args, kwargs))
+        return future
+
+    def run(self, func, *args, **kwargs):
+        """ Submits a write and waits for it within the request deadline """
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return future.result(timeout=remaining())
+        except FutureTimeout:
+            # a write still queued will not run, one already running may be committed
+            future.cancel()
+            raise DeadlineExceeded("Request deadline exceeded waiting for the group commit")
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                collect_until = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    left = collect_until - time.monotonic()
+                    if left <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=left))
+                    except queue.Empty:
+                        break
+                try:
+                    self._commit(batch)
+                except Exception as error:  # pylint: disable=broad-except
+                    # keep the committer alive, no request waits forever
+                    self._fail([(future, None) for future, _, _, _, _ in batch if not future.done()], error)
+                finally:
+                    self.db.session.remove()
+
+    def _commit(self, batch):
+        """ Runs a batch of writes in one transaction, a SAVEPOINT per write """
+        session = self.db.session()
+        done = []
+        for future, deadline, func, args, kwargs in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and deadline <= time.monotonic():
+                future.set_exception(DeadlineExceeded("Request deadline exceeded before the group commit"))
+                continue
+            with carried_deadline(deadline):
+                savepoint = session.begin_nested()
+                try:
+                    result = func(*args, **kwargs)
+                    if session.transaction is savepoint:
+                        session.commit()
+                except Exception as error:  # pylint: disable=broad-except
+                    if session.transaction is not savepoint:
+                        # the write failed after releasing its savepoint, the
+                        # whole batch has to go
+                        session.rollback()
+                        self._fail(done + [(future, None)], error)
+                        return
+                    session.rollback()
+                    future.set_exception(error)
+                else:
+                    done.append((future, result))
+        try:
+            session.commit()
+        except Exception as error:  # pylint: disable=broad-except
+            session.rollback()
+            self._fail(done, error)
+            return
+        self.batches += 1
+        self.writes += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+    def _fail(self, done, error):
+        self.app.logger.error("Group commit of %d writes failed: %s", len(done), error)
+        for future, _ in done:
+            future.set_exception(error)
@@ -0,0 +1,118 @@
+"""
+Idempotency keys
+
+Writes decorated with @idempotent honour the Idempotency-Key header: the
+first request with a key runs normally and its response is stored, a retry
+with the same key and payload gets the stored response back without running
+the write again. Keys expire after IDEMPOTENCY_TTL seconds and are scoped to
+the method and path, and to the authenticated user (REMOTE_USER) when a
+front end sets one; the client address is left out, so a retry sent through
+another proxy or network still finds its key.
+
+The key, the write and the response are committed in one transaction: the
+write runs in a SAVEPOINT (its commit() only releases it) and the response
+is stored before the transaction commits, so a request that fails or dies
+midway leaves no key behind and its retry runs the write again, while a
+retry of a request that committed always finds its response. Idempotent
+writes are therefore not batched by the group commit. With several shards
+the key is kept on the shard of the write, so that both are in the same
+transaction.
+"""
+import json
+import hashlib
+from functools import wraps
+from flask import current_app, g, request
+from flask_api import status
+from flask_restx.utils import unpack
+from werkzeug.exceptions import BadRequest, Conflict, UnprocessableEntity
+from service.models import IdempotencyKey, db, shards, use_shard
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+# Swagger documentation of the header, use with @api.doc(params=...)
+IDEMPOTENCY_PARAMS = {
+    IDEMPOTENCY_HEADER: {
+        "in": "header",
+        "description": "Client generated key, a retry with the same key returns the original response",
+    }
+}
+
+
+def idempotent_request():
+    """ Returns True when the current request is an idempotent write with a key """
+    return g.get("idempotency_key") is not None
+
+
+def _write_shard(kwargs):
+    """
+    Returns the shard the write of the current request goes to: the shard of
+    the order in its path, or of the customer of the order it posts; 0 when
+    neither is known, the write then fails before writing anything
+    """
+    if "order_id" in kwargs:
+        number = shards.for_id(kwargs["order_id"])
+        return 0 if number is None else number
+    data = request.get_json(silent=True)
+    customer_id = data.get("customer_id") if isinstance(data, dict) else None
+    if not isinstance(customer_id, int):
+        return 0
+    return shards.for_customer(customer_id)
+
+
+def _rollback():
+    """ Rolls back the write of a failed request and the key it claimed """
+    session = db.session()
+    if session.transaction is not None and session.transaction.nested:
+        session.rollback()
+    session.rollback()
+
+
+def idempotent(func):
+    """ Replays the stored response when a request is retried with the same Idempotency-Key """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return func(*args, **kwargs)
+        if len(client_key) > 255:
+            raise BadRequest("{} must be at most 255 characters".format(IDEMPOTENCY_HEADER))
+
+        scope = "{} {} {}\n{}".format(request.method, request.path, request.remote_user or "", client_key)
+        key = hashlib.sha256(scope.encode()).hexdigest()
+        fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+        use_shard(_write_shard(kwargs))
+        record, reserved = IdempotencyKey.reserve(
+            key, fingerprint, current_app.config["IDEMPOTENCY_TTL"],
+            current_app.config["IDEMPOTENCY_LOCK_TIMEOUT"])
+
+        if not reserved:
+            if record is None:
+                raise Conflict("A request with this {} was in progress, retry it".format(IDEMPOTENCY_HEADER))
+            if record.fingerprint != fingerprint:
+                raise UnprocessableEntity(
+                    "{} was already used with a different payload".format(IDEMPOTENCY_HEADER))
+            if record.status_code is None:
+                raise Conflict("A request with this {} is still in progress".format(IDEMPOTENCY_HEADER))
+            current_app.logger.info("Replaying response for %s %s", request.method, request.path)
+            headers = {"Idempotent-Replayed": "true"}
+            if record.location:
+                headers["Location"] = record.location
+            return json.loads(record.response), record.status_code, headers
+
+        g.idempotency_key = record
+        savepoint = db.session.begin_nested()
+        try:
+            resp = func(*args, **kwargs)
+            if db.session().transaction is savepoint:
+                db.session.commit()
+            data, code, headers = unpack(resp, status.HTTP_200_OK)
+            record.complete(code, json.dumps(data), dict(headers or {}).get("Location"))
+        except Exception:
+            _rollback()
+            raise
+        finally:
+            g.pop("idempotency_key", None)
+        return resp
+
+    return wrapper
@@ -2,21 +2,116 @@
 Models for Order
 All of the models are stored in this module
 """
+import os
+import json
+import hashlib
 import logging
-from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import asc, desc
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import asc, bindparam, case, desc, event, false, func, inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import column_property, configure_mappers, selectinload
+from sqlalchemy.orm.base import NO_VALUE
+from sqlalchemy.schema import CreateColumn, CreateTable
+from werkzeug.exceptions import NotFound
+from service.sharding import ShardMap, ShardedSQLAlchemy, SHARD_INFO, bind_key, scatter
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = ShardedSQLAlchemy()
+
+# The shards of the orders and items, configured from SHARDS in init_db()
+shards = ShardMap()
+
+# Table options of the sharded Order and Item: autoincrement on SQLite so
+# that the ids of a shard can start at its first id
+SHARDED_TABLE_ARGS = {"info": {"sharded": True}, "sqlite_autoincrement": True}
+# Table options of the change feed and the rollups, kept on the shard of their orders
+SHARDED_INFO = {"info": {"sharded": True}}
+
+# The statuses an item goes through
+ITEM_STATUSES = ['PLACED', 'SHIPPED', 'DELIVERED', 'CANCELLED']
+
+# The Order column counting the items in each status
+STATUS_COUNT_COLUMNS = {status: status.lower() + "_count" for status in ITEM_STATUSES}
+
+# The ProductRollup columns summing the quantity and the total of the items in each status
+STATUS_QUANTITY_COLUMNS = {status: status.lower() + "_quantity" for status in ITEM_STATUSES}
+STATUS_REVENUE_COLUMNS = {status: status.lower() + "_revenue" for status in ITEM_STATUSES}
+
+# The buckets of the OrderRollup and the fields a moment is truncated to for each
+ROLLUP_GRANULARITIES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+ROLLUP_TRUNCATION = {
+    "minute": {"second": 0, "microsecond": 0},
+    "hour": {"minute": 0, "second": 0, "microsecond": 0},
+    "day": {"hour": 0, "minute": 0, "second": 0, "microsecond": 0},
+}
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
 
+def use_shard(number):
+    """
+    Binds the orders and items of db.session to a shard until the session
+    is removed, the pending writes are flushed to the previous one first
+    """
+    session = db.session()
+    if session.info.get(SHARD_INFO, 0) != number:
+        if session.new or session.dirty or session.deleted:
+            session.flush()
+        session.info[SHARD_INFO] = number
+
+
+def on_shards(func, numbers=None):
+    """
+    Returns the results of func(number) on each shard (all of them by
+    default), in order; on the current session when there is a single shard
+    """
+    if not shards.sharded:
+        return [func(0)]
+    return scatter(Order.app, db, shards.numbers if numbers is None else numbers, func)
+
+
+def shard_engine(number):
+    """ Returns the engine of a shard, the default one for shard 0 """
+    return db.get_engine(Order.app, bind=bind_key(number) if number else None)
+
+
+def sharded_tables():
+    """ Returns the tables kept on the shard of their orders """
+    return [table for table in db.metadata.sorted_tables if table.info.get("sharded")]
+
+
+def add_missing_columns(engine, tables):
+    """
+    Adds the columns of tables that the existing tables of a database lack,
+    with their server defaults
+    :return: the columns added, as "table.column"
+    """
+    added = []
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                logger.info("Adding the column %s.%s", table.name, column.name)
+                connection.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                    preparer.format_table(table), CreateColumn(column).compile(dialect=engine.dialect)))
+                added.append("{}.{}".format(table.name, column.name))
+    return added
+
+
 class Item(db.Model):
     """
     Class that represents an item inside an order... For eg if a person orders 3 oranges and 4 apples as 
@@ -24,17 +119,20 @@ class Item(db.Model):
     """
 
     app = None
+    __table_args__ = SHARDED_TABLE_ARGS
 
     # Order Item Table Schema
     item_id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, nullable = False)
+    # active history keeps the previous values of a changed item for the
+    # counts of its order and the rollups of its product
+    product_id = column_property(db.Column(db.Integer, nullable = False, index=True), active_history=True)
     price = db.Column(db.Float, nullable=False)
-    quantity = db.Column(db.Integer, nullable=False, default=1)
-    status = db.Column(db.String, nullable=False, default = "PLACED")
-    item_total = db.Column(db.Float, nullable=False, default=0)
+    quantity = column_property(db.Column(db.Integer, nullable=False, default=1), active_history=True)
+    status = column_property(db.Column(db.String, nullable=False, default = "PLACED"), active_history=True)
+    item_total = column_property(db.Column(db.Float, nullable=False, default=0), active_history=True)
 
     # The order id has to be stored in another table as the different items have the same order id
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
 
     def __repr__(self):
         return "<Item %r>" % (self.item_id)
@@ -84,7 +182,7 @@ class Item(db.Model):
                 raise DataValidationError("Invalid Amount: Check price or quantity")
 
             #checks status is defined
-            if self.status not in ['PLACED', 'SHIPPED', 'DELIVERED', 'CANCELLED']:
+            if self.status not in ITEM_STATUSES:
                 raise DataValidationError("Invalid order: not a valid status")
 
         except KeyError as error:
@@ -99,7 +197,9 @@ class Item(db.Model):
     def all(cls):
         """ Returns all of the Items in the database """
         logger.info("Processing all Orders")
-        return cls.query.all()    
+        if not shards.sharded:
+            return cls.query.all()
+        return [item for items in on_shards(lambda number: cls.query.all()) for item in items]
 
     @classmethod
     def find_by_product_id(cls, product_id: int):
@@ -107,6 +207,42 @@ class Item(db.Model):
         logger.info("Processing product_id query for %s ...", product_id)
         return cls.query.filter(cls.product_id == product_id)    
 
+    @classmethod
+    def serialize_query(cls, query, fields=None):
+        """ Serializes the Items of a query from the serialized columns only """
+        return [row._asdict() for row in query.with_entities(*cls.serialized_columns(fields))]
+
+    @classmethod
+    def serialize_by_product_ids(cls, product_ids):
+        """
+        Returns the serialized Items of many products with a single IN query
+        :return: a dictionary of lists of items keyed by product id, only
+                 products that have items are in it
+        """
+        logger.info("Processing item lookup for %d products ...", len(product_ids))
+        items = {}
+
+        def query(number):
+            return db.session.query(*cls.serialized_columns()) \
+                .filter(cls.product_id.in_(product_ids)).order_by(cls.item_id).all()
+
+        # the item ids of the shards follow each other
+        for rows in on_shards(query):
+            for row in rows:
+                items.setdefault(row.product_id, []).append(row._asdict())
+        return items
+
+    @classmethod
+    def serialized_columns(cls, fields=None):
+        """
+        Returns the columns that serialize() reads, in the same order,
+        or only those named in fields
+        """
+        columns = [cls.item_id, cls.product_id, cls.quantity, cls.price, cls.status, cls.item_total]
+        if fields is None:
+            return columns
+        return [column for column in columns if column.key in fields]
+
     def delete(self):
         """ 
         Removes an Item from the Database
@@ -119,14 +255,25 @@ class Order(db.Model):
     """ Class that represents an Order """
     logger = logging.getLogger(__name__)
     app = None
+    __table_args__ = SHARDED_TABLE_ARGS
 
     ##################################################
     # Order Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, nullable=False)
-    creation_date = db.Column(db.DateTime(), default=datetime.now)
-    order_total = db.Column(db.Float, nullable=False, default=0)
+    # indexed for the filters and sort keys of service.queries
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    # active history keeps the previous values of a changed order for its time rollups
+    creation_date = column_property(db.Column(db.DateTime(), default=datetime.now, index=True), active_history=True)
+    order_total = column_property(db.Column(db.Float, nullable=False, default=0, index=True), active_history=True)
+
+    # Item counts kept in step with the items by the before_flush listener
+    # below, so that list views do not have to load the items
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    placed_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    shipped_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    delivered_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     # List of items in the order 
     order_items = db.relationship('Item', backref='order', cascade="all, delete")
@@ -185,6 +332,47 @@ class Order(db.Model):
             "order_total": self.order_total,
         }
 
+    def serialize_summary(self):
+        """ Serializes an order with its item counts instead of its items """
+        return {
+            "id": self.id,
+            "customer_id": self.customer_id,
+            "creation_date": self.creation_date,
+            "order_total": self.order_total,
+            "item_count": self.item_count,
+            "status_counts": {status: getattr(self, column)
+                              for status, column in STATUS_COUNT_COLUMNS.items()},
+        }
+
+    @staticmethod
+    def item_counts(statuses):
+        """ Returns the values of the count columns for items with these statuses """
+        counts = Counter(statuses)
+        values = {column: counts[status] for status, column in STATUS_COUNT_COLUMNS.items()}
+        values["item_count"] = sum(counts.values())
+        return values
+
+    def count_items(self):
+        """ Sets the count columns from the items of the order """
+        for column, value in self.item_counts(
+                item.status or "PLACED" for item in self.order_items).items():
+            setattr(self, column, value)
+        return self
+
+    @classmethod
+    def recount_items(cls):
+        """ Recomputes the count columns of every order from the item table """
+        logger.info("Recounting the items of all Orders")
+        values = {"item_count": select([func.count(Item.item_id)])
+                                .where(Item.order_id == cls.id).as_scalar()}
+        for status, column in STATUS_COUNT_COLUMNS.items():
+            values[column] = select([func.count(Item.item_id)]) \
+                .where(Item.order_id == cls.id).where(Item.status == status).as_scalar()
+        for number in shards.numbers:
+            use_shard(number)
+            db.session.query(cls).update(values, synchronize_session=False)
+            db.session.commit()
+
     def deserialize(self, data: dict):
         """
         Deserializes an Order from a dictionary
@@ -217,6 +405,35 @@ class Order(db.Model):
             )
         return self
 
+    @classmethod
+    def create_many(cls, payloads):
+        """
+        Creates orders from validated payloads in a single transaction per shard
+        :param payloads: dictionaries already checked against the create model
+        :return: the list of created orders
+        """
+        orders = []
+        for data in payloads:
+            order = cls(customer_id=data["customer_id"], order_total=0)
+            for data_item in data["order_items"]:
+                item = Item(product_id=data_item["product_id"],
+                            quantity=data_item["quantity"],
+                            price=data_item["price"],
+                            status=data_item["status"],
+                            item_total=round(data_item["price"] * data_item["quantity"], 2))
+                order.order_total += item.item_total
+                order.order_items.append(item)
+            orders.append(order)
+        by_shard = {}
+        for order in orders:
+            by_shard.setdefault(shards.for_customer(order.customer_id), []).append(order)
+        # one transaction per shard
+        for number, shard_orders in sorted(by_shard.items()):
+            use_shard(number)
+            db.session.add_all(shard_orders)
+            db.session.commit()
+        return orders
+
     def calc_order_totals(self):
         """ Calculates order total """
         
@@ -235,44 +452,996 @@ class Order(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        shards.configure(app.config.get("SHARDS"), app.config.get("SHARD_VNODES", 64),
+                         app.config.get("SHARD_ID_SPAN", 10**8))
+        app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **shards.binds())
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all() 
+        # No connection is opened until the schema check or the first query
+        schema_check = app.config.get("DB_SCHEMA_CHECK", "startup")
+        if schema_check == "lazy":
+            app.before_first_request(cls.create_schema)
+        elif schema_check != "off":
+            cls.create_schema()
+
+    @classmethod
+    def create_schema(cls):
+        """ Creates any missing tables and columns unless a worker already did for this schema """
+        marker = cls.schema_marker()
+        if marker and os.path.exists(marker):
+            logger.info("Database schema check skipped: %s", marker)
+            return
+        db.create_all()
+        for number in shards.numbers[1:]:
+            cls.create_shard(number)
+        cls.migrate_schema()
+        if marker:
+            with open(marker, "w"):
+                pass
+
+    @classmethod
+    def migrate_schema(cls):
+        """
+        Adds the columns missing from the tables of an older schema, which
+        create_all() leaves as they are, and fills the item counts of the
+        orders when their columns were added
+        :return: the columns added, as "table.column"
+        """
+        added = set()
+        for number in shards.numbers:
+            tables = sharded_tables() if number else db.metadata.sorted_tables
+            added.update(add_missing_columns(shard_engine(number), tables))
+        if any("{}.{}".format(cls.__tablename__, column) in added
+               for column in ["item_count"] + list(STATUS_COUNT_COLUMNS.values())):
+            cls.recount_items()
+        return added
+
+    @classmethod
+    def create_shard(cls, number):
+        """ Creates the sharded tables of a shard, with order and item ids starting at its first id """
+        engine = shard_engine(number)
+        db.metadata.create_all(engine, tables=sharded_tables())
+        first_id = shards.first_id(number)
+        with engine.begin() as connection:
+            for table in (cls.__table__, Item.__table__):
+                column = list(table.primary_key)[0]
+                if engine.dialect.name == "postgresql":
+                    connection.execute(
+                        text("SELECT setval(pg_get_serial_sequence(:table, :column), "
+                             "GREATEST(:first_id, (SELECT COALESCE(MAX({}), 0) FROM \"{}\")))"
+                             .format(column.name, table.name)),
+                        {"table": '"{}"'.format(table.name), "column": column.name, "first_id": first_id})
+                elif engine.dialect.name == "sqlite":
+                    connection.execute(
+                        text("INSERT INTO sqlite_sequence (name, seq) SELECT :table, :first_id "
+                             "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :table)"),
+                        {"table": table.name, "first_id": first_id})
+
+    @classmethod
+    def schema_marker(cls):
+        """ Returns the marker file for the current schema and database or None """
+        cache_dir = cls.app.config.get("DB_SCHEMA_CACHE_DIR")
+        if not cache_dir:
+            return None
+        fingerprint = hashlib.sha1(cls.app.config["SQLALCHEMY_DATABASE_URI"].encode())
+        fingerprint.update(repr(sorted(shards.binds().items())).encode())
+        for table in db.metadata.sorted_tables:
+            fingerprint.update(str(CreateTable(table)).encode())
+        return os.path.join(cache_dir, "orders-schema-{}".format(fingerprint.hexdigest()))
+
+    @classmethod
+    def warm_up(cls, connections=0, hot_orders=0):
+        """
+        Prepares a worker before it takes traffic
+        Configures the mappers, opens pooled connections, runs the common
+        queries once and loads the most recent orders with their items
+        :return: a dictionary describing what was warmed up
+        """
+        logger.info("Warming up %d connections and %d orders", connections, hot_orders)
+        configure_mappers()
+        # hold the connections at the same time so the pool really opens them
+        opened = [db.engine.connect() for _ in range(connections)]
+        for connection in opened:
+            connection.close()
+        try:
+            cls.query.get(0)
+            cls.query.filter(cls.customer_id == 0).all()
+            cls.query.order_by(asc(cls.id)).limit(1).all()
+            Item.query.filter(Item.product_id == 0).all()
+            orders = []
+            if hot_orders:
+                orders = cls.query.order_by(desc(cls.id)).limit(hot_orders).all()
+                for order in orders:
+                    len(order.order_items)
+        finally:
+            db.session.remove()
+        return {"connections": len(opened), "orders": len(orders)}
 
     @classmethod
     def all(cls):
         """ Returns all of the Orders in the database """
         logger.info("Processing all Orders")
-        return cls.query.all()
+        if not shards.sharded:
+            return cls.query.all()
+        # the items are loaded before the session of the shard goes away
+        return [order for orders in on_shards(
+            lambda number: cls.query.options(selectinload(cls.order_items)).order_by(cls.id).all())
+                for order in orders]
+
+    @classmethod
+    def serialize_query(cls, query, fields=None, item_fields=None):
+        """
+        Serializes the Orders of a query like serialize() does, but selects
+        just the needed columns: one query for the orders and one for all of
+        their items, without ORM objects or identity map entries per row
+
+        fields limits the keys (and columns) of the orders, the items are
+        only queried when order_items is one of them; item_fields does the
+        same for the items
+        """
+        orders = [row._asdict() for row in query.with_entities(*cls.serialized_columns(fields))]
+        items = []
+        if orders and cls.with_items(fields):
+            # the ids of the orders read, the listing run again could match
+            # orders committed since
+            items = db.session.query(Item.order_id, *Item.serialized_columns(item_fields)) \
+                .filter(Item.order_id.in_([order["id"] for order in orders])) \
+                .order_by(Item.item_id)
+            items = [row._asdict() for row in items]
+        return cls.assemble(orders, items, fields)
+
+    @classmethod
+    def serialized_columns(cls, fields=None):
+        """
+        Returns the id and the other columns that serialize() reads, or only
+        those named in fields (the id is always selected to attach the items)
+        """
+        columns = [cls.customer_id, cls.creation_date, cls.order_total]
+        if fields is not None:
+            columns = [column for column in columns if column.key in fields]
+        return [cls.id] + columns
+
+    @staticmethod
+    def with_items(fields=None):
+        """ Returns True when fields ask for the items of the orders """
+        return fields is None or "order_items" in fields
+
+    @classmethod
+    def assemble(cls, orders, items, fields=None):
+        """
+        Completes order dictionaries selected with serialized_columns() into
+        what serialize() returns, with their item dictionaries (each with an
+        order_id key) and limited to fields; items of other orders are left out
+        """
+        if cls.with_items(fields):
+            by_id = {}
+            for order in orders:
+                order["order_items"] = []
+                by_id[order["id"]] = order
+            for item in items:
+                order = by_id.get(item.pop("order_id"))
+                if order is not None:
+                    order["order_items"].append(item)
+        if fields is not None and "id" not in fields:
+            for order in orders:
+                del order["id"]
+        return orders
+
+    @classmethod
+    def serialize_by_ids(cls, ids):
+        """
+        Returns the serialized Orders with the given ids, with their items,
+        using one IN query for the orders and one for the items
+        :return: a dictionary of orders keyed by id, missing ids are left out
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        by_shard = defaultdict(list)
+        for order_id in ids:
+            number = shards.for_id(order_id)
+            if number is not None:
+                by_shard[number].append(order_id)
+        numbers = sorted(by_shard)
+        results = on_shards(lambda number: cls.serialize_query(cls.query.filter(cls.id.in_(by_shard[number]))),
+                            numbers)
+        return {order["id"]: order for orders in results for order in orders}
+
+    @classmethod
+    def serialize_by_customer_ids(cls, customer_ids):
+        """
+        Returns the serialized Orders of many customers, with their items,
+        using one IN query for the orders and one for the items
+        :return: a dictionary of lists of orders keyed by customer id, only
+                 customers that have orders are in it
+        """
+        logger.info("Processing lookup for %d customers ...", len(customer_ids))
+        orders = {}
+        by_shard = defaultdict(list)
+        for customer_id in customer_ids:
+            by_shard[shards.for_customer(customer_id)].append(customer_id)
+        numbers = sorted(by_shard)
+        results = on_shards(lambda number: cls.serialize_query(
+            cls.query.filter(cls.customer_id.in_(by_shard[number])).order_by(cls.id)), numbers)
+        for shard_orders in results:
+            for order in shard_orders:
+                orders.setdefault(order["customer_id"], []).append(order)
+        return orders
+
+    @classmethod
+    def serialize_summary_query(cls, query):
+        """ Serializes the Orders of a query as summaries, from the order table only """
+        summaries = []
+        columns = [cls.id, cls.customer_id, cls.creation_date, cls.order_total, cls.item_count] + \
+            [getattr(cls, column) for column in STATUS_COUNT_COLUMNS.values()]
+        for row in query.with_entities(*columns):
+            summary = row._asdict()
+            summary["status_counts"] = {status: summary.pop(column)
+                                        for status, column in STATUS_COUNT_COLUMNS.items()}
+            summaries.append(summary)
+        return summaries
 
     @classmethod
     def find(cls, by_id):
         """ Finds a Order by it's ID """
         logger.info("Processing lookup for id %s ...", by_id)
+        number = shards.for_id(by_id)
+        if number is None:
+            return None
+        use_shard(number)
         return cls.query.get(by_id)
 
     @classmethod
     def find_or_404(cls, by_id):
         """ Find an Order by it's id """
         logger.info("Processing lookup or 404 for id %s ...", by_id)
+        number = shards.for_id(by_id)
+        if number is None:
+            raise NotFound()
+        use_shard(number)
         return cls.query.get_or_404(by_id)
 
+    @classmethod
+    def find_query(cls, by_id):
+        """ Returns the query of the Order with an id, on its shard """
+        number = shards.for_id(by_id)
+        if number is None:
+            return cls.query.filter(false())
+        use_shard(number)
+        return cls.query.filter(cls.id == by_id)
+
+    @classmethod
+    def serialize_by_id(cls, by_id, fields=None, item_fields=None):
+        """ Returns the serialized Order with an id like serialize_query() does, None when it does not exist """
+        logger.info("Processing serialized lookup for id %s ...", by_id)
+        orders = cls.serialize_query(cls.find_query(by_id), fields, item_fields)
+        return orders[0] if orders else None
+
     @classmethod
     def find_by_customer_id(cls, customer_id: int):
         """Returns all of the orders with customer_id: customer_id """
         cls.logger.info("Processing customer_id query for %s ...", customer_id)
+        use_shard(shards.for_customer(customer_id))
         return cls.query.filter(cls.customer_id == customer_id)
 
     @classmethod
     def sort_by(cls, sort, sort_by):
-        """Returns all of the orders sorted by customer_id"""
+        """
+        Returns the list of all of the orders sorted by a column, or the name
+        of one, in the sort_by direction ('asc' or 'desc'), merged from every
+        shard; ties are sorted by id
+        """
         cls.logger.info("Processing all orders query sorted by %s ...", sort)
+        if isinstance(sort, str):
+            sort = getattr(cls, sort)
         # Defaults sorting is ASC
-        if sort_by is None or (sort_by != 'asc' and sort_by != 'desc'):
-            return cls.query.order_by(asc(sort))
+        descending = sort_by == 'desc'
+        direction = desc if descending else asc
+        results = on_shards(lambda number: cls.query.options(selectinload(cls.order_items))
+                            .order_by(direction(sort), asc(cls.id)).all())
+        if len(results) == 1:
+            return results[0]
+        # the sorts are stable, the ties stay sorted by id
+        orders = sorted((order for orders in results for order in orders), key=lambda order: order.id)
+        return sorted(orders, key=lambda order: getattr(order, sort.key), reverse=descending)
+
+class IdempotencyKey(db.Model):
+    """
+    Class that remembers the response of a write sent with an Idempotency-Key
+    so that a retried request gets the original response instead of a duplicate
+    """
+    __tablename__ = "idempotency_key"
+    __table_args__ = SHARDED_INFO
+
+    # sha256 of the method, path, user and client key
+    key = db.Column(db.String(64), primary_key=True)
+    # sha1 of the request body, a reused key must come with the same payload
+    fingerprint = db.Column(db.String(40), nullable=False)
+    # None while the first request is still being processed
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    location = db.Column(db.String(255))
+    created = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, index=True)
+
+    # when keys were last purged, by shard
+    last_purge = {}
+
+    def __repr__(self):
+        return "<IdempotencyKey %r>" % self.key
+
+    @classmethod
+    def reserve(cls, key, fingerprint, ttl, lock_timeout):
+        """
+        Claims a key in the transaction of the current request, which then
+        commits the key with its write and its response (see complete()); a
+        concurrent request with the same key waits on the row until then
+        :return: a tuple (record, reserved), reserved is False when the key was
+                 already claimed and record holds the earlier request, or is
+                 None when that request's key is gone again
+        """
+        now = datetime.utcnow()
+        cls.purge(now, ttl)
+        record = cls.query.get(key)
+        if record is not None:
+            age = (now - record.created).total_seconds()
+            abandoned = record.status_code is None and age > lock_timeout
+            if age <= ttl and not abandoned:
+                return record, False
+            db.session.delete(record)
+            db.session.flush()
+        record = cls(key=key, fingerprint=fingerprint, created=now)
+        db.session.add(record)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # a concurrent retry claimed the key first and committed it
+            db.session.rollback()
+            return cls.query.get(key), False
+        return record, True
+
+    def complete(self, status_code, response, location=None):
+        """ Stores the response of the request that claimed the key and commits it with the write """
+        self.status_code = status_code
+        self.response = response
+        self.location = location
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, now, ttl):
+        """ Deletes the expired keys of the current shard, at most once per ttl / 10 in each process """
+        number = db.session().info.get(SHARD_INFO, 0)
+        last_purge = cls.last_purge.get(number)
+        if last_purge and (now - last_purge).total_seconds() < ttl / 10:
+            return
+        cls.last_purge[number] = now
+        expired = cls.query.filter(cls.created < now - timedelta(seconds=ttl)).delete()
+        db.session.commit()
+        logger.info("Purged %d expired idempotency keys", expired)
+
+
+class OrderChange(db.Model):
+    """
+    Class that records a change to an order in the transaction that makes it,
+    the outbox read by consumers of GET /orders/changes; kept on the shard of
+    the order
+    """
+    __tablename__ = "order_change"
+    __table_args__ = SHARDED_INFO
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    # the cursor of the feed, assigned in commit order once the change is committed (see sequence())
+    position = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), unique=True, index=True)
+    # not a foreign key, the changes of deleted orders are kept
+    order_id = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.Integer)
+    operation = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    # JSON list of the item_id and new status of the items whose status the change set
+    item_statuses = db.Column(db.Text)
+
+    def __repr__(self):
+        return "<OrderChange %r>" % self.id
+
+    def serialize(self):
+        """ Serializes a change into a dictionary """
+        return {
+            "cursor": self.position,
+            "order_id": self.order_id,
+            "customer_id": self.customer_id,
+            "operation": self.operation,
+            "changed_at": self.changed_at,
+            "items": json.loads(self.item_statuses or "[]"),
+        }
+
+    @classmethod
+    def sequence(cls):
+        """
+        Gives the committed changes that have no cursor yet the next cursors,
+        shard by shard in the order of their ids, commits them and then moves
+        the watermark past them. The passes are serialized on Postgres, a pass
+        is skipped while another one runs, and readers stop at the watermark,
+        so a reader never skips a change given its cursor after it read a
+        later one, whatever the shard
+        :return: the watermark, the cursor readers may read up to
+        """
+        if db.engine.dialect.name != "postgresql":
+            return cls._sequence()
+        # a lock of its own connection, held across the commits of the shards
+        with db.engine.connect() as lock:
+            if not lock.execute(select([func.pg_try_advisory_lock(CHANGES_LOCK)])).scalar():
+                return ChangeWatermark.read()
+            try:
+                return cls._sequence()
+            finally:
+                lock.execute(select([func.pg_advisory_unlock(CHANGES_LOCK)]))
+
+    @classmethod
+    def _sequence(cls):
+        """ Runs a pass of sequence() while holding its lock """
+        table = cls.__table__
+        watermark = ChangeWatermark.read()
+        previous = db.session().info.get(SHARD_INFO, 0)
+        pending = {}
+        # the cursors of a pass that died before moving the watermark are committed, start after them
+        start = watermark
+        for number in shards.numbers:
+            use_shard(number)
+            connection = db.session.connection(mapper=cls.__mapper__)
+            ids = [row[0] for row in connection.execute(
+                select([table.c.id]).where(table.c.position.is_(None)).order_by(table.c.id))]
+            if ids:
+                pending[number] = ids
+            start = max(start, connection.execute(select([func.max(table.c.position)])).scalar() or 0)
+        for number, ids in sorted(pending.items()):
+            use_shard(number)
+            db.session.execute(
+                table.update().where(table.c.id == bindparam("change_id")).values(position=bindparam("cursor")),
+                [{"change_id": change_id, "cursor": start + index} for index, change_id in enumerate(ids, 1)],
+                mapper=cls.__mapper__)
+            db.session.commit()
+            start += len(ids)
+        use_shard(previous)
+        if start != watermark:
+            ChangeWatermark.advance(start)
+        db.session.commit()
+        return start
+
+    @classmethod
+    def since(cls, cursor, limit, order_id=None, customer_id=None):
+        """ Returns at most limit changes after the cursor, in commit order, of an order or customer """
+        logger.info("Processing changes query since %s ...", cursor)
+        watermark = cls.sequence()
+        numbers = None
+        if order_id is not None:
+            number = shards.for_id(order_id)
+            if number is None:
+                return []
+            numbers = [number]
+
+        def query(number):
+            changes = cls.query.filter(cls.position > cursor, cls.position <= watermark)
+            if order_id is not None:
+                changes = changes.filter(cls.order_id == order_id)
+            if customer_id is not None:
+                changes = changes.filter(cls.customer_id == customer_id)
+            return changes.order_by(cls.position).limit(limit).all()
+
+        results = on_shards(query, numbers)
+        if len(results) == 1:
+            return results[0]
+        return sorted((change for changes in results for change in changes),
+                      key=lambda change: change.position)[:limit]
+
+    @classmethod
+    def latest(cls):
+        """ Returns the cursor of the last change, 0 when there is none """
+        return cls.sequence()
+
+
+class ChangeWatermark(db.Model):
+    """
+    Class that keeps, in shard 0, the last cursor of the change feed below
+    which every change of every shard is committed (see OrderChange.sequence)
+    """
+    __tablename__ = "order_change_watermark"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    position = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), nullable=False)
+
+    def __repr__(self):
+        return "<ChangeWatermark %r>" % self.position
+
+    @classmethod
+    def read(cls):
+        """ Returns the watermark, 0 before the first change """
+        return db.session.query(cls.position).filter(cls.id == 1).scalar() or 0
+
+    @classmethod
+    def advance(cls, position):
+        """ Moves the watermark to a position """
+        table = cls.__table__
+        updated = db.session.execute(table.update().where(table.c.id == 1).values(position=position),
+                                     mapper=cls.__mapper__)
+        if not updated.rowcount:
+            db.session.execute(table.insert().values(id=1, position=position), mapper=cls.__mapper__)
+
+
+def _add_to_rollups(connection, table, keys, deltas):
+    """
+    Adds deltas, {key values: {column: change}}, to the rows of a rollup
+    table, inserting the missing rows; rows are written in key order so that
+    concurrent writers do not deadlock
+    """
+    for key, delta in sorted(deltas.items()):
+        delta = {column: change for column, change in delta.items() if change}
+        if not delta:
+            continue
+        row = dict(zip(keys, key))
+        if connection.dialect.name == "postgresql":
+            statement = postgresql.insert(table).values(dict(row, **delta))
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[table.c[name] for name in keys],
+                set_={column: table.c[column] + statement.excluded[column] for column in delta}))
+            continue
+        condition = [table.c[name] == value for name, value in row.items()]
+        updated = connection.execute(table.update().where(db.and_(*condition)).values(
+            {column: table.c[column] + change for column, change in delta.items()}))
+        if not updated.rowcount:
+            connection.execute(table.insert().values(dict(row, **delta)))
+
+
+class ProductRollup(db.Model):
+    """
+    Class that keeps the quantity and revenue of the items of a product in
+    each status, updated in the transaction of every item write so that the
+    demand for a product is read from one row per shard
+    """
+    __tablename__ = "product_rollup"
+    __table_args__ = SHARDED_INFO
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    placed_quantity = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    shipped_quantity = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    delivered_quantity = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    cancelled_quantity = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    placed_revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    shipped_revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    delivered_revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    cancelled_revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return "<ProductRollup %r>" % self.product_id
+
+    def serialize(self):
+        """ Serializes a rollup into a dictionary, open items are the ones not shipped yet """
+        return {
+            "product_id": self.product_id,
+            "open_quantity": self.placed_quantity,
+            "shipped_quantity": self.shipped_quantity,
+            "quantity": {status: getattr(self, column) for status, column in STATUS_QUANTITY_COLUMNS.items()},
+            "revenue": {status: getattr(self, column) for status, column in STATUS_REVENUE_COLUMNS.items()},
+        }
+
+    @classmethod
+    def find(cls, product_id):
+        """ Returns the rollup of a product, None when it never had items """
+        logger.info("Processing rollup lookup for product %s ...", product_id)
+        if not shards.sharded:
+            return cls.query.get(product_id)
+        rows = [row for rows in on_shards(lambda number: cls.query.filter(cls.product_id == product_id).all())
+                for row in rows]
+        if not rows:
+            return None
+        columns = list(STATUS_QUANTITY_COLUMNS.values()) + list(STATUS_REVENUE_COLUMNS.values())
+        return cls(product_id=product_id, **{column: sum(getattr(row, column) for row in rows)
+                                             for column in columns})
+
+    @classmethod
+    def apply(cls, connection, deltas):
+        """ Adds deltas, {product_id: {column: change}}, to the rollups creating the missing ones """
+        _add_to_rollups(connection, cls.__table__, ["product_id"],
+                        {(product_id,): delta for product_id, delta in deltas.items()})
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recomputes the rollups of every product from the items of each shard, for backfills
+        :return: the number of rollups, a product has one per shard with its items
+        """
+        logger.info("Rebuilding the rollups of all products")
+        item = Item.__table__
+        columns = [item.c.product_id]
+        columns += [func.sum(case([(item.c.status == status, item.c.quantity)], else_=0))
+                    for status in ITEM_STATUSES]
+        columns += [func.sum(case([(item.c.status == status, item.c.item_total)], else_=0))
+                    for status in ITEM_STATUSES]
+        names = ["product_id"] + list(STATUS_QUANTITY_COLUMNS.values()) + list(STATUS_REVENUE_COLUMNS.values())
+        count = 0
+        # one transaction per shard
+        for number in shards.numbers:
+            use_shard(number)
+            if db.session.connection(mapper=cls.__mapper__).dialect.name == "postgresql":
+                # item writes wait until the rollups are rebuilt
+                db.session.execute("LOCK TABLE item IN SHARE MODE", mapper=cls.__mapper__)
+            db.session.execute(cls.__table__.delete(), mapper=cls.__mapper__)
+            db.session.execute(cls.__table__.insert().from_select(
+                names, select(columns).group_by(item.c.product_id)), mapper=cls.__mapper__)
+            count += db.session.query(func.count(cls.product_id)).scalar()
+            db.session.commit()
+        return count
+
+
+class OrderRollup(db.Model):
+    """
+    Class that keeps the orders created in each minute, hour and day with
+    their items, cancelled items and revenue, updated in the transaction of
+    every order write so that dashboards read a range of buckets, one per
+    shard
+    """
+    __tablename__ = "order_rollup"
+    __table_args__ = SHARDED_INFO
+
+    granularity = db.Column(db.String(8), primary_key=True)
+    bucket = db.Column(db.DateTime(), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return "<OrderRollup %s %s>" % (self.granularity, self.bucket)
+
+    def serialize(self):
+        """ Serializes a bucket into a dictionary """
+        return {
+            "bucket": self.bucket,
+            "order_count": self.order_count,
+            "item_count": self.item_count,
+            "cancelled_count": self.cancelled_count,
+            "revenue": self.revenue,
+        }
+
+    @staticmethod
+    def bucket_of(moment, granularity):
+        """ Returns the start of the bucket of a granularity holding a moment """
+        return moment.replace(**ROLLUP_TRUNCATION[granularity])
+
+    @classmethod
+    def deltas(cls, creation_date, sign=1, order_count=1, item_count=0, cancelled_count=0, revenue=0):
+        """ Returns the changes to the buckets of every granularity of adding (sign 1) or removing (sign -1) orders """
+        delta = {
+            "order_count": sign * order_count,
+            "item_count": sign * (item_count or 0),
+            "cancelled_count": sign * (cancelled_count or 0),
+            "revenue": sign * (revenue or 0),
+        }
+        return {(granularity, cls.bucket_of(creation_date, granularity)): delta for granularity in ROLLUP_GRANULARITIES}
+
+    @classmethod
+    def apply(cls, connection, deltas):
+        """ Adds deltas, {(granularity, bucket): {column: change}}, to the buckets creating the missing ones """
+        _add_to_rollups(connection, cls.__table__, ["granularity", "bucket"], deltas)
+
+    @classmethod
+    def find_range(cls, granularity, start, end):
+        """
+        Returns the serialized buckets of a granularity from the one holding
+        start to the one holding end, with the buckets without orders
+        """
+        start, end = cls.bucket_of(start, granularity), cls.bucket_of(end, granularity)
+        logger.info("Processing %s rollups from %s to %s ...", granularity, start, end)
+        columns = ["order_count", "item_count", "cancelled_count", "revenue"]
+        rows = defaultdict(Counter)
+        for shard_rows in on_shards(lambda number: cls.query.filter(
+                cls.granularity == granularity, cls.bucket >= start, cls.bucket <= end).all()):
+            for row in shard_rows:
+                rows[row.bucket].update({column: getattr(row, column) for column in columns})
+        step = ROLLUP_GRANULARITIES[granularity]
+        buckets = []
+        while start <= end:
+            row = cls(bucket=start, **{column: rows[start][column] if start in rows else 0 for column in columns})
+            buckets.append(row.serialize())
+            start += step
+        return buckets
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recomputes every bucket from the orders of each shard, for backfills
+        :return: the number of buckets, a bucket has one per shard with its orders
+        """
+        logger.info("Rebuilding the rollups of all Orders")
+        count = 0
+        # one transaction per shard
+        for number in shards.numbers:
+            use_shard(number)
+            if db.session.connection(mapper=cls.__mapper__).dialect.name == "postgresql":
+                # order writes wait until the rollups are rebuilt
+                db.session.execute("LOCK TABLE \"order\" IN SHARE MODE", mapper=cls.__mapper__)
+            deltas = defaultdict(Counter)
+            orders = db.session.query(Order.creation_date, Order.item_count, Order.cancelled_count,
+                                      Order.order_total).filter(Order.creation_date.isnot(None))
+            for row in orders.yield_per(1000):
+                for key, delta in cls.deltas(row.creation_date, item_count=row.item_count,
+                                             cancelled_count=row.cancelled_count, revenue=row.order_total).items():
+                    deltas[key].update(delta)
+            db.session.execute(cls.__table__.delete(), mapper=cls.__mapper__)
+            if deltas:
+                db.session.execute(cls.__table__.insert(), [
+                    {"granularity": granularity, "bucket": bucket, **delta}
+                    for (granularity, bucket), delta in sorted(deltas.items())], mapper=cls.__mapper__)
+            count += len(deltas)
+            db.session.commit()
+        return count
+
+
+######################################################################
+#  I T E M   C O U N T S
+######################################################################
+def _status_before(item):
+    """ Returns the status an Item has in the database """
+    history = inspect(item).attrs.status.history
+    if history.deleted:
+        return history.deleted[0]
+    return item.status
+
+
+def _item_count_deltas(session):
+    """
+    Returns the changes a flush makes to the count columns of the existing
+    Orders, {order_id: {column: change}}; new and deleted orders are left out
+    """
+    deltas = defaultdict(Counter)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Item):
+            continue
+        order = inspect(obj).attrs.order.loaded_value
+        if order is not NO_VALUE and order is not None:
+            if order in session.new or order in session.deleted:
+                continue
+            order_id = order.id
         else:
-            if sort_by == 'asc':
-                return cls.query.order_by(asc(sort))
-            else:
-                return cls.query.order_by(desc(sort))
\ No newline at end of file
+            order_id = obj.order_id
+        if order_id is None:
+            continue
+        if obj in session.new:
+            before, after = None, obj.status or "PLACED"
+        elif obj in session.deleted:
+            before, after = _status_before(obj), None
+        else:
+            before, after = _status_before(obj), obj.status
+            if before == after:
+                continue
+        if before is not None:
+            deltas[order_id]["item_count"] -= 1
+            deltas[order_id][STATUS_COUNT_COLUMNS[before]] -= 1
+        if after is not None:
+            deltas[order_id]["item_count"] += 1
+            deltas[order_id][STATUS_COUNT_COLUMNS[after]] += 1
+    return deltas
+
+
+@event.listens_for(db.session, "before_flush")
+def _count_items(session, flush_context, instances):
+    """
+    Keeps the count columns of the Orders in step with their items
+    New orders are counted from their items, the counts of existing orders
+    are moved by increments so concurrent writers do not overwrite each other
+    """
+    for obj in session.new:
+        if isinstance(obj, Order):
+            obj.count_items()
+    deltas = _item_count_deltas(session)
+    for order_id, delta in deltas.items():
+        values = {getattr(Order, column): getattr(Order, column) + change
+                  for column, change in delta.items() if change}
+        if not values:
+            continue
+        session.query(Order).filter(Order.id == order_id).update(values, synchronize_session=False)
+        order = session.identity_map.get(inspect(Order).identity_key_from_primary_key([order_id]))
+        if order is not None:
+            session.expire(order, list(delta))
+
+
+######################################################################
+#  O R D E R   C H A N G E S
+######################################################################
+# Key of the advisory lock that serializes the passes giving the changes their cursors on Postgres
+CHANGES_LOCK = 0x6f72646572
+# Channel notified on Postgres when changes are committed (see service/events.py)
+CHANGES_CHANNEL = "order_changes"
+# Key of the orders written by a session until it commits, in its info
+# dictionary (see service/coalescing.py)
+CHANGED_ORDERS = "changed_orders"
+
+
+def _changed_orders(session):
+    """ Returns the operation made on each order by a flush and its customer, keyed by order id """
+    changes = {}
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            changes[obj.id] = ("deleted", obj.customer_id)
+    for obj in session.new:
+        if isinstance(obj, Order):
+            changes[obj.id] = ("created", obj.customer_id)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item):
+            order = obj.order
+        elif isinstance(obj, Order) and session.is_modified(obj):
+            order = obj
+        else:
+            continue
+        if order is not None and order.id not in changes:
+            changes[order.id] = ("updated", order.customer_id)
+    return changes
+
+
+def _changed_statuses(session):
+    """ Returns the item_id and status of the items whose status a flush set, keyed by order id """
+    statuses = defaultdict(list)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Item) and obj.order_id is not None and \
+                (obj in session.new or inspect(obj).attrs.status.history.has_changes()):
+            statuses[obj.order_id].append({"item_id": obj.item_id, "status": obj.status})
+    return statuses
+
+
+@event.listens_for(db.session, "after_flush")
+def _record_changes(session, flush_context):
+    """
+    Appends an OrderChange for every order written by the flush, in the same
+    transaction; the listeners of CHANGES_CHANNEL are notified when the
+    transaction commits. The changes get their cursors from the readers once
+    committed (see OrderChange.sequence), the writers never wait on each other
+    """
+    changes = _changed_orders(session)
+    if not changes:
+        return
+    session.info.setdefault(CHANGED_ORDERS, {}).update(changes)
+    connection = session.connection(mapper=OrderChange.__mapper__)
+    if connection.dialect.name == "postgresql":
+        connection.execute(select([func.pg_notify(CHANGES_CHANNEL, "")]))
+    statuses = _changed_statuses(session)
+    now = datetime.utcnow()
+    connection.execute(OrderChange.__table__.insert(), [
+        {"order_id": order_id, "customer_id": customer_id, "operation": operation, "changed_at": now,
+         "item_statuses": json.dumps(sorted(statuses.get(order_id, []), key=lambda item: item["item_id"]))}
+        for order_id, (operation, customer_id) in sorted(changes.items())])
+
+
+######################################################################
+#  P R O D U C T   R O L L U P S
+######################################################################
+def _value_before(item, name):
+    """ Returns the value an attribute of an Item has in the database """
+    history = getattr(inspect(item).attrs, name).history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(item, name)
+
+
+def _rollup_values(product_id, status, quantity, item_total, sign):
+    """ Returns the rollup changes of adding (sign 1) or removing (sign -1) an item """
+    status = status or "PLACED"
+    return product_id, {
+        STATUS_QUANTITY_COLUMNS[status]: sign * (quantity or 0),
+        STATUS_REVENUE_COLUMNS[status]: sign * (item_total or 0),
+    }
+
+
+@event.listens_for(db.session, "before_flush")
+def _roll_up_products(session, flush_context, instances):
+    """ Moves the rollups of the products of the items written by the flush """
+    deltas = defaultdict(Counter)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Item):
+            continue
+        changes = []
+        if obj not in session.new:
+            changes.append(_rollup_values(*[_value_before(obj, name) for name in
+                                            ("product_id", "status", "quantity", "item_total")], sign=-1))
+        if obj not in session.deleted:
+            changes.append(_rollup_values(obj.product_id, obj.status, obj.quantity, obj.item_total, sign=1))
+        for product_id, values in changes:
+            if product_id is not None:
+                deltas[product_id].update(values)
+    if deltas:
+        ProductRollup.apply(session.connection(mapper=ProductRollup.__mapper__), deltas)
+
+
+######################################################################
+#  O R D E R   R O L L U P S
+######################################################################
+def _order_before(order, name):
+    """ Returns the value an attribute of an Order has in the database """
+    history = getattr(inspect(order).attrs, name).history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(order, name)
+
+
+# inserted first, so that the count columns of existing orders are still the
+# ones in the database when the listener reads them
+@event.listens_for(db.session, "before_flush", insert=True)
+def _roll_up_orders(session, flush_context, instances):
+    """ Moves the buckets of the orders written by the flush """
+    deltas = defaultdict(Counter)
+
+    def add(changes):
+        for key, delta in changes.items():
+            deltas[key].update(delta)
+
+    for obj in session.new:
+        if isinstance(obj, Order):
+            if obj.creation_date is None:
+                obj.creation_date = datetime.now()
+            counts = obj.item_counts(item.status or "PLACED" for item in obj.order_items)
+            add(OrderRollup.deltas(obj.creation_date, item_count=counts["item_count"],
+                                   cancelled_count=counts["cancelled_count"], revenue=obj.order_total))
+    for obj in session.deleted:
+        if isinstance(obj, Order) and _order_before(obj, "creation_date") is not None:
+            add(OrderRollup.deltas(_order_before(obj, "creation_date"), sign=-1, item_count=obj.item_count,
+                                   cancelled_count=obj.cancelled_count,
+                                   revenue=_order_before(obj, "order_total")))
+    for obj in session.dirty:
+        if not isinstance(obj, Order) or obj in session.deleted:
+            continue
+        before, after = _order_before(obj, "creation_date"), obj.creation_date
+        if before == after:
+            if after is not None:
+                add(OrderRollup.deltas(after, order_count=0,
+                                       revenue=(obj.order_total or 0) - (_order_before(obj, "order_total") or 0)))
+            continue
+        if before is not None:
+            add(OrderRollup.deltas(before, sign=-1, item_count=obj.item_count, cancelled_count=obj.cancelled_count,
+                                   revenue=_order_before(obj, "order_total")))
+        if after is not None:
+            add(OrderRollup.deltas(after, item_count=obj.item_count, cancelled_count=obj.cancelled_count,
+                                   revenue=obj.order_total))
+    item_deltas = _item_count_deltas(session)
+    if item_deltas:
+        creation_dates = {}
+        for order_id in list(item_deltas):
+            order = session.identity_map.get(inspect(Order).identity_key_from_primary_key([order_id]))
+            if order is not None and "creation_date" in inspect(order).dict:
+                creation_dates[order_id] = order.creation_date
+        missing = [order_id for order_id in item_deltas if order_id not in creation_dates]
+        if missing:
+            creation_dates.update(session.query(Order.id, Order.creation_date).filter(Order.id.in_(missing)))
+        for order_id, delta in item_deltas.items():
+            if creation_dates.get(order_id) is not None:
+                add(OrderRollup.deltas(creation_dates[order_id], order_count=0, item_count=delta["item_count"],
+                                       cancelled_count=delta["cancelled_count"]))
+    if deltas:
+        OrderRollup.apply(session.connection(mapper=OrderRollup.__mapper__), deltas)
+
+
+######################################################################
+#  S H A R D S
+######################################################################
+def _shard_of(session, obj):
+    """ Returns the shard an Order or Item is written to, None for an item without an order yet """
+    if isinstance(obj, Item):
+        order = inspect(obj).attrs.order.loaded_value
+        if order is NO_VALUE or order is None:
+            return None if obj.order_id is None else shards.for_id(obj.order_id)
+        obj = order
+    if obj.id is not None:
+        return shards.for_id(obj.id)
+    return shards.for_customer(obj.customer_id)
+
+
+# inserted first, before the other listeners write anything
+@event.listens_for(db.session, "before_flush", insert=True)
+def _route_to_shard(session, flush_context, instances):
+    """ Binds the session to the shard of the orders and items written by the flush """
+    if not shards.sharded:
+        return
+    numbers = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Order, Item)):
+            numbers.add(_shard_of(session, obj))
+    numbers.discard(None)
+    if len(numbers) > 1:
+        raise DataValidationError("Orders of different shards cannot be written together")
+    if numbers:
+        session.info[SHARD_INFO] = numbers.pop()
@@ -0,0 +1,93 @@
+"""
+Sparse fieldsets
+
+GET endpoints decorated with @sparse accept a fields query parameter, e.g.
+?fields=id,customer_id,order_total or ?fields=id,order_items{item_id,status}
+using the flask-restx mask syntax. The fields are validated against the
+response model and handed to flask-restx as the X-Fields mask, so only the
+requested fields are marshalled; the routes also read them with
+requested_fields() to select only the columns (and relationships) needed.
+"""
+from functools import wraps
+from flask import current_app, request
+from flask_restx import fields
+from flask_restx.mask import Mask, ParseError
+from werkzeug.exceptions import BadRequest
+
+FIELDS_ARG = "fields"
+
+# Swagger documentation of the parameter, use with @api.doc(params=...)
+FIELDS_PARAMS = {
+    FIELDS_ARG: {
+        "in": "query",
+        "description": "Comma separated fields to return, nested fields in braces "
+                       "e.g. id,order_items{item_id,status}",
+    }
+}
+
+
+def _nested_model(field):
+    """ Returns the model of a Nested field or of a List of Nested, or None """
+    if isinstance(field, fields.List):
+        field = field.container
+    if isinstance(field, fields.Nested):
+        return field.nested
+    return None
+
+
+def _check_mask(mask, model, prefix=""):
+    """ Raises BadRequest when the mask names a field the model does not have """
+    for name, nested in mask.items():
+        field = model.get(name)
+        if field is None:
+            raise BadRequest("Unknown field '{}{}' in {}".format(prefix, name, FIELDS_ARG))
+        if isinstance(nested, Mask):
+            nested_model = _nested_model(field)
+            if nested_model is None:
+                raise BadRequest("Field '{}{}' has no nested fields".format(prefix, name))
+            _check_mask(nested, nested_model, "{}{}.".format(prefix, name))
+
+
+def parse_fields(value, model):
+    """ Returns the Mask of a fields value validated against the model, None for all fields """
+    if not value:
+        return None
+    try:
+        mask = Mask(value)
+    except ParseError as error:
+        raise BadRequest("Invalid {}: {}".format(FIELDS_ARG, error))
+    _check_mask(mask, model)
+    return mask
+
+
+def requested_fields(model):
+    """
+    Returns the Mask requested with ?fields= (or the X-Fields header),
+    validated against the model, or None when every field is wanted
+    """
+    value = request.args.get(FIELDS_ARG) or request.headers.get(current_app.config["RESTX_MASK_HEADER"])
+    return parse_fields(value, model)
+
+
+def nested_fields(mask, name):
+    """ Returns the names requested inside a nested field, None for all of them """
+    if mask is None or not isinstance(mask.get(name), Mask):
+        return None
+    return list(mask[name])
+
+
+def sparse(model):
+    """
+    Applies ?fields= as the flask-restx mask of the response
+    Place it above @api.marshal_with, which reads the mask from X-Fields
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            mask = requested_fields(model)
+            if mask is not None and FIELDS_ARG in request.args:
+                header = "HTTP_" + current_app.config["RESTX_MASK_HEADER"].upper().replace("-", "_")
+                request.environ[header] = request.args[FIELDS_ARG]
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
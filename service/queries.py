@@ -0,0 +1,337 @@
+"""
+Query builders for Orders and Items
+
+A builder composes every filter, the sort and the page of a listing into a
+single SQL statement:
+
+    OrderQuery().customer(5).status("PLACED").sort("creation_date", "desc").page(1, 50)
+
+Only indexed columns can be sorted on. On tables with more than
+QUERY_SCAN_THRESHOLD rows (estimated from the database statistics) the
+builder refuses the combinations that would have the database read the whole
+table: a listing with no selective filter (customer_id, product_id, order_id)
+must be paginated, even when it is bounded by a range (a range can match
+every row), a range on one column cannot be sorted by another one, and the
+offset of a page is capped by QUERY_MAX_OFFSET.
+
+count() returns the number of rows matching the filters without counting
+them when it can: the counts are cached per filter for COUNT_CACHE_TTL
+seconds and on Postgres the planner's estimate is used, unless it is below
+COUNT_EXACT_BELOW rows, where counting is cheap, or an exact count is asked.
+
+With several shards (see service.sharding) a listing of one customer (or of
+the items of one order) is read from its shard; the others are sent to every
+shard at once: each returns the sort keys of its first offset + limit rows,
+the keys are merged and the rows of the page are then read from the shards
+that hold them. Counts and row estimates are the sums over the shards.
+"""
+import time
+from sqlalchemy import asc, desc, text
+from service.models import Order, Item, DataValidationError, ITEM_STATUSES, STATUS_COUNT_COLUMNS, db, \
+    shards, use_shard, on_shards
+from service.sharding import SHARD_INFO
+
+SORT_DIRECTIONS = {"asc": asc, "desc": desc}
+
+# Seconds a row estimate is reused
+ESTIMATE_TTL = 60
+
+_estimates = {}
+# Most counts cached, the cache is emptied when it is full
+COUNT_CACHE_SIZE = 10000
+
+# statement and parameters -> (count, time counted)
+_counts = {}
+
+
+class QueryError(DataValidationError):
+    """ Raised for filters, sorts or pages that cannot be served """
+
+
+def estimated_rows(model):
+    """
+    Returns an estimate of the number of rows of a model's table
+    Postgres keeps one in its statistics, elsewhere the largest id is used
+    """
+    table = model.__table__
+    cached = _estimates.get(table.name)
+    now = time.monotonic()
+    if cached and now - cached[1] < ESTIMATE_TTL:
+        return cached[0]
+
+    def estimate(number):
+        if db.engine.dialect.name == "postgresql":
+            rows = db.session.execute(
+                text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+                {"name": '"{}"'.format(table.name)}).scalar()
+        else:
+            primary_key = list(table.primary_key)[0]
+            # the ids of a shard start at its first id
+            rows = (db.session.query(db.func.max(primary_key)).scalar() or shards.first_id(number)) - \
+                shards.first_id(number)
+        return int(rows or 0)
+
+    rows = sum(on_shards(estimate))
+    _estimates[table.name] = (rows, now)
+    return rows
+
+
+def planned_rows(statement):
+    """ Returns the number of rows the Postgres planner expects a statement to return """
+    compiled = statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute("EXPLAIN (FORMAT JSON) " + compiled.string, compiled.params).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class QueryBuilder():
+    """ Composes the filters, sort and page of a query on a model """
+
+    model = None
+    # name -> column of the indexed columns that can be sorted on
+    sort_keys = {}
+    default_sort = None
+
+    def __init__(self, query=None):
+        self.query = query if query is not None else self.model.query
+        self.selective = []
+        self.ranges = set()
+        self.sort_key = None
+        self.direction = "asc"
+        self.limit = None
+        self.offset = 0
+        # the shard holding every row of the query, None for all of them
+        self.shard = None
+
+    def _filter(self, *criteria):
+        self.query = self.query.filter(*criteria)
+        return self
+
+    def _range(self, column, minimum, maximum):
+        """ Filters a column to [minimum, maximum], either bound can be None """
+        if minimum is not None and maximum is not None and minimum > maximum:
+            raise QueryError("Invalid range for {}: {} is after {}".format(column.key, minimum, maximum))
+        if minimum is not None:
+            self._filter(column >= minimum)
+        if maximum is not None:
+            self._filter(column <= maximum)
+        if minimum is not None or maximum is not None:
+            self.ranges.add(column.key)
+        return self
+
+    def sort(self, key, direction=None):
+        """ Sorts by one of the sort_keys, ascending unless direction is desc """
+        if key is None:
+            return self
+        if key not in self.sort_keys:
+            raise QueryError("Invalid sort key '{}', use one of {}".format(key, ", ".join(self.sort_keys)))
+        self.sort_key = key
+        self.direction = direction if direction in SORT_DIRECTIONS else "asc"
+        return self
+
+    def page(self, page, per_page):
+        """ Returns page (starting at 1) of per_page rows """
+        if per_page is None:
+            return self
+        if per_page < 1 or (page is not None and page < 1):
+            raise QueryError("page and per_page must be positive")
+        self.limit = per_page
+        self.offset = ((page or 1) - 1) * per_page
+        return self
+
+    def check_scan(self, threshold, max_offset):
+        """ Raises QueryError when the query would scan a table larger than threshold rows """
+        if self.offset > max_offset:
+            raise QueryError("Pages deeper than {} rows are not served, narrow the filters".format(max_offset))
+        if self.selective or estimated_rows(self.model) <= threshold:
+            return
+        if self.ranges and self.sort_key is not None and self.sort_key not in self.ranges:
+            raise QueryError("Sort by {} when filtering on a range of it on large tables".format(
+                " or ".join(sorted(self.ranges))))
+        if self.limit is None:
+            raise QueryError("Listing the whole table is not served, filter it or use page and per_page")
+
+    def count(self, exact=False, exact_below=0, ttl=0):
+        """
+        Returns a tuple (count, exact) with the number of rows matching the
+        filters, whatever the page; exact is False for an estimate or a count
+        cached up to ttl seconds ago
+        """
+        if not self._scatters():
+            if self.shard is not None:
+                use_shard(self.shard)
+            return self._count(self.query, exact, exact_below, ttl)
+        counts = on_shards(lambda number: self._count(self.query.with_session(db.session()), exact, exact_below, ttl))
+        return sum(rows for rows, _ in counts), all(counted for _, counted in counts)
+
+    @staticmethod
+    def _count(query, exact, exact_below, ttl):
+        """ Returns count() on the shard of the session """
+        query = query.order_by(None)
+        compiled = query.statement.compile()
+        key = (db.session().info.get(SHARD_INFO, 0), compiled.string, repr(sorted(compiled.params.items())))
+        now = time.monotonic()
+        cached = _counts.get(key)
+        if not exact and cached and now - cached[1] < ttl:
+            return cached[0], False
+        if not exact and db.engine.dialect.name == "postgresql":
+            rows = planned_rows(query.statement)
+            if rows >= exact_below:
+                return rows, False
+        rows = query.count()
+        if len(_counts) >= COUNT_CACHE_SIZE:
+            _counts.clear()
+        _counts[key] = (rows, now)
+        return rows, True
+
+    def _sorted(self, query):
+        """ Returns query sorted by the sort key """
+        column = self.sort_keys[self.sort_key or self.default_sort]
+        query = query.order_by(SORT_DIRECTIONS[self.direction](column))
+        if self.sort_key is not None and self.sort_key != self.default_sort:
+            # ties are broken by the primary key so pages are stable
+            query = query.order_by(asc(self.sort_keys[self.default_sort]))
+        return query
+
+    def build(self, threshold=None, max_offset=None):
+        """ Returns the composed query, checked against the full scan guard when a threshold is given """
+        if threshold is not None:
+            self.check_scan(threshold, max_offset)
+        query = self._sorted(self.query)
+        if self.limit is not None:
+            query = query.limit(self.limit).offset(self.offset)
+        return query
+
+    def _scatters(self):
+        """ Returns True when the rows of the query are on every shard """
+        return shards.sharded and self.shard is None
+
+    def results(self, serialize, *args, threshold=None, max_offset=None):
+        """
+        Returns serialize(query, *args) of the composed query, with the rows
+        of the page merged from every shard when they are not on one
+        """
+        query = self.build(threshold, max_offset)
+        if not self._scatters():
+            if self.shard is not None:
+                use_shard(self.shard)
+            return serialize(query, *args)
+        column = self.sort_keys[self.sort_key or self.default_sort]
+        primary_key = self.sort_keys[self.default_sort]
+        window = self._sorted(self.query)
+        if self.limit is not None:
+            window = window.limit(self.offset + self.limit)
+
+        def keys(number):
+            return [(row[0], row[1], number)
+                    for row in window.with_session(db.session()).with_entities(column, primary_key)]
+
+        rows = [row for shard_rows in on_shards(keys) for row in shard_rows]
+        # ties are broken by the primary key, the sorts are stable
+        rows.sort(key=lambda row: row[1])
+        rows.sort(key=lambda row: (row[0] is None, row[0]), reverse=self.direction == "desc")
+        end = None if self.limit is None else self.offset + self.limit
+        page = rows[self.offset:end]
+        by_shard = {}
+        for _, key, number in page:
+            by_shard.setdefault(number, []).append(key)
+
+        def read(number):
+            session = db.session()
+            if session.get_bind(self.model.__mapper__).dialect.name == "postgresql":
+                # one snapshot for the keys and the rows, so that they line up
+                session.connection(mapper=self.model.__mapper__,
+                                   execution_options={"isolation_level": "REPEATABLE READ"})
+            query = self._sorted(self.query.with_session(session)).filter(primary_key.in_(by_shard[number]))
+            keys = [row[0] for row in query.with_entities(primary_key)]
+            return dict(zip(keys, serialize(query, *args)))
+
+        numbers = sorted(by_shard)
+        serialized = dict(zip(numbers, on_shards(read, numbers)))
+        # in the merged order, without the rows deleted since the keys were read
+        return [serialized[number][key] for _, key, number in page if key in serialized[number]]
+
+
+class OrderQuery(QueryBuilder):
+    """ Composable query on Orders """
+
+    model = Order
+    sort_keys = {
+        "id": Order.id,
+        "creation_date": Order.creation_date,
+        "customer_id": Order.customer_id,
+        "order_total": Order.order_total,
+    }
+    default_sort = "id"
+
+    def ids(self, order_ids):
+        """ Orders with one of these ids """
+        if order_ids is None:
+            return self
+        self.selective.append("id")
+        return self._filter(Order.id.in_(order_ids))
+
+    def customer(self, customer_id):
+        """ Orders of a customer """
+        if customer_id is None:
+            return self
+        self.selective.append("customer_id")
+        self.shard = shards.for_customer(customer_id)
+        return self._filter(Order.customer_id == customer_id)
+
+    def product(self, product_id):
+        """ Orders with an item of a product, through the item product_id index """
+        if product_id is None:
+            return self
+        self.selective.append("product_id")
+        return self._filter(Order.id.in_(
+            db.session.query(Item.order_id).filter(Item.product_id == product_id)))
+
+    def status(self, item_status):
+        """ Orders with at least one item in a status, from the count columns """
+        if item_status is None:
+            return self
+        if item_status not in ITEM_STATUSES:
+            raise QueryError("Invalid status '{}', use one of {}".format(item_status, ", ".join(ITEM_STATUSES)))
+        return self._filter(getattr(Order, STATUS_COUNT_COLUMNS[item_status]) > 0)
+
+    def created(self, since=None, until=None):
+        """ Orders created between since and until """
+        return self._range(Order.creation_date, since, until)
+
+    def total(self, minimum=None, maximum=None):
+        """ Orders with a total between minimum and maximum """
+        return self._range(Order.order_total, minimum, maximum)
+
+
+class ItemQuery(QueryBuilder):
+    """ Composable query on Items """
+
+    model = Item
+    sort_keys = {
+        "item_id": Item.item_id,
+        "product_id": Item.product_id,
+    }
+    default_sort = "item_id"
+
+    def product(self, product_id):
+        """ Items of a product """
+        if product_id is None:
+            return self
+        self.selective.append("product_id")
+        return self._filter(Item.product_id == product_id)
+
+    def order(self, order_id):
+        """ Items of an order """
+        if order_id is None:
+            return self
+        self.selective.append("order_id")
+        self.shard = shards.for_id(order_id)
+        return self._filter(Item.order_id == order_id)
+
+    def status(self, item_status):
+        """ Items in a status """
+        if item_status is None:
+            return self
+        if item_status not in ITEM_STATUSES:
+            raise QueryError("Invalid status '{}', use one of {}".format(item_status, ", ".join(ITEM_STATUSES)))
+        return self._filter(Item.status == item_status)
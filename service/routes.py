@@ -4,23 +4,47 @@ Paths:
 ------
 GET /orders - Returns a list all of the orders and order items
 GET /orders/{id} - Returns the Order and its items with a given id number
+GET /orders/summary - Returns the orders with item counts, without loading the items
 POST /orders - creates a new order record in the database
+POST /orders/bulk - creates many orders in one transaction
+POST /orders/lookup - looks up many orders by order, customer or product ids
 PUT /orders/{id} - updates a Order record in the database
 DELETE /orders/{id} - deletes a order record and associated items in the database
+GET /orders/changes - Returns the changes made to the orders after a cursor
+GET /orders/events - Streams the changes of an order or customer as Server-Sent Events
+GET /orders/rollups - Returns the orders, items and revenue of each minute, hour or day of a range
+GET /ready - Readiness probe, 200 once the worker has warmed up
+GET /metrics - Admission control counters of this worker
+GET /products/{id}/rollup - Returns the quantity and revenue of a product's items by status
 """
 
 import os
 import sys
+import time
 import logging
-from werkzeug.exceptions import NotFound
-from flask import Flask, jsonify, request, url_for, make_response, abort, render_template
+from datetime import datetime
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, render_template, \
+    stream_with_context
 from flask_api import status  # HTTP Status Codes
 from flask_restx import Api, Resource, fields, reqparse, inputs
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Order, Item,  DataValidationError
+from service.models import Order, Item, OrderChange, OrderRollup, ProductRollup, DataValidationError, db, \
+    ITEM_STATUSES, ROLLUP_GRANULARITIES
+from service.deadlines import init_deadlines, check_deadline
+from service.compression import init_compression
+from service.assets import AssetManifest
+from service.admission import init_admission
+from service.group_commit import GroupCommitter
+from service.coalescing import SingleFlight, forget_on_commit
+from service.events import ChangeBroker, Subscription
+from service.projection import sparse, requested_fields, nested_fields, FIELDS_PARAMS
+from service.queries import OrderQuery, ItemQuery, QueryError
+from service.idempotency import idempotent, idempotent_request, IDEMPOTENCY_PARAMS
+from service.validation import ModelValidator
 
 # Import Flask application
 from . import app
@@ -33,9 +57,57 @@ from . import app
 def index():
     """ Root URL response """
     app.logger.info("Request for Root URL")
-    return app.send_static_file('index.html')
+    response = make_response(render_template('index.html'))
+    # the page names the current assets, it must be revalidated
+    response.cache_control.no_cache = True
+    return response
 
 
+######################################################################
+# FINGERPRINTED STATIC ASSETS
+######################################################################
+assets = AssetManifest(app.static_folder)
+app.jinja_env.globals["asset_url"] = assets.url
+
+@app.route("/assets/<path:name>")
+def asset(name):
+    """ Serves a fingerprinted static asset, cacheable for a year """
+    return assets.response(app, name)
+
+
+######################################################################
+# READINESS
+######################################################################
+warm_up_status = {"ready": False}
+
+@app.route("/ready")
+def ready():
+    """ Readiness probe that reports ready once this worker is warmed up """
+    if not warm_up_status["ready"]:
+        try:
+            warm_up()
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.error("Warm up failed: %s", error)
+            return (
+                jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        error="Service Unavailable", message=str(error)),
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+    return (
+        jsonify(dict(warm_up_status, startup_seconds=app.config.get("STARTUP_SECONDS"))),
+        status.HTTP_200_OK,
+    )
+
+
+######################################################################
+# METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """ Returns the admission control and read coalescing counters of this worker """
+    return jsonify(admission=admission.metrics(),
+                   coalescing=order_reads.metrics() if order_reads else None), status.HTTP_200_OK
+
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -53,11 +125,11 @@ api = Api(app,
 create_item_model = api.model('Item', {
     'product_id': fields.Integer(required=True,
                                  description='Product id of item'),
-    'quantity': fields.Integer(required=True,
+    'quantity': fields.Integer(required=True, min=1,
                                description='Quantity of item'),
-    'price': fields.Float(required=True,
+    'price': fields.Float(required=True, min=0, exclusiveMin=True,
                           description='Price of item'),
-    'status': fields.String(required=True,
+    'status': fields.String(required=True, enum=ITEM_STATUSES,
                             description='Status of item')
 })
 
@@ -80,9 +152,19 @@ create_model = api.model('Order', {
     'customer_id': fields.Integer(required=True,
                                   description='The customer id of Order'),
     'order_items': fields.List(fields.Nested(create_item_model, required=True), required=True,
-                               description='The items in Order')
+                               min_items=1, description='The items in Order')
 })
 
+def item_total_error(item):
+    """ Refuses an item whose total rounds to 0, as Item.deserialize does """
+    if round(float(item["price"]) * float(item["quantity"]), 2) <= 0:
+        return "price", "Invalid Amount: Check price or quantity"
+    return None
+
+
+# Compiled validator for the create model, used by the bulk endpoint
+order_validator = ModelValidator(create_model, checks={create_item_model.name: [item_total_error]})
+
 order_update_model = api.model('OrderUpdateModel', {
     'customer_id': fields.Integer(required=True,
                                   description='customer id of order')
@@ -98,15 +180,157 @@ order_model = api.model('Order', {
     'order_total': fields.Float(readOnly=True, description='Order total amount (sum of all item totals)')
 })
 
+status_counts_model = api.model('StatusCounts', {
+    item_status: fields.Integer(description='Number of items {}'.format(item_status))
+    for item_status in ITEM_STATUSES
+})
+
+order_summary_model = api.model('OrderSummary', {
+    'id': fields.Integer(description='The id of the order'),
+    'customer_id': fields.Integer(description='The customer id of Order'),
+    'creation_date': fields.DateTime(description='The date and time at which order was created'),
+    'order_total': fields.Float(description='Order total amount (sum of all item totals)'),
+    'item_count': fields.Integer(description='Number of items in the Order'),
+    'status_counts': fields.Nested(status_counts_model, description='Number of items in each status'),
+})
+
+lookup_model = api.model('OrderLookup', {
+    'order_ids': fields.List(fields.Integer, description='Ids of the orders to look up'),
+    'customer_ids': fields.List(fields.Integer, description='Customer ids whose orders to look up'),
+    'product_ids': fields.List(fields.Integer, description='Product ids whose items to look up'),
+})
+
+# Compiled validator for the lookup model
+lookup_validator = ModelValidator(lookup_model)
+
+lookup_result_model = api.model('OrderLookupResult', {
+    'orders': fields.Nested(api.model('OrdersById', {
+        '*': fields.Wildcard(fields.Nested(order_model))
+    }), description='The orders found, keyed by order id'),
+    'customers': fields.Nested(api.model('OrdersByCustomer', {
+        '*': fields.Wildcard(fields.List(fields.Nested(order_model)))
+    }), description='The orders of each customer found, keyed by customer id'),
+    'products': fields.Nested(api.model('ItemsByProduct', {
+        '*': fields.Wildcard(fields.List(fields.Nested(item_model)))
+    }), description='The items of each product found, keyed by product id'),
+    'missing': fields.Nested(api.model('LookupMisses', {
+        'order_ids': fields.List(fields.Integer),
+        'customer_ids': fields.List(fields.Integer),
+        'product_ids': fields.List(fields.Integer),
+    }), description='The ids that matched nothing'),
+})
+
+change_model = api.model('OrderChange', {
+    'cursor': fields.Integer(description='Position of the change in the feed'),
+    'order_id': fields.Integer(description='The id of the changed order'),
+    'customer_id': fields.Integer(description='The customer id of the changed order'),
+    'operation': fields.String(enum=['created', 'updated', 'deleted'],
+                               description='What happened to the order'),
+    'changed_at': fields.DateTime(description='When the change was made'),
+    'items': fields.List(fields.Nested(api.model('ItemStatus', {
+        'item_id': fields.Integer(description='The id of the item'),
+        'status': fields.String(description='The new status of the item'),
+    })), description='The items whose status the change set'),
+})
+
+changes_model = api.model('OrderChanges', {
+    'changes': fields.List(fields.Nested(change_model), description='The changes in commit order'),
+    'cursor': fields.Integer(description='The since value of the next request'),
+})
+
+order_rollup_model = api.model('OrderRollup', {
+    'bucket': fields.DateTime(description='Start of the minute, hour or day'),
+    'order_count': fields.Integer(description='Number of orders created in the bucket'),
+    'item_count': fields.Integer(description='Number of items of these orders'),
+    'cancelled_count': fields.Integer(description='Number of these items cancelled'),
+    'revenue': fields.Float(description='Total of these orders'),
+})
+
+status_quantities_model = api.model('StatusQuantities', {
+    item_status: fields.Integer(description='Quantity of the items {}'.format(item_status))
+    for item_status in ITEM_STATUSES
+})
+
+status_revenues_model = api.model('StatusRevenues', {
+    item_status: fields.Float(description='Total of the items {}'.format(item_status))
+    for item_status in ITEM_STATUSES
+})
+
+product_rollup_model = api.model('ProductRollup', {
+    'product_id': fields.Integer(description='The product id'),
+    'open_quantity': fields.Integer(description='Quantity ordered and not shipped yet'),
+    'shipped_quantity': fields.Integer(description='Quantity shipped and not delivered yet'),
+    'quantity': fields.Nested(status_quantities_model, description='Quantity of the items in each status'),
+    'revenue': fields.Nested(status_revenues_model, description='Total of the items in each status'),
+})
+
 # query string arguments
 order_args = reqparse.RequestParser()
-order_args.add_argument('customer_id', type=int, required=False, help='List Orders by Customer id')
-order_args.add_argument('sort', type=str, required=False, help='List Orders by sort order')
-order_args.add_argument('sort_by', type=str, required=False, help='List Orders by the field')
+order_args.add_argument('customer_id', type=int, required=False, location='args',
+                        help='List Orders by Customer id')
+order_args.add_argument('product_id', type=int, required=False, location='args',
+                        help='List Orders with an item of a product')
+order_args.add_argument('status', type=str, required=False, location='args', choices=ITEM_STATUSES,
+                        help='List Orders with an item in this status')
+order_args.add_argument('created_after', type=inputs.datetime_from_iso8601, required=False, location='args',
+                        help='List Orders created at or after this ISO 8601 date')
+order_args.add_argument('created_before', type=inputs.datetime_from_iso8601, required=False, location='args',
+                        help='List Orders created at or before this ISO 8601 date')
+order_args.add_argument('min_total', type=float, required=False, location='args',
+                        help='List Orders with at least this total')
+order_args.add_argument('max_total', type=float, required=False, location='args',
+                        help='List Orders with at most this total')
+order_args.add_argument('sort', type=str, required=False, location='args', choices=list(OrderQuery.sort_keys),
+                        help='Sort Orders by this field')
+order_args.add_argument('sort_by', type=str, required=False, location='args',
+                        help='Sort direction, asc or desc')
+order_args.add_argument('page', type=inputs.positive, required=False, location='args',
+                        help='Page number, starting at 1')
+order_args.add_argument('per_page', type=inputs.positive, required=False, location='args',
+                        help='Orders per page')
+order_args.add_argument('exact', type=inputs.boolean, required=False, default=False, location='args',
+                        help='Count the Orders exactly for X-Total-Count instead of estimating')
+order_args.add_argument('fields', type=str, required=False, location='args',
+                        help=FIELDS_PARAMS['fields']['description'])
 
 
 item_args = reqparse.RequestParser()
-item_args.add_argument('product_id', type=int, required=False, help='List Orders by product id')
+item_args.add_argument('product_id', type=int, required=False, location='args',
+                       help='List Orders by product id')
+item_args.add_argument('status', type=str, required=False, location='args', choices=ITEM_STATUSES,
+                       help='List Items in this status')
+item_args.add_argument('sort', type=str, required=False, location='args', choices=list(ItemQuery.sort_keys),
+                       help='Sort Items by this field')
+item_args.add_argument('sort_by', type=str, required=False, location='args',
+                       help='Sort direction, asc or desc')
+item_args.add_argument('page', type=inputs.positive, required=False, location='args',
+                       help='Page number, starting at 1')
+item_args.add_argument('per_page', type=inputs.positive, required=False, location='args',
+                       help='Items per page')
+item_args.add_argument('exact', type=inputs.boolean, required=False, default=False, location='args',
+                       help='Count the Items exactly for X-Total-Count instead of estimating')
+item_args.add_argument('fields', type=str, required=False, location='args',
+                       help=FIELDS_PARAMS['fields']['description'])
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=inputs.natural, required=False, default=0, location='args',
+                         help='Cursor returned by the previous request, 0 to start')
+change_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                         help='Most changes to return')
+
+rollup_args = reqparse.RequestParser()
+rollup_args.add_argument('granularity', type=str, required=False, default='hour', location='args',
+                         choices=list(ROLLUP_GRANULARITIES), help='Size of the buckets')
+rollup_args.add_argument('start', type=inputs.datetime_from_iso8601, required=False, location='args',
+                         help='Moment in the first bucket, ISO 8601')
+rollup_args.add_argument('end', type=inputs.datetime_from_iso8601, required=False, location='args',
+                         help='Moment in the last bucket, ISO 8601, now by default')
+
+event_args = reqparse.RequestParser()
+event_args.add_argument('order_id', type=int, required=False, location='args',
+                        help='Stream the changes of this Order')
+event_args.add_argument('customer_id', type=int, required=False, location='args',
+                        help='Stream the changes of the Orders of this Customer')
 
 ######################################################################
 # Error Handlers
@@ -143,6 +367,78 @@ def not_found(error):
     )
 
 
+@app.errorhandler(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+def request_entity_too_large(error):
+    """ Handles request bodies that are too large with 413_REQUEST_ENTITY_TOO_LARGE """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            error="Request Entity Too Large",
+            message=str(error),
+        ),
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    )
+
+
+@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+def unsupported_media_type(error):
+    """ Handles unsupported media types and encodings with 415_UNSUPPORTED_MEDIA_TYPE """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            error="Unsupported Media Type",
+            message=str(error),
+        ),
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles requests that cannot be served with 503_SERVICE_UNAVAILABLE """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=str(error),
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        retry_after_headers(error),
+    )
+
+
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """ Handles clients over their rate limit with 429_TOO_MANY_REQUESTS """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=str(error),
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        retry_after_headers(error),
+    )
+
+
+@app.errorhandler(status.HTTP_504_GATEWAY_TIMEOUT)
+def gateway_timeout(error):
+    """ Handles requests past their deadline with 504_GATEWAY_TIMEOUT """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_504_GATEWAY_TIMEOUT,
+            error="Gateway Timeout",
+            message=str(error),
+        ),
+        status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -158,6 +454,25 @@ def internal_server_error(error):
     )
 
 
+init_deadlines(app, db)
+init_compression(app)
+admission = init_admission(app)
+
+# per process fan out of the order changes to the event streams, see service/events.py
+order_events = ChangeBroker(app, db, app.config["SSE_POLL_INTERVAL"], max_streams=app.config["SSE_MAX_STREAMS"])
+
+# per process committer of the item writes, see service/group_commit.py
+group_committer = None
+if app.config["GROUP_COMMIT"]:
+    group_committer = GroupCommitter(app, db, app.config["GROUP_COMMIT_WINDOW"],
+                                     app.config["GROUP_COMMIT_MAX_BATCH"])
+
+# per process sharing of the identical reads in flight, see service/coalescing.py
+order_reads = None
+if app.config["READ_COALESCING"]:
+    order_reads = SingleFlight()
+    forget_on_commit(order_reads, db)
+
 ######################################################################
 # CREATE AN ORDER
 ######################################################################
@@ -165,10 +480,13 @@ def internal_server_error(error):
 @api.route('/orders', strict_slashes=False)
 class OrderCollection(Resource):
 
-    @api.doc('create_order')
+    @api.doc('create_order', params=IDEMPOTENCY_PARAMS)
     @api.expect(create_model)
     @api.response(400, 'Posted data was not valid')
     @api.response(201, 'Order created successfully')
+    @api.response(409, 'A request with the same Idempotency-Key is in progress')
+    @api.response(422, 'The Idempotency-Key was used with a different payload')
+    @idempotent
     @api.marshal_with(order_model, code=201)
     def  post(self):
         """
@@ -194,6 +512,7 @@ class OrderCollection(Resource):
 
     @api.doc('list_orders')
     @api.expect(order_args, validate=True)
+    @sparse(order_model)
     @api.marshal_with(order_model, code=200)
     def get(self):
         """
@@ -201,25 +520,236 @@ class OrderCollection(Resource):
         """
         app.logger.info("Request for order list")
         
-        params = request.args
-        sort_value = params.get('sort')
-        sortby_value = params.get('sort_by')
-        customer_id = params.get("customer_id")
-
-        if sort_value is not None:
-            orders = Order.sort_by(sort_value,sortby_value)
-        else:
-            orders = Order.all()
-        
-        if customer_id:
-            orders = Order.find_by_customer_id(customer_id)
+        args = order_args.parse_args()
+        mask = requested_fields(order_model)
 
         try:
-            results = [order.serialize() for order in orders]
+            if args["customer_id"] is None:
+                results, headers = list_orders(args, mask)
+            else:
+                key = ("customer", args["customer_id"], tuple(sorted(args.items())), mask and str(mask))
+                results, headers = coalesced(key, list_orders, args, mask)
         except DataValidationError as dataValidationError:
             api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
+        check_deadline("marshalling the orders")
 
         app.logger.info("Returning %d orders", len(results))
+        return results, status.HTTP_200_OK, headers
+
+######################################################################
+# LIST ORDER SUMMARIES
+######################################################################
+@api.route('/orders/summary', strict_slashes=False)
+class OrderSummaryCollection(Resource):
+
+    @api.doc('list_order_summaries')
+    @api.expect(order_args, validate=True)
+    @sparse(order_summary_model)
+    @api.marshal_with(order_summary_model, code=200)
+    def get(self):
+        """
+        Returns the orders with their item counts instead of their items
+        Served from the order table alone
+        """
+        app.logger.info("Request for order summaries")
+        args = order_args.parse_args()
+
+        try:
+            orders = build_order_query(args)
+            results = list_results(orders, Order.serialize_summary_query)
+        except DataValidationError as dataValidationError:
+            api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
+        headers = total_count_headers(orders, args)
+        check_deadline("marshalling the order summaries")
+
+        app.logger.info("Returning %d order summaries", len(results))
+        return results, status.HTTP_200_OK, headers
+
+######################################################################
+# FEED OF ORDER CHANGES
+######################################################################
+@api.route('/orders/changes', strict_slashes=False)
+class OrderChangeCollection(Resource):
+
+    @api.doc('list_order_changes')
+    @api.expect(change_args, validate=True)
+    @api.marshal_with(changes_model, code=200)
+    def get(self):
+        """
+        Returns the changes made to the orders after a cursor
+
+        Changes are in commit order, pass the returned cursor as since to get
+        the next ones; an empty list means the consumer is up to date
+        """
+        args = change_args.parse_args()
+        app.logger.info("Request for order changes since %s", args["since"])
+        limit = args["limit"] or app.config["CHANGES_PAGE_SIZE"]
+        if limit > app.config["QUERY_MAX_PAGE_SIZE"]:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "limit must be at most {}".format(app.config["QUERY_MAX_PAGE_SIZE"]))
+        changes = OrderChange.since(args["since"], limit)
+        cursor = changes[-1].position if changes else args["since"]
+        app.logger.info("Returning %d order changes", len(changes))
+        return {"changes": [change.serialize() for change in changes], "cursor": cursor}, status.HTTP_200_OK
+
+######################################################################
+# ORDERS BY MINUTE, HOUR OR DAY
+######################################################################
+@api.route('/orders/rollups', strict_slashes=False)
+class OrderRollupCollection(Resource):
+
+    @api.doc('list_order_rollups')
+    @api.expect(rollup_args, validate=True)
+    @api.marshal_list_with(order_rollup_model)
+    def get(self):
+        """
+        Returns the orders created in each bucket of a time range
+
+        Buckets hold the orders whose creation_date falls in them, with their
+        items, cancelled items and total; buckets without orders are zeros
+        """
+        args = rollup_args.parse_args()
+        granularity = args["granularity"]
+        step = ROLLUP_GRANULARITIES[granularity]
+        end = local_time(args["end"]) if args["end"] else datetime.now()
+        start = local_time(args["start"]) if args["start"] else end - step * (app.config["ORDER_ROLLUP_BUCKETS"] - 1)
+        app.logger.info("Request for %s order rollups from %s to %s", granularity, start, end)
+        if start > end:
+            api.abort(status.HTTP_400_BAD_REQUEST, "start must be before end")
+        if (end - start) / step >= app.config["ORDER_ROLLUP_MAX_BUCKETS"]:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "at most {} buckets can be requested".format(app.config["ORDER_ROLLUP_MAX_BUCKETS"]))
+        results = OrderRollup.find_range(granularity, start, end)
+        app.logger.info("Returning %d order rollups", len(results))
+        return results, status.HTTP_200_OK
+
+######################################################################
+# STREAM OF ORDER CHANGES
+######################################################################
+@api.route('/orders/events', strict_slashes=False)
+class OrderEventStream(Resource):
+
+    @api.doc('stream_order_events', produces=['text/event-stream'],
+             params={'Last-Event-ID': {'in': 'header', 'description': 'Id of the last event received'}})
+    @api.expect(event_args, validate=True)
+    @api.response(400, 'Neither an order_id nor a customer_id was given')
+    @api.response(503, 'The worker serves as many streams as it can')
+    def get(self):
+        """
+        Streams the changes of an order or of a customer's orders as Server-Sent Events
+
+        Each event has the change as data, its operation as event type and
+        its cursor as id; reconnecting with Last-Event-ID resumes the stream
+        """
+        args = event_args.parse_args()
+        if args["order_id"] is None and args["customer_id"] is None:
+            api.abort(status.HTTP_400_BAD_REQUEST, "Give an order_id or a customer_id to stream")
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id is None:
+            cursor = OrderChange.latest()
+        elif last_event_id.isdigit():
+            cursor = int(last_event_id)
+        else:
+            api.abort(status.HTTP_400_BAD_REQUEST, "Invalid Last-Event-ID: {}".format(last_event_id))
+        app.logger.info("Streaming order events of order %s customer %s since %s",
+                        args["order_id"], args["customer_id"], cursor)
+        if not order_events.open_stream():
+            raise ServiceUnavailable("Too many event streams open, retry later",
+                                     retry_after=app.config["CONCURRENCY_RETRY_AFTER"])
+        subscription = Subscription(args["order_id"], args["customer_id"], app.config["SSE_QUEUE_SIZE"])
+        events = order_events.stream(subscription, cursor, app.config["SSE_HEARTBEAT"],
+                                     app.config["SSE_MAX_DURATION"])
+        response = Response(stream_with_context(events), mimetype="text/event-stream")
+        # called by the server when the stream ends, started or not
+        response.call_on_close(order_events.close_stream)
+        response.headers["Cache-Control"] = "no-cache"
+        # ask proxies not to buffer the stream
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+######################################################################
+# CREATE ORDERS IN BULK
+######################################################################
+@api.route('/orders/bulk', strict_slashes=False)
+class OrderBulkCollection(Resource):
+
+    @api.doc('create_orders_bulk')
+    @api.expect([create_model])
+    @api.response(400, 'Posted data was not valid, all errors are listed with JSON pointers')
+    @api.response(201, 'Orders created successfully')
+    @api.marshal_list_with(order_model, code=201)
+    def post(self):
+        """
+        Creates many orders in one transaction
+
+        Every order is validated before anything is written
+        """
+        app.logger.info("Request to create orders in bulk")
+        check_content_type("application/json")
+        payloads = request.get_json()
+        if isinstance(payloads, list) and len(payloads) > app.config["BULK_MAX_ORDERS"]:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "At most {} orders can be created at once".format(app.config["BULK_MAX_ORDERS"]))
+        errors = order_validator.errors_many(payloads)
+        if errors:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "Invalid orders: {} validation error(s)".format(len(errors)), errors=errors)
+        check_deadline("creating the orders")
+        orders = Order.create_many(payloads)
+        app.logger.info("Created %d orders", len(orders))
+        return [order.serialize() for order in orders], status.HTTP_201_CREATED
+
+######################################################################
+# LOOK UP MANY ORDERS
+######################################################################
+@api.route('/orders/lookup', strict_slashes=False)
+class OrderLookup(Resource):
+
+    @api.doc('lookup_orders')
+    @api.expect(lookup_model)
+    @api.response(400, 'Posted data was not valid')
+    @api.marshal_with(lookup_result_model)
+    def post(self):
+        """
+        Looks up many orders at once
+
+        Orders are looked up by id, by customer id or items by product id,
+        each kind with a single query. Results are keyed by id and the ids
+        that matched nothing are listed in missing
+        """
+        app.logger.info("Request to look up orders")
+        check_content_type("application/json")
+        data = request.get_json()
+        errors = lookup_validator.errors(data)
+        if errors:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "Invalid lookup: {} validation error(s)".format(len(errors)), errors=errors)
+        ids = {key: sorted(set(data.get(key) or [])) for key in ("order_ids", "customer_ids", "product_ids")}
+        if not any(ids.values()):
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "Nothing to look up: send order_ids, customer_ids or product_ids")
+        for key, values in ids.items():
+            if len(values) > app.config["LOOKUP_MAX_IDS"]:
+                api.abort(status.HTTP_400_BAD_REQUEST,
+                          "At most {} {} can be looked up at once".format(app.config["LOOKUP_MAX_IDS"], key))
+
+        results = {
+            "orders": Order.serialize_by_ids(ids["order_ids"]) if ids["order_ids"] else {},
+            "customers": Order.serialize_by_customer_ids(ids["customer_ids"]) if ids["customer_ids"] else {},
+            "products": Item.serialize_by_product_ids(ids["product_ids"]) if ids["product_ids"] else {},
+        }
+        results["missing"] = {
+            key: [value for value in ids[key] if value not in results[found]]
+            for key, found in (("order_ids", "orders"), ("customer_ids", "customers"),
+                               ("product_ids", "products"))
+        }
+        # JSON object keys are strings
+        for found in ("orders", "customers", "products"):
+            results[found] = {str(key): value for key, value in results[found].items()}
+        check_deadline("marshalling the lookup")
+
+        app.logger.info("Found %d orders, %d customers and %d products",
+                        len(results["orders"]), len(results["customers"]), len(results["products"]))
         return results, status.HTTP_200_OK
 
 ######################################################################
@@ -252,8 +782,9 @@ class OrderResource(Resource):
         app.logger.info("Order with ID [%s] updated.", order_id)
         return order.serialize(), status.HTTP_200_OK
 
-    @api.doc('get_orders')
+    @api.doc('get_orders', params=FIELDS_PARAMS)
     @api.response(404, 'Order was not found')
+    @sparse(order_model)
     @api.marshal_with(order_model)
     def get(self,order_id):
         """
@@ -261,10 +792,13 @@ class OrderResource(Resource):
         This endpoint will return a order based on its id
         """
         app.logger.info("Request for order with id: %s", order_id)
-        order = Order.find(order_id)
+        mask = requested_fields(order_model)
+        # a missing order is shared too
+        order = coalesced(("order", order_id, mask and str(mask)), Order.serialize_by_id, order_id,
+                          mask and list(mask), nested_fields(mask, "order_items"))
         if not order:
             api.abort(status.HTTP_404_NOT_FOUND, "Order was not found.")
-        return order.serialize(), status.HTTP_200_OK
+        return order, status.HTTP_200_OK
         
 
     ######################################################################
@@ -333,6 +867,7 @@ class ItemCollection(Resource):
 
     @api.doc('list_items')
     @api.expect(item_args, validate=True)
+    @sparse(item_model)
     @api.marshal_with(item_model, code=200)
     def get(self):
         """
@@ -340,20 +875,19 @@ class ItemCollection(Resource):
         """
         app.logger.info("Request for item list")
         
-        params = request.args
-        product_id = params.get("product_id")
+        args = item_args.parse_args()
+        mask = requested_fields(item_model)
        
-        if product_id:
-            items = Item.find_by_product_id(product_id)
-        else:
-            items = Item.all()
         try:
-            results = [item.serialize() for item in items]
+            items = build_item_query(args)
+            results = list_results(items, Item.serialize_query, mask and list(mask))
         except DataValidationError as dataValidationError:
             api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
+        headers = total_count_headers(items, args)
+        check_deadline("marshalling the items")
 
         app.logger.info("Returning %d items", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
 
 ######################################################################
@@ -363,10 +897,13 @@ class ItemCollection(Resource):
 @api.param('order_id', 'The Order identifier')
 class ItemCollection(Resource):   
 
-    @api.doc('add_orders_items')
+    @api.doc('add_orders_items', params=IDEMPOTENCY_PARAMS)
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted Item data was not valid')
+    @api.response(409, 'A request with the same Idempotency-Key is in progress')
+    @api.response(422, 'The Idempotency-Key was used with a different payload')
     @api.expect(item_model)
+    @idempotent
     @api.marshal_with(order_model)
     def put(self, order_id):
         """
@@ -375,19 +912,7 @@ class ItemCollection(Resource):
         app.logger.info("Request to create an item inside the order")
         check_content_type("application/json")
 
-        order = Order.find(order_id)
-        if not order:
-            api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' not found.".format(order_id))
-
-        item = Item();
-        try:
-            item.deserialize(request.get_json())
-        except DataValidationError as dataValidationError:
-            api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
-
-        order.order_items.append(item)
-        order.update();
-        return order.serialize(), status.HTTP_200_OK
+        return run_write(add_item, order_id, request.get_json(silent=True)), status.HTTP_200_OK
 
 
 @api.route('/orders/<int:order_id>/items/<int:item_id>', strict_slashes=False)
@@ -438,19 +963,7 @@ class ItemResource(Resource):
         """  
         app.logger.info("Request to update order with id :%s and item with id : %s", order_id, item_id)
         check_content_type("application/json")
-        order = Order.find(order_id)
-        if not order:
-            api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' not found.".format(order_id))
-        item_found = False
-
-        updated_order_item = Item()
-        updated_order_item.deserialize(request.get_json())
-        item_found = find_item(updated_order_item, order, item_id)
-
-        if not item_found:
-            api.abort(status.HTTP_404_NOT_FOUND, "Item with id '{}'  not found in order.".format(item_id))   
-        order.update()
-        return order.serialize(), status.HTTP_200_OK     
+        return run_write(update_item, order_id, item_id, request.get_json(silent=True)), status.HTTP_200_OK
 
 
     ######################################################################
@@ -496,29 +1009,31 @@ class CancelItemResource(Resource):
         This endpoint will cancel an item in the Order based the item id specified in the path
         """
         app.logger.info("Request to cancel order with id :%s and item with id : %s", order_id, item_id)
-        order = Order.find(order_id)
-        if not order:
-            api.abort(status.HTTP_404_NOT_FOUND, "Order id '{}' was not found.".format(order_id)) 
-        
-        item_found = False
-        item_cancellable = True
-        try:
-            for item in order.order_items:
-                if item.item_id == item_id:
-                    item_found = True
-                    if item.status in ["DELIVERED", "SHIPPED"]:
-                        item_cancellable = False
-                    elif item.status == "PLACED":
-                        item.status = "CANCELLED"
-            if not item_found:
-                api.abort(status.HTTP_404_NOT_FOUND, "Item with id '{}'  not found in item.".format(item_id))   
-            if not item_cancellable: 
-                raise DataValidationError("Item not cancellable")
-        except DataValidationError as dataValidationError:
-                api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError) 
-        order.update()        
-        return order.serialize(), status.HTTP_200_OK
+        return run_write(cancel_item, order_id, item_id), status.HTTP_200_OK
     
+######################################################################
+# ROLLUP OF A PRODUCT
+######################################################################
+@api.route('/products/<int:product_id>/rollup')
+@api.param('product_id', 'The Product identifier')
+class ProductRollupResource(Resource):
+
+    @api.doc('get_product_rollups')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(product_rollup_model)
+    def get(self, product_id):
+        """
+        Returns the quantity and revenue of the items of a product by status
+
+        Read from one row kept up to date by every item write
+        """
+        app.logger.info("Request for the rollup of product %s", product_id)
+        rollup = ProductRollup.find(product_id)
+        if not rollup:
+            raise NotFound("Product with id '{}' has no items.".format(product_id))
+        return rollup.serialize(), status.HTTP_200_OK
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -536,11 +1051,180 @@ def find_item(item, order, item_id):
     return item_found    
 
 
+def run_write(func, *args):
+    """
+    Runs an item write, through the group committer when GROUP_COMMIT is on
+    and the write does not commit its Idempotency-Key with it
+    """
+    if group_committer is None or idempotent_request():
+        return func(*args)
+    return group_committer.run(func, *args)
+
+
+def coalesced(key, func, *args):
+    """ Runs a read, shared with the identical reads in flight when READ_COALESCING is on """
+    if order_reads is None:
+        return func(*args)
+    return order_reads.run(key, func, *args)
+
+
+def list_orders(args, mask):
+    """ Returns the serialized orders of a listing and its X-Total-Count headers """
+    orders = build_order_query(args)
+    results = list_results(orders, Order.serialize_query, mask and list(mask),
+                           nested_fields(mask, "order_items"))
+    return results, total_count_headers(orders, args)
+
+
+def add_item(order_id, data):
+    """ Adds an item to an order, returns the serialized order """
+    order = Order.find(order_id)
+    if not order:
+        api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' not found.".format(order_id))
+
+    item = Item()
+    try:
+        item.deserialize(data)
+    except DataValidationError as dataValidationError:
+        api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
+
+    order.order_items.append(item)
+    order.update()
+    return order.serialize()
+
+
+def update_item(order_id, item_id, data):
+    """ Updates an item of an order, returns the serialized order """
+    order = Order.find(order_id)
+    if not order:
+        api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' not found.".format(order_id))
+    updated_order_item = Item()
+    updated_order_item.deserialize(data)
+    item_found = find_item(updated_order_item, order, item_id)
+    if not item_found:
+        api.abort(status.HTTP_404_NOT_FOUND, "Item with id '{}'  not found in order.".format(item_id))
+    order.update()
+    return order.serialize()
+
+
+def cancel_item(order_id, item_id):
+    """ Cancels an item of an order, returns the serialized order """
+    order = Order.find(order_id)
+    if not order:
+        api.abort(status.HTTP_404_NOT_FOUND, "Order id '{}' was not found.".format(order_id))
+
+    item_found = False
+    item_cancellable = True
+    try:
+        for item in order.order_items:
+            if item.item_id == item_id:
+                item_found = True
+                if item.status in ["DELIVERED", "SHIPPED"]:
+                    item_cancellable = False
+                elif item.status == "PLACED":
+                    item.status = "CANCELLED"
+        if not item_found:
+            api.abort(status.HTTP_404_NOT_FOUND, "Item with id '{}'  not found in item.".format(item_id))
+        if not item_cancellable:
+            raise DataValidationError("Item not cancellable")
+    except DataValidationError as dataValidationError:
+        api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
+    order.update()
+    return order.serialize()
+
+
+def retry_after_headers(error):
+    """ Returns the Retry-After header of an error that has one """
+    retry_after = getattr(error, "retry_after", None)
+    return {"Retry-After": retry_after} if retry_after is not None else {}
+
+
+def check_page_size(args):
+    """ Raises QueryError when a listing asks for too many rows per page """
+    if args["per_page"] is not None and args["per_page"] > app.config["QUERY_MAX_PAGE_SIZE"]:
+        raise QueryError("per_page must be at most {}".format(app.config["QUERY_MAX_PAGE_SIZE"]))
+
+
+def build_order_query(args):
+    """ Composes the query builder of an order listing from its query string arguments """
+    check_page_size(args)
+    return OrderQuery() \
+        .customer(args["customer_id"]) \
+        .product(args["product_id"]) \
+        .status(args["status"]) \
+        .created(args["created_after"], args["created_before"]) \
+        .total(args["min_total"], args["max_total"]) \
+        .sort(args["sort"], args["sort_by"]) \
+        .page(args["page"], args["per_page"])
+
+
+def build_item_query(args):
+    """ Composes the query builder of an item listing from its query string arguments """
+    check_page_size(args)
+    return ItemQuery() \
+        .product(args["product_id"]) \
+        .status(args["status"]) \
+        .sort(args["sort"], args["sort_by"]) \
+        .page(args["page"], args["per_page"])
+
+
+def list_results(builder, serialize, *args):
+    """ Returns the serialized rows of a listing, checked against the full scan guard """
+    return builder.results(serialize, *args, threshold=app.config["QUERY_SCAN_THRESHOLD"],
+                           max_offset=app.config["QUERY_MAX_OFFSET"])
+
+
+def local_time(moment):
+    """ Returns a moment as the naive local time of the creation dates """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def total_count_headers(builder, args):
+    """ Returns the X-Total-Count headers of a listing, exact when asked with exact=true, and its deepest offset """
+    count, exact = builder.count(args["exact"], app.config["COUNT_EXACT_BELOW"], app.config["COUNT_CACHE_TTL"])
+    return {"X-Total-Count": count, "X-Total-Count-Type": "exact" if exact else "estimated",
+            "X-Max-Offset": app.config["QUERY_MAX_OFFSET"]}
+
+
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Order.init_db(app)
 
+
+@app.cli.command("rebuild-product-rollups")
+def rebuild_product_rollups():
+    """ Recomputes the product rollups from the items, e.g. after a backfill """
+    app.logger.info("Rebuilt %d product rollups", ProductRollup.rebuild())
+
+
+@app.cli.command("rebuild-order-rollups")
+def rebuild_order_rollups():
+    """ Recomputes the minute, hour and day rollups from the orders, e.g. after a backfill """
+    app.logger.info("Rebuilt %d order rollups", OrderRollup.rebuild())
+
+
+@app.cli.command("migrate-schema")
+def migrate_schema():
+    """ Adds the columns missing from existing tables and fills the item counts of the orders """
+    added = Order.migrate_schema()
+    app.logger.info("Added %d columns: %s", len(added), ", ".join(sorted(added)))
+
+
+def warm_up():
+    """ Warms up this worker: pooled connections, mappers, common queries and hot orders """
+    started = time.perf_counter()
+    # a lazy schema check must run before the warm up queries
+    app.try_trigger_before_first_request_functions()
+    warm_up_status.update(Order.warm_up(app.config["WARMUP_CONNECTIONS"],
+                                        app.config["WARMUP_HOT_ORDERS"]))
+    warm_up_status["precompressed_assets"] = assets.precompress(app.config)
+    warm_up_status["seconds"] = time.perf_counter() - started
+    warm_up_status["ready"] = True
+    app.logger.info("Worker warmed up in %.3f seconds", warm_up_status["seconds"])
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -0,0 +1,146 @@
+"""
+Customer sharding
+
+With SHARDS set, orders and their items are spread over several databases
+by customer_id. Shard 0 is SQLALCHEMY_DATABASE_URI and SHARDS adds the
+others by number, e.g. SHARDS='{"1": "postgres://...", "2": "postgres://..."}'.
+Customers are placed on a consistent hash ring with SHARD_VNODES points per
+shard, so adding a shard moves about 1/N of the customers to it (their
+orders have to be copied over) and leaves the others where they are.
+
+Order and item ids of shard n start at n * SHARD_ID_SPAN, so the shard of an
+order is known from its id alone. A session writes the orders of one shard
+per flush, and the change feed and the rollups of those orders in the same
+transaction on the same shard (the tables with info sharded). Each shard
+holds the rollups of its own orders, summed on read, and its part of the
+feed, merged on read up to a watermark kept in shard 0 (see
+OrderChange.sequence). Idempotency keys are kept on the shard of the write
+they guard, and committed with it.
+
+Reads of one customer or one order go to its shard, on the async read path
+(service.async_reads) too; the other listings are sent to every shard at
+once and merged (see service.queries), within the request's deadline.
+"""
+import bisect
+import hashlib
+import threading
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from service.deadlines import carried_deadline, current_deadline
+
+# Key of the shard a session is bound to in its info dictionary
+SHARD_INFO = "shard"
+
+
+def bind_key(number):
+    """ Returns the SQLALCHEMY_BINDS key of a shard """
+    return "shard-{}".format(number)
+
+
+def _point(key):
+    """ Returns the position of a key on the ring """
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+class HashRing():
+    """ Consistent hashing of keys onto nodes, with vnodes points per node """
+
+    def __init__(self, nodes, vnodes=64):
+        self.points = sorted((_point("{}#{}".format(node, replica)), node)
+                             for node in nodes for replica in range(vnodes))
+        self.keys = [point for point, _ in self.points]
+
+    def node(self, key):
+        """ Returns the node owning a key, the first point after it on the ring """
+        index = bisect.bisect(self.keys, _point(key)) % len(self.keys)
+        return self.points[index][1]
+
+
+class ShardMap():
+    """ The shards of the orders, shard 0 being the default database """
+
+    def __init__(self, shards=None, vnodes=64, id_span=10**8):
+        self.configure(shards, vnodes, id_span)
+
+    def configure(self, shards=None, vnodes=64, id_span=10**8):
+        """ Sets the shards, {number: database URI}, of the map """
+        self.uris = {0: None}
+        self.uris.update({int(number): uri for number, uri in (shards or {}).items()})
+        self.numbers = sorted(self.uris)
+        self.ring = HashRing(self.numbers, vnodes)
+        self.id_span = id_span
+
+    @property
+    def sharded(self):
+        """ True when there is more than one shard """
+        return len(self.numbers) > 1
+
+    def binds(self):
+        """ Returns the SQLALCHEMY_BINDS of the shards other than 0 """
+        return {bind_key(number): uri for number, uri in self.uris.items() if number}
+
+    def for_customer(self, customer_id):
+        """ Returns the shard of a customer """
+        if not self.sharded:
+            return 0
+        return self.ring.node(customer_id)
+
+    def for_id(self, row_id):
+        """ Returns the shard of an order or item id, None when no shard has it """
+        if not self.sharded:
+            return 0
+        number = row_id // self.id_span
+        return number if number in self.uris and row_id >= 0 else None
+
+    def first_id(self, number):
+        """ Returns the id the ids of a shard follow """
+        return number * self.id_span
+
+
+class ShardedSession(SignallingSession):
+    """ Session that sends the statements on sharded tables to the shard it is bound to """
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = self.info.get(SHARD_INFO)
+        if shard and (mapper is None or mapper.local_table.info.get("sharded")):
+            return get_state(self.app).db.get_engine(self.app, bind=bind_key(shard))
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with ShardedSession sessions """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+
+def scatter(app, db, numbers, func):
+    """
+    Runs func(number) once per shard, at the same time, each on its own
+    thread with db.session bound to the shard and the deadline of the
+    current request
+    :return: the results in the order of numbers
+    """
+    results = [None] * len(numbers)
+    errors = []
+    deadline = current_deadline()
+
+    def run(index, number):
+        with app.app_context(), carried_deadline(deadline):
+            try:
+                db.session().info[SHARD_INFO] = number
+                results[index] = func(number)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=run, args=(index, number), name="shard-{}".format(number))
+               for index, number in enumerate(numbers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -19,6 +19,11 @@ $(function () {
 
         row_num = 0;
         $("#order_items").empty();
+        // order summaries come without their items
+        if (!res.order_items) {
+            add_row();
+            return;
+        }
         for (var i = 0; i < res.order_items.length; i++) { 
             add_row();
             var item = res.order_items[i];
@@ -93,54 +98,140 @@ $(function () {
         });
     }
 
-    // Updates results
-    function update_results(ajax) {
-        ajax.done(function(res){
-            $("#results").empty();
-            $("#results").append('<table class="table-striped" cellpadding="10">');
-            var header = '<thead><tr><th colspan="1"></th><th colspan="1"></th><th colspan="1"></th>'
-            header += '<th colspan="5">ORDER ITEMS</th></tr><tr>'
-            header += '<th style="width:10%">Order ID</th>'
-            header += '<th style="width:15%">Customer ID</th>'
-            header += '<th style="width:10%">Item ID</th>'
-            header += '<th style="width:10%">Product ID</th>'
-            header += '<th style="width:10%">Quantity</th>'
-            header += '<th style="width:10%">Price</th>'
-            header += '<th style="width:10%">Status</th>'
-            $("#results").append(header);
-
-            $("#results").append('<tbody>');
-            var first_order = "";
-            for(var i = 0; i < res.length; i++) {
-                var order = res[i];
-                var order_row = "<tr><td>"+order.id+"</td><td>"+order.customer_id+"</td><td>";
-                var empty_row = "<tr><td></td><td></td><td></td>";
-                for (var j = 0; j < order.order_items.length; j++) {
-                    var item = order.order_items[j];
-                    var item_row = item.item_id+"</td><td>"+ item.product_id + "</td><td>" 
-                                         + item.quantity + "</td><td>" + item.price + "</td><td>" 
-                                         + item.status + "</td></tr>";
-                    $("#results").append((j == 0 ? order_row : empty_row) + item_row);
+    // ****************************************
+    //  R E S U L T S   T A B L E
+    // ****************************************
+    // Listings are paged and filtered by the server and only the rows in
+    // view are in the DOM, the pages are fetched as they are scrolled to
+    const STATUSES = ["PLACED", "SHIPPED", "DELIVERED", "CANCELLED"];
+    const PAGE_SIZE = 100;
+    const ROW_HEIGHT = 37;
+    const VIEW_ROWS = 12;
+    const OVERSCAN = 6;
+
+    var listing = null;
+
+    // Starts a listing of the order summaries matching the filters
+    function list_orders(filters) {
+        var status = $("#search_status").val();
+        if (status) {
+            filters.status = status;
+        }
+        // max_rows is how deep the server serves pages, told by X-Max-Offset
+        listing = {filters: filters, total: 0, exact: false, max_rows: Infinity, pages: {}, loading: {}};
+
+        var header = '<thead><tr><th colspan="1"></th><th colspan="1"></th><th colspan="1"></th>'
+        header += '<th colspan="4">ITEMS BY STATUS</th><th colspan="1"></th></tr><tr>'
+        header += '<th style="width:10%">Order ID</th>'
+        header += '<th style="width:15%">Customer ID</th>'
+        header += '<th style="width:10%">Items</th>'
+        for (var s = 0; s < STATUSES.length; s++) {
+            header += '<th style="width:10%">' + STATUSES[s] + '</th>'
+        }
+        header += '<th style="width:10%">Total</th></tr></thead>'
+
+        $("#results").empty();
+        $("#results").append('<p id="results_count"></p>');
+        $("#results").append('<div id="results_viewport" style="height:' + (VIEW_ROWS * ROW_HEIGHT + 60)
+                             + 'px; overflow-y:auto;"><table class="table-striped" cellpadding="10" '
+                             + 'style="width:100%">' + header + '<tbody id="results_body"></tbody></table></div>');
+        $("#results_viewport").on("scroll", function () {
+            window.requestAnimationFrame(render_rows);
+        });
+        load_page(1);
+    }
+
+    // Fetches a page of the listing, unless it is loaded or loading
+    function load_page(page) {
+        var current = listing;
+        if (current.pages[page] || current.loading[page]) {
+            return;
+        }
+        current.loading[page] = true;
+        var ajax = $.ajax({
+            type: "GET",
+            url: "/orders/summary",
+            contentType: "application/json",
+            data: $.extend({page: page, per_page: PAGE_SIZE}, current.filters)
+        });
+
+        ajax.done(function(res, text_status, xhr){
+            // a newer listing replaced this one
+            if (current !== listing) {
+                return;
+            }
+            delete current.loading[page];
+            current.pages[page] = res;
+            if (page == 1) {
+                current.total = parseInt(xhr.getResponseHeader("X-Total-Count")) || res.length;
+                current.exact = xhr.getResponseHeader("X-Total-Count-Type") == "exact";
+                var max_offset = parseInt(xhr.getResponseHeader("X-Max-Offset"));
+                if (!isNaN(max_offset)) {
+                    current.max_rows = (Math.floor(max_offset / PAGE_SIZE) + 1) * PAGE_SIZE;
                 }
-                if (i == 0) {
-                    first_order = order;
+                // copy the first result to the form
+                if (res.length > 0) {
+                    update_form_data(res[0]);
                 }
+                flash_message("Success");
             }
-
-            $("#results").append('</tbody></table>');
-
-            // copy the first result to the form
-            if (first_order != "") {
-                update_form_data(first_order)
+            // a short page is the last one, whatever the estimate said
+            if (res.length < PAGE_SIZE) {
+                current.total = (page - 1) * PAGE_SIZE + res.length;
+                current.exact = true;
             }
-            flash_message("Success")
+            render_rows();
         });
 
         ajax.fail(function(res){
-            flash_message(res.responseJSON.message)
+            delete current.loading[page];
+            // a page past the deepest one served ends the listing
+            if (res.status == 400 && page > 1 && current === listing) {
+                current.max_rows = Math.min(current.max_rows, (page - 1) * PAGE_SIZE);
+                render_rows();
+            }
+            flash_message(res.responseJSON.message);
         });
     }
 
+    // Returns the table row of an order summary
+    function summary_row(order) {
+        var row = '<tr style="height:' + ROW_HEIGHT + 'px; white-space:nowrap;"><td>' + order.id + "</td><td>"
+                  + order.customer_id + "</td><td>" + order.item_count + "</td>";
+        for (var s = 0; s < STATUSES.length; s++) {
+            row += '<td class="' + STATUSES[s].toLowerCase() + '_count">' + order.status_counts[STATUSES[s]] + "</td>";
+        }
+        return row + "<td>" + order.order_total + "</td></tr>";
+    }
+
+    // Renders the rows in view, spacer rows stand for the others
+    function render_rows() {
+        if (listing == null || !$("#results_viewport").length) {
+            return;
+        }
+        var rows = Math.min(listing.total, listing.max_rows);
+        var first = Math.max(0, Math.floor($("#results_viewport").scrollTop() / ROW_HEIGHT) - OVERSCAN);
+        var last = Math.min(rows, first + VIEW_ROWS + 2 * OVERSCAN);
+        var html = '<tr style="height:' + (first * ROW_HEIGHT) + 'px"></tr>';
+        for (var i = first; i < last; i++) {
+            var orders = listing.pages[Math.floor(i / PAGE_SIZE) + 1];
+            if (!orders) {
+                load_page(Math.floor(i / PAGE_SIZE) + 1);
+                html += '<tr style="height:' + ROW_HEIGHT + 'px"><td colspan="8">Loading...</td></tr>';
+            } else if (i % PAGE_SIZE < orders.length) {
+                html += summary_row(orders[i % PAGE_SIZE]);
+            }
+        }
+        html += '<tr style="height:' + (Math.max(rows - last, 0) * ROW_HEIGHT) + 'px"></tr>';
+        $("#results_body").html(html);
+
+        var count = (listing.exact ? "" : "about ") + listing.total + " orders";
+        if (listing.total > listing.max_rows) {
+            count += ", showing the first " + listing.max_rows + ": filter to narrow the search";
+        }
+        $("#results_count").text(count);
+    }
+
     // ****************************************
     // Delete an Order
     // ****************************************
@@ -326,14 +417,7 @@ $(function () {
     // List All Orders
     // ****************************************
     $("#list-all-btn").click(function () {
-        var ajax = $.ajax({
-            type: "GET",
-            url: "/orders",
-            contentType: "application/json",
-            data: ''
-        })
-        
-        update_results(ajax);
+        list_orders({});
     });
 
     // ****************************************
@@ -341,15 +425,7 @@ $(function () {
     // ****************************************
     $("#find-by-customer-id-btn").click(function () {
         var customer_id = parseInt($("#order_customer_id").val());
-        console.log(customer_id)
-        var ajax = $.ajax({
-            type: "GET",
-            url: "/orders?customer_id=" + customer_id,
-            contentType: "application/json",
-            data: ''
-        })
-        
-        update_results(ajax);
+        list_orders({customer_id: customer_id});
     });
 
 
@@ -357,6 +433,7 @@ $(function () {
     // Clear the results
     // ****************************************
     $("#clear-results-btn").click(function () {
+        listing = null;
         $("#results").empty();
     });
 })
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Batch validation of request payloads
+
+Validators are compiled once from the flask-restx models declared in
+service/routes.py, so the documented schema and the checks cannot drift
+apart. Compiling turns every field into a small closure with its
+constraints (type, required, min/max, enum, min_items) already resolved;
+validating an array of payloads is then a single pass that collects every
+error with the JSON pointer of the offending value instead of stopping at
+the first one.
+
+Rules that span fields (e.g. an item total that rounds to 0) are given as
+checks per model name; they run on the objects whose fields are all valid.
+"""
+from flask_restx import fields
+
+MISSING = object()
+
+
+def _escape(name):
+    """ Escapes a key for a JSON pointer (RFC 6901) """
+    return str(name).replace("~", "~0").replace("/", "~1")
+
+
+def _value(field, attribute):
+    """ Returns a field constraint, resolving callables """
+    value = getattr(field, attribute, None)
+    return value() if callable(value) else value
+
+
+def _compile_number(field, types, type_name):
+    """ Compiles an integer or number field into a check returning an error or None """
+    minimum = _value(field, "minimum")
+    maximum = _value(field, "maximum")
+    exclusive_min = _value(field, "exclusiveMinimum")
+    exclusive_max = _value(field, "exclusiveMaximum")
+
+    def check(value):
+        if not isinstance(value, types) or isinstance(value, bool):
+            return "must be {}".format(type_name)
+        if minimum is not None and (value <= minimum if exclusive_min else value < minimum):
+            return "must be greater than {}{}".format("" if exclusive_min else "or equal to ", minimum)
+        if maximum is not None and (value >= maximum if exclusive_max else value > maximum):
+            return "must be less than {}{}".format("" if exclusive_max else "or equal to ", maximum)
+        return None
+    return check
+
+
+def _compile_string(field):
+    """ Compiles a string field into a check returning an error or None """
+    enum = _value(field, "enum")
+    allowed = frozenset(enum) if enum else None
+
+    def check(value):
+        if not isinstance(value, str):
+            return "must be a string"
+        if allowed is not None and value not in allowed:
+            return "must be one of {}".format(", ".join(enum))
+        return None
+    return check
+
+
+def _compile_field(field, checks=None):
+    """
+    Compiles a field into a tuple (scalar, check)
+    A scalar check returns an error message or None, a container check
+    receives the pointer of the value and appends its errors to a list
+    """
+    if isinstance(field, fields.Nested):
+        return False, compile_model(field.nested, checks)
+    if isinstance(field, fields.List):
+        min_items = _value(field, "min_items")
+        item_scalar, item_check = _compile_field(field.container, checks)
+
+        def check_list(value, pointer, errors):
+            if not isinstance(value, list):
+                errors.append((pointer, "must be an array"))
+                return
+            if min_items and len(value) < min_items:
+                errors.append((pointer, "must contain at least {} item(s)".format(min_items)))
+            for index, item in enumerate(value):
+                if item_scalar:
+                    message = item_check(item)
+                    if message:
+                        errors.append(("{}/{}".format(pointer, index), message))
+                else:
+                    item_check(item, "{}/{}".format(pointer, index), errors)
+        return False, check_list
+    if isinstance(field, fields.Integer):
+        return True, _compile_number(field, int, "an integer")
+    if isinstance(field, (fields.Float, fields.Arbitrary, fields.Fixed)):
+        return True, _compile_number(field, (int, float), "a number")
+    if isinstance(field, fields.String):
+        return True, _compile_string(field)
+    return True, lambda value: None
+
+
+def compile_model(model, checks=None):
+    """
+    Compiles a flask-restx model into a check(data, pointer, errors)
+    Read only fields are skipped, they are never sent by clients; checks,
+    {model name: [check(data) returning None or (field name, message)]},
+    are run on the valid objects of a model
+    """
+    compiled = []
+    for name, field in model.items():
+        if getattr(field, "readonly", False):
+            continue
+        scalar, check = _compile_field(field, checks)
+        compiled.append((name, "/" + _escape(name), bool(field.required), scalar, check))
+    model_checks = (checks or {}).get(model.name, [])
+
+    def check_model(data, pointer, errors):
+        if not isinstance(data, dict):
+            errors.append((pointer, "must be an object"))
+            return
+        found = len(errors)
+        for name, suffix, required, scalar, check in compiled:
+            value = data.get(name, MISSING)
+            if value is MISSING or value is None:
+                if required:
+                    errors.append((pointer + suffix, "is required"))
+                continue
+            if scalar:
+                message = check(value)
+                if message:
+                    errors.append((pointer + suffix, message))
+            else:
+                check(value, pointer + suffix, errors)
+        if len(errors) > found:
+            return
+        for model_check in model_checks:
+            error = model_check(data)
+            if error:
+                name, message = error
+                errors.append((pointer + "/" + _escape(name), message))
+    return check_model
+
+
+class ModelValidator():
+    """ Validates payloads against a compiled flask-restx model and its checks """
+
+    def __init__(self, model, checks=None):
+        self.model = model
+        self.check = compile_model(model, checks)
+
+    def errors(self, data, pointer=""):
+        """ Returns the errors of a payload as a list of {pointer, message} """
+        errors = []
+        self.check(data, pointer, errors)
+        return [{"pointer": where, "message": message} for where, message in errors]
+
+    def errors_many(self, payloads):
+        """ Returns the errors of an array of payloads in one pass """
+        if not isinstance(payloads, list):
+            return [{"pointer": "", "message": "must be an array"}]
+        errors = []
+        check = self.check
+        for index, data in enumerate(payloads):
+            check(data, "/{}".format(index), errors)
+        return [{"pointer": where, "message": message} for where, message in errors]
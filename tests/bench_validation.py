@@ -0,0 +1,50 @@
+"""
+Benchmark of the compiled validator against Order.deserialize
+
+Usage:
+  python -m tests.bench_validation --orders 10000
+"""
+import argparse
+import timeit
+from service.models import Order
+from service.routes import order_validator
+from .data_generator import OrderDataGenerator
+
+
+def payloads(count, seed=0):
+    """ Builds create order payloads from the data generator """
+    return [{
+        "customer_id": order["customer_id"],
+        "order_items": [{
+            "product_id": item["product_id"],
+            "quantity": item["quantity"],
+            "price": item["price"],
+            "status": item["status"],
+        } for item in items],
+    } for order, items in OrderDataGenerator(seed=seed).generate(count)]
+
+
+def deserialize_all(data):
+    """ The per item path: one Order and Item object per payload """
+    for order in data:
+        Order().deserialize(order)
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Benchmark payload validation")
+    parser.add_argument("--orders", type=int, default=10000, help="orders per run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each path")
+    args = parser.parse_args(argv)
+
+    data = payloads(args.orders)
+    items = sum(len(order["order_items"]) for order in data)
+    per_item = min(timeit.repeat(lambda: deserialize_all(data), number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: order_validator.errors_many(data), number=1, repeat=args.repeat))
+    print("{} orders, {} items".format(len(data), items))
+    print("Order.deserialize    {:8.1f} ms".format(per_item * 1000))
+    print("compiled validator   {:8.1f} ms ({:.1f}x faster)".format(compiled * 1000, per_item / compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+HTTP load generator for the Order Service
+
+Replays the order lifecycle described in features/orders.feature
+(create, list, find by customer, retrieve, update, cancel items and
+orders, delete) concurrently against a running service without a browser,
+and reports throughput and p50/p95/p99 latency per endpoint.
+
+Flows:
+  lifecycle - create an order, retrieve it, update it, cancel an item,
+              cancel the order and delete it
+  browse    - list the first page of the orders
+  lookup    - find the orders of a customer and retrieve one of them
+  create    - create an order
+
+Usage:
+  python -m tests.load_generator --base-url http://localhost:5000 \\
+      --concurrency 16 --duration 60 --mix lifecycle=1,browse=1,lookup=6
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+import requests
+from .data_generator import OrderDataGenerator
+
+logger = logging.getLogger("flask.app")
+
+HEADERS = {"Content-Type": "application/json"}
+
+# Orders listed by the browse flow
+BROWSE_PAGE_SIZE = 50
+
+DEFAULT_MIX = {"lifecycle": 1, "browse": 1, "lookup": 6, "create": 2}
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(values)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class LoadStats():
+    """ Thread safe latency and status recorder keyed by endpoint """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.started = time.time()
+        self.finished = None
+
+    def record(self, endpoint, seconds, ok):
+        """ Records one request """
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def stop(self):
+        """ Marks the end of the run """
+        self.finished = time.time()
+
+    def summary(self):
+        """ Returns a dictionary with throughput and latency per endpoint """
+        elapsed = (self.finished or time.time()) - self.started
+        endpoints = {}
+        total = 0
+        with self.lock:
+            for endpoint, values in sorted(self.latencies.items()):
+                values = sorted(values)
+                total += len(values)
+                endpoints[endpoint] = {
+                    "requests": len(values),
+                    "errors": self.errors[endpoint],
+                    "throughput": len(values) / elapsed if elapsed else 0,
+                    "p50_ms": percentile(values, 50) * 1000,
+                    "p95_ms": percentile(values, 95) * 1000,
+                    "p99_ms": percentile(values, 99) * 1000,
+                }
+        return {
+            "elapsed": elapsed,
+            "requests": total,
+            "throughput": total / elapsed if elapsed else 0,
+            "endpoints": endpoints,
+        }
+
+    def report(self):
+        """ Formats the summary as a table """
+        summary = self.summary()
+        lines = ["{:<38} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")]
+        for endpoint, stats in summary["endpoints"].items():
+            lines.append("{:<38} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                endpoint, stats["requests"], stats["errors"], stats["throughput"],
+                stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+        lines.append("{} requests in {:.1f}s ({:.1f} req/s)".format(
+            summary["requests"], summary["elapsed"], summary["throughput"]))
+        return "\n".join(lines)
+
+
+class OrderFlows():
+    """ The BDD workflows expressed as sequences of HTTP calls """
+
+    def __init__(self, session, base_url, stats, generator, rng=None):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.stats = stats
+        self.generator = generator
+        self.rng = rng or random.Random()
+        self.customer_ids = []
+
+    def call(self, method, endpoint, path, payload=None, expected=(200,)):
+        """ Sends one request and records its latency under the endpoint name """
+        started = time.perf_counter()
+        ok = False
+        resp = None
+        try:
+            resp = self.session.request(method, self.base_url + path, headers=HEADERS,
+                                        data=json.dumps(payload) if payload is not None else None)
+            ok = resp.status_code in expected
+        except requests.RequestException as error:
+            logger.warning("%s %s failed: %s", method, path, error)
+        self.stats.record("{} {}".format(method, endpoint), time.perf_counter() - started, ok)
+        return resp if ok else None
+
+    def _new_order(self):
+        """ Builds a create order payload from the data generator """
+        order, items = next(self.generator.generate(1))
+        return {
+            "customer_id": order["customer_id"],
+            "order_items": [{
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
+                "price": item["price"],
+                "status": "PLACED",
+            } for item in items],
+        }
+
+    def create(self):
+        """ Create an Order """
+        resp = self.call("POST", "/orders", "/orders", self._new_order(), expected=(201,))
+        if resp is None:
+            return None
+        order = resp.json()
+        self.customer_ids.append(order["customer_id"])
+        del self.customer_ids[:-100]
+        return order
+
+    def browse(self):
+        """ List the first page of the orders, the service does not list whole tables """
+        self.call("GET", "/orders?per_page={n}", "/orders?per_page={}".format(BROWSE_PAGE_SIZE))
+
+    def lookup(self):
+        """ List all orders for a customer id and retrieve one """
+        if not self.customer_ids:
+            self.create()
+            return
+        customer_id = self.rng.choice(self.customer_ids)
+        resp = self.call("GET", "/orders?customer_id={id}",
+                         "/orders?customer_id={}".format(customer_id))
+        if resp is not None and resp.json():
+            order = self.rng.choice(resp.json())
+            self.call("GET", "/orders/{id}", "/orders/{}".format(order["id"]))
+
+    def lifecycle(self):
+        """ Create, retrieve, update, cancel and delete an order """
+        order = self.create()
+        if order is None:
+            return
+        path = "/orders/{}".format(order["id"])
+        self.call("GET", "/orders/{id}", path)
+        self.call("PUT", "/orders/{id}", path, {"customer_id": order["customer_id"]})
+        item_id = order["order_items"][0]["item_id"]
+        self.call("PUT", "/orders/{id}/items/{item_id}/cancel",
+                  "{}/items/{}/cancel".format(path, item_id))
+        self.call("PUT", "/orders/{id}/cancel", path + "/cancel", expected=(200, 400))
+        self.call("DELETE", "/orders/{id}", path, expected=(204,))
+
+
+class LoadGenerator():
+    """ Runs a weighted mix of flows from several threads """
+
+    def __init__(self, base_url, concurrency=4, mix=None, seed=0, session_factory=requests.Session):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.mix = mix or DEFAULT_MIX
+        self.seed = seed
+        self.session_factory = session_factory
+        self.stats = LoadStats()
+
+    def _worker(self, index, deadline, remaining):
+        """ Runs flows until the deadline passes or the iterations are used up """
+        rng = random.Random(self.seed + index)
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        flows = OrderFlows(self.session_factory(), self.base_url, self.stats,
+                           OrderDataGenerator(seed=self.seed + index, customers=1000, products=1000), rng)
+        while deadline is None or time.time() < deadline:
+            if remaining is not None:
+                with remaining["lock"]:
+                    if remaining["count"] <= 0:
+                        return
+                    remaining["count"] -= 1
+            getattr(flows, rng.choices(names, weights)[0])()
+
+    def run(self, duration=None, iterations=None):
+        """
+        Runs the load for duration seconds or until iterations flows have run
+        :return: the LoadStats of the run
+        """
+        deadline = time.time() + duration if duration else None
+        remaining = {"lock": threading.Lock(), "count": iterations} if iterations else None
+        if deadline is None and remaining is None:
+            raise ValueError("Either duration or iterations is required")
+        self.stats = LoadStats()
+        threads = [threading.Thread(target=self._worker, args=(i, deadline, remaining), daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stats.stop()
+        return self.stats
+
+
+def parse_mix(text):
+    """ Parses a mix such as 'lifecycle=1,lookup=5' """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if not hasattr(OrderFlows, name) or name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("unknown flow: {}".format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Replay order flows against a running service")
+    parser.add_argument("--base-url", default=os.getenv("BASE_URL", "http://localhost:5000"))
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, help="seconds to run for")
+    parser.add_argument("--iterations", type=int, help="number of flows to run")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="weighted flows, e.g. lifecycle=1,browse=1,lookup=6,create=2")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.iterations:
+        args.duration = 30
+
+    logging.basicConfig(level=logging.WARNING)
+    stats = LoadGenerator(args.base_url, args.concurrency, args.mix, args.seed).run(
+        duration=args.duration, iterations=args.iterations)
+    print(json.dumps(stats.summary(), indent=2) if args.json else stats.report())
+
+
+if __name__ == "__main__":
+    main()
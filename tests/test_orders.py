@@ -5,8 +5,10 @@ Test cases for Order Model
 import logging
 import unittest
 import os
+import tempfile
+from sqlalchemy import MetaData, Table
 from werkzeug.exceptions import NotFound
-from service.models import Order,Item, DataValidationError, db
+from service.models import Order,Item, IdempotencyKey, OrderChange, OrderRollup, ProductRollup, DataValidationError, db
 from service import app 
 from datetime import datetime
 from .order_factory import OrderFactory
@@ -225,6 +227,210 @@ class TestOrderModel(unittest.TestCase):
         self.assertEqual(order.creation_date, order1.creation_date)
 
 
+    def test_serialize_query(self):
+        """ Serialize orders from columns only """
+        for customer_id in (5, 6, 5):
+            items = [Item(product_id=1, quantity=1, price=5.0, item_total=5),
+                     Item(product_id=2, quantity=3, price=2.0, item_total=6)]
+            order = Order(customer_id=customer_id, order_items=items)
+            order.calc_order_totals()
+            order.create()
+        query = Order.find_by_customer_id(5)
+        expected = [order.serialize() for order in query]
+        self.assertEqual(Order.serialize_query(query), expected)
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(len(expected[0]["order_items"]), 2)
+        self.assertEqual(Order.serialize_query(Order.find_by_customer_id(7)), [])
+
+    def test_serialize_query_fields(self):
+        """ Serialize only the requested order and item fields """
+        order = Order(customer_id=5, order_items=[Item(product_id=1, quantity=2, price=5.0, item_total=10)])
+        order.calc_order_totals()
+        order.create()
+        self.assertEqual(Order.serialize_query(Order.query, ["customer_id", "order_total"]),
+                         [{"customer_id": 5, "order_total": 10}])
+        self.assertEqual(Order.serialize_query(Order.query, ["id", "order_items"], ["status", "quantity"]),
+                         [{"id": order.id, "order_items": [{"quantity": 2, "status": "PLACED"}]}])
+        self.assertEqual(Item.serialize_query(Item.query, ["product_id"]), [{"product_id": 1}])
+
+    def test_assemble_skips_unknown_orders(self):
+        """ Items of orders that were not read, e.g. committed in between, are left out """
+        orders = Order.assemble([{"id": 1}], [{"order_id": 1, "item_id": 1}, {"order_id": 99, "item_id": 2}])
+        self.assertEqual(orders, [{"id": 1, "order_items": [{"item_id": 1}]}])
+
+    def test_serialize_by_ids(self):
+        """ Look up orders by ids and customer ids """
+        for customer_id in (5, 6, 5):
+            order = Order(customer_id=customer_id, order_items=[Item(product_id=customer_id, quantity=1,
+                                                                      price=5.0, item_total=5)])
+            order.calc_order_totals()
+            order.create()
+        orders = Order.serialize_by_ids([1, 3, 9])
+        self.assertEqual(sorted(orders), [1, 3])
+        self.assertEqual(orders[3]["order_items"][0]["product_id"], 5)
+        customers = Order.serialize_by_customer_ids([5, 7])
+        self.assertEqual([order["id"] for order in customers[5]], [1, 3])
+        self.assertNotIn(7, customers)
+        products = Item.serialize_by_product_ids([6, 8])
+        self.assertEqual(list(products), [6])
+
+    def test_item_counts(self):
+        """ The item counts follow every item write """
+        order = Order(customer_id=5, order_items=[
+            Item(product_id=1, quantity=1, price=5.0, item_total=5, status="PLACED"),
+            Item(product_id=2, quantity=1, price=5.0, item_total=5, status="SHIPPED")])
+        order.calc_order_totals()
+        order.create()
+        self.assertEqual((order.item_count, order.placed_count, order.shipped_count), (2, 1, 1))
+        order.order_items.append(Item(product_id=3, quantity=1, price=1.0, item_total=1))
+        order.update()
+        self.assertEqual((order.item_count, order.placed_count), (3, 2))
+        item = Item.find_by_product_id(1).first()
+        item.status = "CANCELLED"
+        db.session.commit()
+        self.assertEqual((order.placed_count, order.cancelled_count), (1, 1))
+        Item.find_by_product_id(2).first().delete()
+        self.assertEqual((order.item_count, order.shipped_count), (2, 0))
+        summary = Order.serialize_summary_query(Order.query)
+        self.assertEqual(summary, [order.serialize_summary()])
+        self.assertEqual(summary[0]["status_counts"],
+                         {"PLACED": 1, "SHIPPED": 0, "DELIVERED": 0, "CANCELLED": 1})
+
+    def test_recount_items(self):
+        """ Recount the items of every order from the item table """
+        order = Order(customer_id=5, order_items=[Item(product_id=1, quantity=1, price=5.0, item_total=5)])
+        order.calc_order_totals()
+        order.create()
+        Order.query.update({"item_count": 0, "placed_count": 0})
+        db.session.commit()
+        Order.recount_items()
+        self.assertEqual((order.item_count, order.placed_count), (1, 1))
+
+    def test_migrate_schema(self):
+        """ Add the count columns to an order table created before them """
+        db.drop_all()
+        counts = ["item_count", "placed_count", "shipped_count", "delivered_count", "cancelled_count"]
+        old_order = Table("order", MetaData(), *[column.copy() for column in Order.__table__.columns
+                                                 if column.name not in counts])
+        old_order.create(db.engine)
+        db.create_all()
+        db.session.execute(old_order.insert(), {"id": 1, "customer_id": 5, "order_total": 15})
+        db.session.execute(Item.__table__.insert(), [
+            {"order_id": 1, "product_id": 1, "price": 5.0, "quantity": 1, "status": "PLACED", "item_total": 5},
+            {"order_id": 1, "product_id": 2, "price": 5.0, "quantity": 2, "status": "SHIPPED", "item_total": 10}])
+        db.session.commit()
+        added = Order.migrate_schema()
+        self.assertEqual(added, {"order." + name for name in counts})
+        order = Order.find(1)
+        self.assertEqual((order.item_count, order.placed_count, order.shipped_count), (2, 1, 1))
+        self.assertEqual(Order.migrate_schema(), set())
+
+    def test_product_rollups(self):
+        """ The product rollups follow every item write """
+        order = Order(customer_id=5, order_items=[
+            Item(product_id=1, quantity=2, price=5.0, item_total=10, status="PLACED"),
+            Item(product_id=1, quantity=1, price=5.0, item_total=5, status="SHIPPED"),
+            Item(product_id=2, quantity=3, price=1.0, item_total=3, status="PLACED")])
+        order.calc_order_totals()
+        order.create()
+        rollup = ProductRollup.find(1)
+        self.assertEqual((rollup.placed_quantity, rollup.shipped_quantity), (2, 1))
+        self.assertEqual((rollup.placed_revenue, rollup.shipped_revenue), (10, 5))
+        item = order.order_items[0]
+        item.status = "CANCELLED"
+        order.order_items[2].product_id = 1
+        order.update()
+        self.assertEqual((rollup.placed_quantity, rollup.cancelled_quantity), (3, 2))
+        self.assertEqual(ProductRollup.find(2).placed_quantity, 0)
+        order.delete()
+        self.assertEqual(ProductRollup.find(1).serialize(), {
+            "product_id": 1, "open_quantity": 0, "shipped_quantity": 0,
+            "quantity": {"PLACED": 0, "SHIPPED": 0, "DELIVERED": 0, "CANCELLED": 0},
+            "revenue": {"PLACED": 0, "SHIPPED": 0, "DELIVERED": 0, "CANCELLED": 0}})
+        self.assertIsNone(ProductRollup.find(3))
+
+    def test_rebuild_product_rollups(self):
+        """ Rebuild the rollup of every product from the item table """
+        order = Order(customer_id=5, order_items=[
+            Item(product_id=1, quantity=2, price=5.0, item_total=10, status="DELIVERED")])
+        order.calc_order_totals()
+        order.create()
+        ProductRollup.query.delete()
+        db.session.commit()
+        ProductRollup.rebuild()
+        rollup = ProductRollup.find(1)
+        self.assertEqual((rollup.delivered_quantity, rollup.delivered_revenue, rollup.placed_quantity), (2, 10, 0))
+
+    def test_order_rollups(self):
+        """ The minute, hour and day rollups follow every order write """
+        created = datetime(2021, 3, 4, 10, 30, 15)
+        order = Order(customer_id=5, creation_date=created, order_items=[
+            Item(product_id=1, quantity=1, price=5.0, item_total=5),
+            Item(product_id=2, quantity=1, price=2.0, item_total=2)])
+        order.calc_order_totals()
+        order.create()
+        Order(customer_id=6, creation_date=datetime(2021, 3, 4, 11, 0), order_items=[
+            Item(product_id=1, quantity=1, price=1.0, item_total=1)], order_total=1).create()
+        day = OrderRollup.find_range("day", created, created)
+        self.assertEqual(day, [{"bucket": datetime(2021, 3, 4), "order_count": 2, "item_count": 3,
+                                "cancelled_count": 0, "revenue": 8}])
+        order.order_items[0].status = "CANCELLED"
+        order.order_items.append(Item(product_id=3, quantity=1, price=4.0, item_total=4))
+        order.update()
+        hours = OrderRollup.find_range("hour", created, datetime(2021, 3, 4, 12, 0))
+        self.assertEqual([(hour["order_count"], hour["item_count"], hour["cancelled_count"], hour["revenue"])
+                          for hour in hours], [(1, 3, 1, order.order_total), (1, 1, 0, 1), (0, 0, 0, 0)])
+        order.delete()
+        minute = OrderRollup.find_range("minute", created, created)[0]
+        self.assertEqual((minute["bucket"], minute["order_count"], minute["revenue"]),
+                         (datetime(2021, 3, 4, 10, 30), 0, 0))
+
+    def test_rebuild_order_rollups(self):
+        """ Rebuild the rollups of every order from the order table """
+        created = datetime(2021, 3, 4, 10, 30, 15)
+        order = Order(customer_id=5, creation_date=created, order_items=[
+            Item(product_id=1, quantity=1, price=5.0, item_total=5)])
+        order.calc_order_totals()
+        order.create()
+        OrderRollup.query.delete()
+        db.session.commit()
+        OrderRollup.rebuild()
+        self.assertEqual(OrderRollup.query.count(), 3)
+        self.assertEqual(OrderRollup.find_range("day", created, created)[0]["revenue"], 5)
+
+    def test_record_changes(self):
+        """ Every write to an order appends a change in its transaction """
+        order = Order(customer_id=5, order_items=[Item(product_id=1, quantity=1, price=5.0, item_total=5)])
+        order.calc_order_totals()
+        order.create()
+        order.order_items[0].status = "SHIPPED"
+        order.update()
+        # a change rolled back with its write is not recorded
+        order.customer_id = 6
+        db.session.flush()
+        db.session.rollback()
+        order.delete()
+        changes = OrderChange.since(0, 10)
+        self.assertEqual([(change.order_id, change.operation) for change in changes],
+                         [(order.id, "created"), (order.id, "updated"), (order.id, "deleted")])
+        self.assertEqual(OrderChange.since(changes[0].position, 10), changes[1:])
+        self.assertEqual(changes[0].serialize()["cursor"], changes[0].position)
+
+    def test_change_cursors_in_commit_order(self):
+        """ Changes get their cursors in the order they are committed, not of their ids """
+        order = Order(customer_id=5, order_items=[Item(product_id=1, quantity=1, price=5.0, item_total=5)])
+        order.calc_order_totals()
+        order.create()
+        self.assertEqual(OrderChange.latest(), 1)
+        # the change with id 5 was written first and committed last
+        db.session.add(OrderChange(id=10, order_id=order.id, operation="updated"))
+        db.session.commit()
+        self.assertEqual([change.id for change in OrderChange.since(1, 10)], [10])
+        db.session.add(OrderChange(id=5, order_id=order.id, operation="updated"))
+        db.session.commit()
+        changes = OrderChange.since(2, 10)
+        self.assertEqual([(change.id, change.position) for change in changes], [(5, 3)])
+
 ######################################################################
 #   PLACE ITEM RELATED TEST CASES HERE 
 ######################################################################
@@ -243,6 +449,14 @@ class TestOrderModel(unittest.TestCase):
         self.assertEqual(order_item.price, 10)
         self.assertEqual(order_item.order_id, 19)
 
+    def test_serialize_item_rows(self):
+        """ Serialize items from columns only """
+        items = [Item(product_id=1, quantity=1, price=5.0, item_total=5),
+                 Item(product_id=2, quantity=3, price=2.0, item_total=6)]
+        Order(customer_id=1, order_items=items).create()
+        self.assertEqual(Item.serialize_query(Item.query), [item.serialize() for item in Item.all()])
+        self.assertEqual(Item.serialize_query(Item.find_by_product_id(2)), [items[1].serialize()])
+
     def test_deserialize_bad_data_with_wrong_product_id(self):
         """ Deserialization of bad order item data with product_id None """
         data = {"product_id": None, "quantity": 3, "price": 10}
@@ -279,6 +493,55 @@ class TestOrderModel(unittest.TestCase):
         order = Item()
         self.assertRaises(DataValidationError, order.deserialize, data)
 
+######################################################################
+#   I D E M P O T E N C Y   K E Y   T E S T   C A S E S
+######################################################################
+    def test_reserve_idempotency_key(self):
+        """ Reserve, complete and expire an idempotency key """
+        record, reserved = IdempotencyKey.reserve("k1", "f1", ttl=60, lock_timeout=10)
+        self.assertTrue(reserved)
+        self.assertIsNone(record.status_code)
+        record.complete(201, "{}", "http://localhost/orders/1")
+        record, reserved = IdempotencyKey.reserve("k1", "f1", ttl=60, lock_timeout=10)
+        self.assertFalse(reserved)
+        self.assertEqual(record.status_code, 201)
+        # an expired key can be claimed again
+        record, reserved = IdempotencyKey.reserve("k1", "f2", ttl=-1, lock_timeout=10)
+        self.assertTrue(reserved)
+        self.assertEqual(record.fingerprint, "f2")
+        # the key is only committed with the response
+        db.session.rollback()
+        self.assertIsNone(IdempotencyKey.query.get("k1"))
+
+######################################################################
+#   S T A R T U P   T E S T   C A S E S
+######################################################################
+    def test_schema_check_off(self):
+        """ No tables are created when the schema check is off """
+        db.drop_all()
+        app.config["DB_SCHEMA_CHECK"] = "off"
+        try:
+            Order.init_db(app)
+        finally:
+            app.config["DB_SCHEMA_CHECK"] = "startup"
+        self.assertFalse(db.engine.has_table(Order.__tablename__))
+
+    def test_schema_check_cached(self):
+        """ The schema check is skipped once a marker exists """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            app.config["DB_SCHEMA_CACHE_DIR"] = cache_dir
+            try:
+                marker = Order.schema_marker()
+                self.assertTrue(marker.startswith(cache_dir))
+                Order.create_schema()
+                self.assertTrue(os.path.exists(marker))
+                db.drop_all()
+                Order.create_schema()
+                self.assertFalse(db.engine.has_table(Order.__tablename__))
+            finally:
+                app.config["DB_SCHEMA_CACHE_DIR"] = ""
+        self.assertIsNone(Order.schema_marker())
+
 ######################################################################
 #   M A I N
 ######################################################################
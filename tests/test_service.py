@@ -7,11 +7,21 @@ Test cases can be run with the following:
 """
 import os
 import logging
+import gzip
+import io
+import json
+import re
+import threading
+import zlib
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from flask_api import status  # HTTP Status Codes
 from urllib.parse import quote_plus
 from service.models import db
+from service.events import ChangeBroker
+from service.compression import BROTLI_BOUNDED, DECOMPRESSION_ERROR, Compressor, RequestDecompressor, \
+    available_encodings, decompress
+from werkzeug.exceptions import RequestEntityTooLarge
 from service.routes import app, init_db
 from .order_factory import OrderFactory, ItemFactory
 from flask import abort
@@ -89,6 +99,42 @@ class TestOrderService(TestCase):
         """ Test index call """
         resp = self.app.get("/")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+    def test_fingerprinted_assets(self):
+        """ The page links assets named by their content, cached for good and precompressed """
+        page = self.app.get("/").get_data(as_text=True)
+        url = re.search(r'src="(/assets/js/rest_api\.[0-9a-f]{10}\.js)"', page).group(1)
+        resp = self.app.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        with open(os.path.join(app.static_folder, "js", "rest_api.js"), "rb") as asset_file:
+            self.assertEqual(gzip.decompress(resp.get_data()), asset_file.read())
+        resp = self.app.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotIn("darkly", page)
+        resp = self.app.get("/assets/js/rest_api.0000000000.js")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_ready(self):
+        """ Test the readiness probe warms up the worker """
+        self._create_orders(2)
+        with patch.dict(app.config, {"WARMUP_HOT_ORDERS": 5}):
+            with patch.dict("service.routes.warm_up_status", {"ready": False}):
+                resp = self.app.get("/ready")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                data = resp.get_json()
+                self.assertTrue(data["ready"])
+                self.assertEqual(data["orders"], 2)
+
+    def test_ready_warm_up_fails(self):
+        """ Test the readiness probe when the warm up fails """
+        with patch.dict("service.routes.warm_up_status", {"ready": False}):
+            with patch("service.models.Order.warm_up", side_effect=Exception("no database")):
+                resp = self.app.get("/ready")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
     def test_get_order(self):
         """ Get a single order """
@@ -115,6 +161,90 @@ class TestOrderService(TestCase):
 
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
         
+    def test_create_orders_idempotent(self):
+        """ Test a retried create with the same Idempotency-Key """
+        data = _get_order_factory_with_items(1).serialize()
+        headers = {"Idempotency-Key": "checkout-1"}
+        resp = self.app.post('/orders', json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        retry = self.app.post('/orders', json=data, headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers.get("Idempotent-Replayed"), "true")
+        self.assertEqual(retry.headers["Location"], resp.headers["Location"])
+        self.assertEqual(retry.get_json(), resp.get_json())
+        self.assertEqual(len(self.app.get('/orders').get_json()), 1)
+        # the same key with another payload is rejected
+        data["customer_id"] += 1
+        resp = self.app.post('/orders', json=data, headers=headers)
+        self.assertEqual(resp.status_code, 422)
+
+    def test_create_orders_idempotent_after_error(self):
+        """ Test a key is released when the request fails """
+        order_factory = _get_order_factory_with_items(1)
+        order_factory.order_items[0].quantity = -1
+        headers = {"Idempotency-Key": "checkout-2"}
+        resp = self.app.post('/orders', json=order_factory.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        order_factory.order_items[0].quantity = 1
+        resp = self.app.post('/orders', json=order_factory.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_create_orders_idempotent_crash(self):
+        """ Test a request dying before its response is stored leaves no order and no key """
+        data = _get_order_factory_with_items(1).serialize()
+        headers = {"Idempotency-Key": "checkout-3"}
+        with patch("service.models.IdempotencyKey.complete", side_effect=RuntimeError("worker died")):
+            with self.assertRaises(RuntimeError):
+                self.app.post('/orders', json=data, headers=headers)
+        db.session.remove()
+        self.assertEqual(self.app.get('/orders').get_json(), [])
+        resp = self.app.post('/orders', json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(resp.headers.get("Idempotent-Replayed"))
+
+    def test_idempotency_keys_per_client(self):
+        """ Test a retry from another address and two users with the same Idempotency-Key """
+        data = _get_order_factory_with_items(1).serialize()
+        headers = {"Idempotency-Key": "checkout-4"}
+        replayed = []
+        for address in ("10.0.0.1", "10.0.0.2"):
+            resp = self.app.post('/orders', json=data, headers=headers, environ_base={"REMOTE_ADDR": address})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            replayed.append(resp.headers.get("Idempotent-Replayed"))
+        self.assertEqual(replayed, [None, "true"])
+        resp = self.app.post('/orders', json=data, headers=headers, environ_base={"REMOTE_USER": "alice"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(resp.headers.get("Idempotent-Replayed"))
+        self.assertEqual(len(self.app.get('/orders').get_json()), 2)
+
+    def test_create_orders_bulk(self):
+        """ Test create many orders at once """
+        orders = [_get_order_factory_with_items(2).serialize() for _ in range(3)]
+        resp = self.app.post('/orders/bulk', json=orders, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+        self.assertEqual(len(data[0]["order_items"]), 2)
+        self.assertEqual(len(self.app.get('/orders').get_json()), 3)
+
+    def test_create_orders_bulk_invalid(self):
+        """ Test bulk create reports every error and creates nothing """
+        orders = [_get_order_factory_with_items(1).serialize() for _ in range(3)]
+        orders[0]["order_items"][0]["quantity"] = -1
+        orders[2]["customer_id"] = "abc"
+        resp = self.app.post('/orders/bulk', json=orders, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        pointers = [error["pointer"] for error in resp.get_json()["errors"]]
+        self.assertEqual(pointers, ["/0/order_items/0/quantity", "/2/customer_id"])
+        self.assertEqual(len(self.app.get('/orders').get_json()), 0)
+
+    def test_create_orders_bulk_too_many(self):
+        """ Test bulk create rejects too many orders """
+        orders = [_get_order_factory_with_items(1).serialize() for _ in range(3)]
+        with patch.dict(app.config, {"BULK_MAX_ORDERS": 2}):
+            resp = self.app.post('/orders/bulk', json=orders, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_orders(self):
         """ Test Get list of orders service """
         resp = self.app.get('/orders')
@@ -126,6 +256,23 @@ class TestOrderService(TestCase):
         resp = self.app.get('/orders?sort=customer_id&sort_by=asc')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_request_deadline_exceeded(self):
+        """ Test a request past its deadline returns 504 """
+        self._create_orders(2)
+        resp = self.app.get('/orders', headers={"X-Request-Timeout": "0.000001"})
+        self.assertEqual(resp.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        with patch.dict(app.config["REQUEST_TIMEOUTS"], {"item_collection": 0.000001}):
+            resp = self.app.get('/items')
+            self.assertEqual(resp.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        resp = self.app.get('/orders', headers={"X-Request-Timeout": "5"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_request_deadline_invalid(self):
+        """ Test a timeout header that is not a positive number of seconds returns 400 """
+        for timeout in ("0", "-1", "nan", "inf", "-inf", "soon"):
+            resp = self.app.get('/orders', headers={"X-Request-Timeout": timeout})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, timeout)
+
     def test_create_order_negative_qty(self):
         """ Create an order with negative quantity """
         order_factory = _get_order_factory_with_items(1)
@@ -278,6 +425,18 @@ class TestOrderService(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
 
+    def test_create_item_idempotent(self):
+        """ Test a retried item add with the same Idempotency-Key """
+        order = self._create_orders(1)[0]
+        data = ItemFactory().serialize()
+        headers = {"Idempotency-Key": "add-item-1"}
+        for _ in range(2):
+            resp = self.app.put('/orders/{}/items'.format(order.id), json=data, headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(resp.get_json()["order_items"]), 2)
+        resp = self.app.get('/orders/{}'.format(order.id))
+        self.assertEqual(len(resp.get_json()["order_items"]), 2)
+
     def test_create_invalid_item(self):
         """ Test create an invalid item """
         order_factory = _get_order_factory_with_items(1)
@@ -457,4 +616,303 @@ class TestOrderService(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         new_item = resp.get_json()
         self.assertEqual(len(new_item), 2)
-    
\ No newline at end of file
+    
+    def test_compressed_response(self):
+        """ Large responses are gzipped for clients that accept it """
+        self._create_orders(5)
+        with patch.dict(app.config, {"COMPRESSION_MIN_SIZE": 100}):
+            resp = self.app.get("/orders", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertEqual(len(json.loads(gzip.decompress(resp.data))), 5)
+            resp = self.app.get("/orders")
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertEqual(len(resp.get_json()), 5)
+
+    def test_small_response_not_compressed(self):
+        """ Responses under the threshold are sent as is """
+        resp = self.app.get("/orders", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_compressed_request_body(self):
+        """ Create an order from a gzipped body """
+        test_order = _get_order_factory_with_items(count=2)
+        body = gzip.compress(json.dumps(test_order.serialize()).encode())
+        resp = self.app.post("/orders", data=body, content_type="application/json",
+                             headers={"Content-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(resp.get_json()["order_items"]), 2)
+
+    def test_bad_compressed_request_body(self):
+        """ Invalid or unsupported request encodings are rejected """
+        resp = self.app.post("/orders", data=b"not gzip", content_type="application/json",
+                             headers={"Content-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/orders", data=b"{}", content_type="application/json",
+                             headers={"Content-Encoding": "compress"})
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertIn("compress", resp.get_json()["message"])
+
+    def test_decompression_bomb(self):
+        """ Request bodies stop inflating once past the limit, whatever their encoding """
+        data = b"0" * 1000000
+        for encoding in available_encodings():
+            if encoding == "br" and not BROTLI_BOUNDED:
+                continue
+            body = Compressor(encoding, app.config).compress_all(data)
+            self.assertLess(len(body), 10000)
+            self.assertEqual(decompress(body, encoding, len(data)), data)
+            with self.assertRaises(RequestEntityTooLarge):
+                decompress(body, encoding, 1000)
+
+    def test_gzip_members(self):
+        """ Every member of a gzip body is decompressed, within the limit """
+        body = gzip.compress(b"first ") + gzip.compress(b"second")
+        self.assertEqual(decompress(body, "gzip", 100), b"first second")
+        with self.assertRaises(RequestEntityTooLarge):
+            decompress(body, "gzip", 8)
+        self.assertEqual(self.app.post("/orders", data=gzip.compress(b"{}")[:-4],
+                                       headers={"Content-Encoding": "gzip"},
+                                       content_type="application/json").status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+    def test_compressed_body_size(self):
+        """ At most the compressed limit of a body is read, chunked or not """
+        environs = []
+        middleware = RequestDecompressor(lambda environ, start_response: environs.append(environ), 1000, 100)
+        for length in ("", "5000"):
+            stream = io.BytesIO(os.urandom(5000))
+            middleware({"HTTP_CONTENT_ENCODING": "gzip", "CONTENT_LENGTH": length, "wsgi.input": stream}, None)
+            self.assertIsInstance(environs[-1][DECOMPRESSION_ERROR], RequestEntityTooLarge)
+            self.assertLessEqual(stream.tell(), 101)
+        stream = io.BytesIO(gzip.compress(b"x" * 500))
+        middleware({"HTTP_CONTENT_ENCODING": "gzip", "wsgi.input": stream}, None)
+        self.assertEqual(environs[-1]["wsgi.input"].read(), b"x" * 500)
+
+    def test_compressed_stream_flushed(self):
+        """ Each chunk of a streamed response can be decompressed as soon as it is sent """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        stream = Compressor("gzip", app.config).compress_stream(iter(["first ", b"", "second"]))
+        self.assertEqual(decompressor.decompress(next(stream)), b"first ")
+        self.assertEqual(decompressor.decompress(next(stream)), b"second")
+        self.assertEqual(decompressor.decompress(next(stream)), b"")
+        self.assertTrue(decompressor.eof)
+
+    def test_list_orders_fields(self):
+        """ List orders with only the requested fields """
+        test_order = self._create_orders(2)[0]
+        resp = self.app.get("/orders?fields=id,customer_id,order_total")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(set(data[0]), {"id", "customer_id", "order_total"})
+        self.assertEqual(data[0]["customer_id"], test_order.customer_id)
+        resp = self.app.get("/orders?fields=id,order_items{item_id}")
+        self.assertEqual(resp.get_json()[0]["order_items"],
+                         [{"item_id": test_order.order_items[0].item_id}])
+
+    def test_get_order_fields(self):
+        """ Get an order with only the requested fields """
+        test_order = self._create_orders(1)[0]
+        resp = self.app.get("/orders/{}?fields=customer_id".format(test_order.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"customer_id": test_order.customer_id})
+        resp = self.app.get("/orders/0?fields=customer_id")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_items_fields(self):
+        """ List items with only the requested fields """
+        test_order = self._create_orders(1)[0]
+        resp = self.app.get("/items?fields=item_id,status")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"item_id": test_order.order_items[0].item_id,
+                                            "status": test_order.order_items[0].status}])
+
+    def test_unknown_fields(self):
+        """ Unknown or malformed fields are rejected """
+        for fields in ("id,color", "customer_id{id}", "order_items{color}", "id{"):
+            resp = self.app.get("/orders?fields={}".format(fields))
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, fields)
+
+    def test_list_order_summaries(self):
+        """ List orders with item counts """
+        orders = self._create_orders(2)
+        resp = self.app.put("/orders/{}/cancel".format(orders[0].id), content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/orders/summary?customer_id={}".format(orders[0].customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data[0]["id"], orders[0].id)
+        self.assertEqual(data[0]["item_count"], 1)
+        self.assertNotIn("order_items", data[0])
+        self.assertEqual(data[0]["status_counts"]["CANCELLED"], 1)
+        resp = self.app.get("/orders/summary")
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_lookup_orders(self):
+        """ Look up many orders, customers and products at once """
+        orders = self._create_orders(3)
+        product_id = orders[1].order_items[0].product_id
+        resp = self.app.post("/orders/lookup", json={
+            "order_ids": [orders[0].id, orders[2].id, 0],
+            "customer_ids": [orders[1].customer_id, -1],
+            "product_ids": [product_id, -2],
+        }, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sorted(data["orders"]), sorted([str(orders[0].id), str(orders[2].id)]))
+        self.assertEqual(data["orders"][str(orders[0].id)]["order_items"][0]["item_id"],
+                         orders[0].order_items[0].item_id)
+        customer_orders = data["customers"][str(orders[1].customer_id)]
+        self.assertIn(orders[1].id, [order["id"] for order in customer_orders])
+        self.assertEqual(data["products"][str(product_id)][0]["product_id"], product_id)
+        self.assertEqual(data["missing"], {"order_ids": [0], "customer_ids": [-1], "product_ids": [-2]})
+
+    def test_lookup_orders_bad_request(self):
+        """ Look up with invalid or no ids """
+        resp = self.app.post("/orders/lookup", json={"order_ids": ["1"]}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["errors"], [{"pointer": "/order_ids/0", "message": "must be an integer"}])
+        resp = self.app.post("/orders/lookup", json={}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_orders_filtered_and_sorted(self):
+        """ A customer_id filter keeps the requested sort and page """
+        for total in (3, 1, 2):
+            order = _get_order_factory_with_items(count=1)
+            order.customer_id = 77
+            order.order_items[0].quantity = total
+            order.order_items[0].price = 1.0
+            resp = self.app.post("/orders", json=order.serialize(), content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("/orders?customer_id=77&sort=order_total&sort_by=desc&page=1&per_page=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([order["order_total"] for order in resp.get_json()], [3, 2])
+        resp = self.app.get("/orders?sort=color")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {"QUERY_SCAN_THRESHOLD": -1}):
+            resp = self.app.get("/orders")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/orders?min_total=0")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/orders?created_after=1970-01-01")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/orders/summary?per_page=10")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_list_order_changes(self):
+        """ Follow the changes to the orders with the cursor """
+        orders = self._create_orders(2)
+        resp = self.app.get("/orders/changes")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([(change["order_id"], change["operation"]) for change in data["changes"]],
+                         [(orders[0].id, "created"), (orders[1].id, "created")])
+        resp = self.app.put("/orders/{}/items/{}/cancel".format(orders[0].id, orders[0].order_items[0].item_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/orders/changes?since={}&limit=1".format(data["cursor"]))
+        changes = resp.get_json()["changes"]
+        self.assertEqual([(change["order_id"], change["operation"]) for change in changes],
+                         [(orders[0].id, "updated")])
+        resp = self.app.get("/orders/changes?since={}".format(resp.get_json()["cursor"]))
+        self.assertEqual(resp.get_json()["changes"], [])
+        resp = self.app.get("/orders/changes?since=-1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_total_count(self):
+        """ Listings tell the total number of rows and how it was counted """
+        self._create_orders(3)
+        with patch.dict(app.config, {"COUNT_CACHE_TTL": 0}):
+            resp = self.app.get("/orders?per_page=2")
+            self.assertEqual(len(resp.get_json()), 2)
+            self.assertEqual(resp.headers["X-Total-Count"], "3")
+            self.assertEqual(resp.headers["X-Total-Count-Type"], "exact")
+            self.assertEqual(resp.headers["X-Max-Offset"], str(app.config["QUERY_MAX_OFFSET"]))
+            resp = self.app.get("/orders/summary?exact=true&status=SHIPPED&per_page=1")
+            self.assertIn("X-Total-Count", resp.headers)
+            self.assertIn("X-Max-Offset", resp.headers)
+            resp = self.app.get("/items?exact=true")
+            self.assertEqual(resp.headers["X-Total-Count"], "3")
+        resp = self.app.get("/orders?exact=maybe")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_order_rollups(self):
+        """ List the orders of each hour of a range """
+        orders = self._create_orders(2)
+        resp = self.app.get("/orders/rollups")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), app.config["ORDER_ROLLUP_BUCKETS"])
+        self.assertEqual(data[-1]["order_count"], 2)
+        self.assertAlmostEqual(data[-1]["revenue"], sum(order.order_total for order in orders))
+        resp = self.app.get("/orders/rollups?granularity=day&start=2021-03-01&end=2021-03-03T12:00:00")
+        self.assertEqual([bucket["bucket"] for bucket in resp.get_json()],
+                         ["2021-03-01T00:00:00", "2021-03-02T00:00:00", "2021-03-03T00:00:00"])
+        resp = self.app.get("/orders/rollups?granularity=week")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders/rollups?granularity=minute&start=2000-01-01")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_rollup(self):
+        """ Get the quantity and revenue of a product by status """
+        order = self._create_orders(1)[0]
+        item = order.order_items[0]
+        resp = self.app.get("/products/{}/rollup".format(item.product_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["open_quantity"], item.quantity)
+        self.assertEqual(data["quantity"]["PLACED"], item.quantity)
+        resp = self.app.put("/orders/{}/items/{}/cancel".format(order.id, item.item_id))
+        data = self.app.get("/products/{}/rollup".format(item.product_id)).get_json()
+        self.assertEqual((data["open_quantity"], data["quantity"]["CANCELLED"]), (0, item.quantity))
+        resp = self.app.get("/products/{}/rollup".format(item.product_id + 1000))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_order_events(self):
+        """ Stream the changes of an order, replayed and live """
+        orders = self._create_orders(2)
+        item_id = orders[0].order_items[0].item_id
+        resp = self.app.get("/orders/events")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        broker = ChangeBroker(app, db, poll_interval=0.05)
+        config = {"SSE_HEARTBEAT": 0.05, "SSE_MAX_DURATION": 2}
+        with patch("service.routes.order_events", broker), patch.dict(app.config, config):
+            resp = self.app.get("/orders/events?order_id={}".format(orders[0].id),
+                                headers={"Last-Event-ID": "0"}, buffered=False)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            events = (chunk.decode("utf-8") for chunk in resp.response
+                      if not chunk.startswith(b":"))
+            event = next(events)
+            self.assertIn("event: created\n", event)
+            self.assertIn('"order_id": {}'.format(orders[0].id), event)
+            cancel = threading.Thread(target=app.test_client().put, args=(
+                "/orders/{}/items/{}/cancel".format(orders[0].id, item_id),))
+            cancel.start()
+            event = next(events)
+            cancel.join()
+            self.assertIn("event: updated\n", event)
+            self.assertIn('"items": [{{"item_id": {}, "status": "CANCELLED"}}]'.format(item_id), event)
+            resp.close()
+        self.assertEqual(broker.subscriptions, set())
+        self.assertEqual(broker.streams, 0)
+
+    def test_event_streams_capped(self):
+        """ A worker turns away the streams over SSE_MAX_STREAMS """
+        order = self._create_orders(1)[0]
+        broker = ChangeBroker(app, db, poll_interval=0.05, max_streams=1)
+        with patch("service.routes.order_events", broker), patch.dict(app.config, {"SSE_MAX_DURATION": 2}):
+            path = "/orders/events?order_id={}".format(order.id)
+            first = self.app.get(path, buffered=False)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            resp = self.app.get(path)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("Retry-After", resp.headers)
+            first.close()
+            self.assertEqual(broker.streams, 0)
+            resp = self.app.get(path, buffered=False)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp.close()
@@ -0,0 +1,78 @@
+"""
+Test cases for the compiled payload validators
+
+"""
+import unittest
+from flask_restx import Model, fields
+from service.models import Item, DataValidationError
+from service.routes import order_validator
+from service.validation import ModelValidator
+
+
+def _order(**kwargs):
+    """ Returns a valid create order payload """
+    data = {
+        "customer_id": 1,
+        "order_items": [{"product_id": 2, "quantity": 3, "price": 4.5, "status": "PLACED"}],
+    }
+    data.update(kwargs)
+    return data
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestModelValidator(unittest.TestCase):
+    """ Test Cases for the compiled validators """
+
+    def test_valid_orders(self):
+        """ Valid orders have no errors """
+        self.assertEqual(order_validator.errors(_order()), [])
+        self.assertEqual(order_validator.errors_many([_order(), _order(customer_id=7)]), [])
+
+    def test_all_errors_reported(self):
+        """ Every error is reported with its JSON pointer """
+        payloads = [
+            _order(),
+            _order(customer_id="1", order_items=[
+                {"product_id": 1, "quantity": 0, "price": 1, "status": "PLACED"},
+                {"product_id": 1, "quantity": 1, "price": -1, "status": "LOST"},
+            ]),
+            _order(order_items=[]),
+            "not an order",
+            {"order_items": [{"quantity": True, "price": "1", "status": "PLACED"}]},
+        ]
+        errors = {error["pointer"]: error["message"] for error in order_validator.errors_many(payloads)}
+        self.assertEqual(errors, {
+            "/1/customer_id": "must be an integer",
+            "/1/order_items/0/quantity": "must be greater than or equal to 1",
+            "/1/order_items/1/price": "must be greater than 0",
+            "/1/order_items/1/status": "must be one of PLACED, SHIPPED, DELIVERED, CANCELLED",
+            "/2/order_items": "must contain at least 1 item(s)",
+            "/3": "must be an object",
+            "/4/customer_id": "is required",
+            "/4/order_items/0/product_id": "is required",
+            "/4/order_items/0/quantity": "must be an integer",
+            "/4/order_items/0/price": "must be a number",
+        })
+
+    def test_not_an_array(self):
+        """ A batch must be an array """
+        self.assertEqual(order_validator.errors_many({"customer_id": 1}),
+                         [{"pointer": "", "message": "must be an array"}])
+
+    def test_item_total_rounding_to_zero(self):
+        """ An item whose total rounds to 0 is refused by the bulk validator as by Item.deserialize """
+        item = {"product_id": 2, "quantity": 1, "price": 0.001, "status": "PLACED"}
+        self.assertRaises(DataValidationError, Item().deserialize, dict(item))
+        self.assertEqual(order_validator.errors_many([_order(order_items=[item])]),
+                         [{"pointer": "/0/order_items/0/price", "message": "Invalid Amount: Check price or quantity"}])
+        # reported once the fields themselves are valid
+        self.assertEqual(order_validator.errors(_order(order_items=[dict(item, quantity=0)])),
+                         [{"pointer": "/order_items/0/quantity", "message": "must be greater than or equal to 1"}])
+
+    def test_pointer_escaping(self):
+        """ Keys are escaped in JSON pointers """
+        validator = ModelValidator(Model("Odd", {"a/b~c": fields.Integer(max=5, exclusiveMax=True)}))
+        self.assertEqual(validator.errors({"a/b~c": 5}),
+                         [{"pointer": "/a~1b~0c", "message": "must be less than 5"}])